@@ -1,97 +1,273 @@
 import numpy as np
 import os
 import argparse
+import functools
+import gzip
+import sys
 
-def process_fmri_csv_to_npy(source_dir, output_dir):
+import batch_runner
+from cohort_store import CohortStore
+
+# 输出文件 -> ROI 数 (--store_dir 时每个输出对应一个 cohort store)
+OUTPUT_ROIS = {'roi50.npy': 50, 'roi100.npy': 100, 'roi400.npy': 400, 'roi360.npy': 360}
+
+FILES = {
+    'tian': 'fMRI.Tian_Subcortex_S3_3T.csv.gz',
+    'sch100': 'fMRI.Schaefer17n100p.csv.gz',
+    'sch400': 'fMRI.Schaefer17n400p.csv.gz',
+    'glasser': 'fMRI.Glasser.csv.gz'
+}
+
+
+# Z-score 函数
+def zscore_data(data, axis=1):
+    """
+    axis=1: 对每一行(每个ROI)的所有时间点做标准化
+    均值/方差用 float64 累加，结果保持输入的 dtype
+    """
+    mean = np.mean(data, axis=axis, keepdims=True, dtype=np.float64)
+    std = np.std(data, axis=axis, keepdims=True, dtype=np.float64)
+    # 加上 1e-8 防止除以 0 (例如该 ROI 信号全为 0)
+    return ((data - mean) / (std + 1e-8)).astype(data.dtype, copy=False)
+
+
+def read_roi_csv(path, dtype=np.float32):
+    """
+    读取 ROI x Time 的 CSV(.gz)，去掉表头(Row 0)和索引(Col 0)。
+
+    流式解压 gzip，用 numpy 的 C 解析器 (np.loadtxt) 直接解析为 `dtype`；
+    遇到缺失值等 loadtxt 无法处理的内容时退回 np.genfromtxt (缺失值为 NaN)。
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        n_cols = f.readline().count(',') + 1
+        try:
+            return np.loadtxt(f, delimiter=',', dtype=dtype, usecols=range(1, n_cols), ndmin=2)
+        except ValueError:
+            pass
+    return np.genfromtxt(path, delimiter=',')[1:, 1:].astype(dtype)
+
+
+def process_fmri_csv_to_npy(source_dir, output_dir, dtype=np.float32, quiet=False, store_dir=None, subject_id=None,
+                            stores=None):
     """
     读取 UKB fMRI CSV.gz (假设原始格式为 ROI x Time)，
     去除表头(Row 0)和索引(Col 0)，对时间维度做 Z-score，
     拼接 Schaefer100+Tian50，保存为 .npy。
+
+    给出 store_dir 时不写单独的 .npy，而是把结果写入 `cohort_store.CohortStore`
+    (store_dir/roi50 等，需事先用 `create_stores` 准备) 中 subject_id 对应的行；
+    此时 output_dir 不会被使用。批处理时应传入已打开的 stores (见 `open_stores`)，
+    否则每次调用都要重新打开 (解析整个被试索引)。
+
+    Returns:
+        info: {'saved': {文件名: 形状}, 'errors': {CSV 文件名: 错误信息}}
     """
-    
+    log = (lambda *a: None) if quiet else print
+    info = {'saved': {}, 'errors': {}}
+    if store_dir is not None and stores is None:
+        stores = open_stores(store_dir)
+
     # 1. 确保输出目录存在
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        print(f"创建输出目录: {output_dir}")
-
-    files = {
-        'tian': 'fMRI.Tian_Subcortex_S3_3T.csv.gz',
-        'sch100': 'fMRI.Schaefer17n100p.csv.gz',
-        'sch400': 'fMRI.Schaefer17n400p.csv.gz',
-        'glasser': 'fMRI.Glasser.csv.gz'
-    }
-
-    # Z-score 函数
-    def zscore_data(data, axis=1):
-        """
-        axis=1: 对每一行(每个ROI)的所有时间点做标准化
-        """
-        mean = np.mean(data, axis=axis, keepdims=True)
-        std = np.std(data, axis=axis, keepdims=True)
-        # 加上 1e-8 防止除以 0 (例如该 ROI 信号全为 0)
-        return (data - mean) / (std + 1e-8)
+    if store_dir is None and not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        log(f"创建输出目录: {output_dir}")
 
     # 辅助函数
     def load_clean_csv(filename):
         path = os.path.join(source_dir, filename)
         if not os.path.exists(path):
-            print(f"警告: 文件不存在 {path}")
+            log(f"警告: 文件不存在 {path}")
+            info['errors'][filename] = '文件不存在'
             return None
-        
+
         try:
             # 假设原始文件是 ROI x Time (带表头和索引列)
-            raw_data = np.genfromtxt(path, delimiter=',')
-            
-            # 去掉第一行(Header)和第一列(Index)
             # 结果形状应为 (N_ROI, N_Time)
-            clean_data = raw_data[1:, 1:]
-            
+            clean_data = read_roi_csv(path, dtype=dtype)
+
             # 立即进行 Z-score 标准化
             # 我们希望每个 ROI 自身在时间上变为均值0方差1
             # 输入 (ROI, Time), 在 axis=1 上操作
             norm_data = zscore_data(clean_data, axis=1)
-            
+
             return norm_data
         except Exception as e:
-            print(f"读取错误 {filename}: {e}")
+            log(f"读取错误 {filename}: {e}")
+            info['errors'][filename] = f'{type(e).__name__}: {e}'
             return None
 
+    def save(name, data):
+        if store_dir is not None:
+            store = stores[name]
+            if not store.write(subject_id, data):
+                info['errors'][name] = f'时间点不足: {data.shape[1]} < {store.n_t}'
+            store.flush()
+            info['saved'][name] = list(data.shape)
+            log(f"已写入: {store_dir}/{name[:-len('.npy')]}[{subject_id}], 形状: {data.shape}")
+            return
+        save_path = os.path.join(output_dir, name)
+        np.save(save_path, data)
+        info['saved'][name] = list(data.shape)
+        log(f"已保存: {save_path}, 形状: {data.shape}")
+
     # ================= 2. 读取数据 =================
-    data_tian = load_clean_csv(files['tian'])      # 预期 (50, 490)
-    data_sch100 = load_clean_csv(files['sch100'])  # 预期 (100, 490)
-    data_sch400 = load_clean_csv(files['sch400'])  # 预期 (400, 490)
-    data_glasser = load_clean_csv(files['glasser']) # 预期 (360, 490)
+    data_tian = load_clean_csv(FILES['tian'])      # 预期 (50, 490)
+    data_sch100 = load_clean_csv(FILES['sch100'])  # 预期 (100, 490)
+    data_sch400 = load_clean_csv(FILES['sch400'])  # 预期 (400, 490)
+    data_glasser = load_clean_csv(FILES['glasser']) # 预期 (360, 490)
 
     # ================= 3. 处理与保存 =================
-    
+
     # --- 任务 A: 分别保存 Schaefer100 (100 ROI) 和 Tian (50 ROI) ---
     if data_sch100 is not None and data_tian is not None:
-        save_path_100 = os.path.join(output_dir, 'roi100.npy')
-        np.save(save_path_100, data_sch100)
-        print(f"已保存: {save_path_100}, 形状: {data_sch100.shape}")
-
-        save_path_50 = os.path.join(output_dir, 'roi50.npy')
-        np.save(save_path_50, data_tian)
-        print(f"已保存: {save_path_50}, 形状: {data_tian.shape}")
-
+        save('roi100.npy', data_sch100)
+        save('roi50.npy', data_tian)
 
     # --- 任务 B: 保存 Schaefer400 ---
     if data_sch400 is not None:
-        save_path = os.path.join(output_dir, 'roi400.npy')
-        np.save(save_path, data_sch400)
-        print(f"已保存: {save_path}, 形状: {data_sch400.shape}")
+        save('roi400.npy', data_sch400)
 
     # --- 任务 C: 保存 Glasser ---
     if data_glasser is not None:
-        save_path = os.path.join(output_dir, 'roi360.npy')
-        np.save(save_path, data_glasser)
-        print(f"已保存: {save_path}, 形状: {data_glasser.shape}")
-        
+        save('roi360.npy', data_glasser)
+
+    return info
+
+
+def read_subject_list(lines, output_root=None):
+    """
+    解析批处理列表：每行一个被试目录，可选第二列为输出目录、第三列为被试 ID (空白或逗号分隔)。
+
+    未给输出目录时写到 `output_root/<被试目录名>`，没有 output_root 则写回被试目录本身。
+    未给被试 ID 时用输出目录名 (如脚本中的 `<eid>_<session>`，同一被试的不同 session 不会重名)。
+    空行和以 # 开头的行被跳过。
+
+    Returns:
+        (源目录, 输出目录, 被试 ID) 列表
+    """
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.replace(',', ' ').split()
+        source_dir = fields[0]
+        if len(fields) > 1:
+            output_dir = fields[1]
+        elif output_root:
+            output_dir = os.path.join(output_root, os.path.basename(os.path.normpath(source_dir)))
+        else:
+            output_dir = source_dir
+        subject_id = fields[2] if len(fields) > 2 else subject_id_of(output_dir)
+        jobs.append((source_dir, output_dir, subject_id))
+    return jobs
+
+
+def subject_id_of(path):
+    """被试 ID：目录名 (批处理中默认取输出目录名)。"""
+    return os.path.basename(os.path.normpath(path))
+
+
+def create_stores(store_dir, jobs, n_t=490, dtype=np.float16, overwrite=False):
+    """
+    为批处理中的全部被试准备每个图谱的 cohort store ([n_subjects, n_roi, n_t])。
+
+    已有的 store 被打开并追加其中没有的被试 (ROI 数、n_t、dtype 必须一致)；
+    overwrite=True 时重新创建。
+
+    Returns:
+        在所有 store 中都已有效的被试 ID 集合 (重跑时可跳过)
+    """
+    subjects = [subject_id for _, _, subject_id in jobs]
+    done = None
+    for name, n_roi in OUTPUT_ROIS.items():
+        if overwrite:
+            store = CohortStore.create(store_dir, name[:-len('.npy')], subjects, n_roi, n_t, dtype=dtype,
+                                       overwrite=True)
+        else:
+            store = CohortStore.open_or_create(store_dir, name[:-len('.npy')], subjects, n_roi, n_t, dtype=dtype)
+        valid = set(store.valid_subjects())
+        done = valid if done is None else done & valid
+    return done
+
+
+def open_stores(store_dir):
+    """打开 store_dir 中每个输出对应的 cohort store (可写)，返回 {输出文件名: CohortStore}。"""
+    return {name: CohortStore(store_dir, name[:-len('.npy')], mode='r+') for name in OUTPUT_ROIS}
+
+
+# 每个工作进程只打开一次 cohort store (进程池 initializer)，而不是每写一个图谱打开一次
+_STORES = {}
+
+
+def _init_worker(store_dir):
+    _STORES.clear()
+    if store_dir is not None:
+        _STORES.update(open_stores(store_dir))
+
+
+def _run_job(job, store_dir=None):
+    source_dir, output_dir, subject_id = job
+    status = {'source_dir': source_dir, 'output_dir': output_dir}
+    if store_dir is not None:
+        status = {'source_dir': source_dir, 'subject': subject_id, 'store_dir': store_dir}
+    return batch_runner.run_job(status, process_fmri_csv_to_npy, source_dir, output_dir, quiet=True,
+                                store_dir=store_dir, subject_id=subject_id, stores=_STORES or None)
+
+
+def run_batch(jobs, workers=1, status_file=None, store_dir=None):
+    """
+    在进程池中处理多个被试，每个被试输出一行 JSON 状态 (含缺失/出错的 CSV)。
+    store_dir 不为 None 时写入已准备好的 cohort store (见 `create_stores`)。
+
+    Returns:
+        出错的被试数
+    """
+    return batch_runner.run_batch(functools.partial(_run_job, store_dir=store_dir), jobs, workers=workers,
+                                  status_file=status_file, chunksize=8, initializer=_init_worker,
+                                  initargs=(store_dir,))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="处理 UKB fMRI CSV.gz 文件并保存为 .npy 格式")
-    parser.add_argument('--source_dir', type=str, required=True, help='源数据目录，包含 fMRI CSV.gz 文件')
-    parser.add_argument('--output_dir', type=str, required=True, help='输出目录，用于保存处理后的 .npy 文件')
-    
+    parser.add_argument('--source_dir', type=str, default=None, help='源数据目录，包含 fMRI CSV.gz 文件')
+    parser.add_argument('--output_dir', type=str, default=None, help='输出目录，用于保存处理后的 .npy 文件')
+    parser.add_argument('--batch', '-b', type=str, default=None,
+                        help='被试目录列表文件 (每行 "源目录 [输出目录 [被试 ID]]"，"-" 表示 stdin)；'
+                             '每个被试输出一行 JSON 状态')
+    parser.add_argument('--output_root', type=str, default=None,
+                        help='--batch 时未指定输出目录的被试写到 <output_root>/<被试目录名> (默认写回源目录)')
+    parser.add_argument('--workers', '-w', type=int, default=1, help='--batch 的进程数，默认 1')
+    parser.add_argument('--store_dir', type=str, default=None,
+                        help='--batch 时把所有被试写入此目录下每个图谱一个的 cohort store '
+                             '([n_subjects, n_roi, T] memmap，见 cohort_store.py)，而不是每个被试四个 .npy；'
+                             '已有的 store 会追加新被试，已有效的被试被跳过')
+    parser.add_argument('--overwrite_store', action='store_true',
+                        help='重新创建 --store_dir 中已有的 cohort store (丢弃已写入的被试)')
+    parser.add_argument('--store_dtype', type=str, default='float16', choices=['float16', 'float32'],
+                        help='cohort store 的 dtype，默认 float16')
+    parser.add_argument('--n_t', type=int, default=490, help='cohort store 的时间点数，默认 490')
+    parser.add_argument('--status_file', type=str, default=None, help='把 --batch 的状态行追加到此文件而不是 stdout')
+
     args = parser.parse_args()
-    
+
+    if args.batch:
+        if args.batch == '-':
+            jobs = read_subject_list(sys.stdin, args.output_root)
+        else:
+            with open(args.batch) as f:
+                jobs = read_subject_list(f, args.output_root)
+        if args.store_dir:
+            done = create_stores(args.store_dir, jobs, n_t=args.n_t, dtype=np.dtype(args.store_dtype),
+                                 overwrite=args.overwrite_store)
+            todo = [job for job in jobs if job[2] not in done]
+            if len(todo) < len(jobs):
+                print(f'跳过 {len(jobs) - len(todo)} 个已写入 cohort store 的被试', file=sys.stderr)
+            jobs = todo
+        n_failed = run_batch(jobs, workers=args.workers, status_file=args.status_file, store_dir=args.store_dir)
+        sys.exit(1 if n_failed else 0)
+
+    if not args.source_dir or not args.output_dir:
+        parser.error('需要 --source_dir 和 --output_dir，或使用 --batch')
     process_fmri_csv_to_npy(args.source_dir, args.output_dir)
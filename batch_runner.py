@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+def run_job(status: dict, func, *args, **kwargs) -> dict:
+    """
+    Call ``func(*args, **kwargs)`` and fill in the JSON status line of one job.
+
+    `func` returns an info dict that is merged into `status`. The job is
+    'ok' unless `func` raises or reports a non-empty ``info['errors']``.
+    The wall time is stored as ``status['seconds']``.
+    """
+    t0 = time.perf_counter()
+    try:
+        info = func(*args, **kwargs)
+        status.update(status='error' if info.get('errors') else 'ok', **info)
+    except Exception as e:
+        status.update(status='error', error=f'{type(e).__name__}: {e}')
+    status['seconds'] = round(time.perf_counter() - t0, 3)
+    return status
+
+
+def run_batch(func, jobs, workers: int = 1, status_file=None, chunksize: int = 1, initializer=None,
+              initargs=()) -> int:
+    """
+    Run ``func(job)`` for every job and print one JSON status line per job, in job order.
+
+    Parameters
+    ----------
+    func : callable
+        Picklable job runner (module-level function or `functools.partial`)
+        returning a status dict with a 'status' key, usually via `run_job`.
+    jobs : iterable
+        Job descriptions passed to `func`.
+    workers : int
+        Processes; 1 runs the jobs in this interpreter.
+    status_file : str or None
+        Append the status lines to this file instead of stdout.
+    chunksize : int
+        Jobs sent to a worker at a time (larger for many short jobs).
+    initializer : callable or None
+        Called as ``initializer(*initargs)`` once per worker process (or once
+        here when `workers` is 1), e.g. to open files shared by all jobs.
+    initargs : tuple
+        Arguments of `initializer`.
+
+    Returns
+    -------
+    int
+        Number of failed jobs.
+    """
+    out = open(status_file, 'a') if status_file else sys.stdout
+    n_failed = 0
+    try:
+        if workers > 1:
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+            results = pool.map(func, jobs, chunksize=chunksize)
+        else:
+            pool = None
+            if initializer is not None:
+                initializer(*initargs)
+            results = map(func, jobs)
+
+        for status in results:
+            n_failed += status['status'] != 'ok'
+            out.write(json.dumps(status, ensure_ascii=False) + '\n')
+            out.flush()
+
+        if pool is not None:
+            pool.shutdown()
+    finally:
+        if status_file:
+            out.close()
+    return n_failed
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import json
+import os
+
+import numpy as np
+
+_VERSION = 1
+
+
+def _paths(root: str, name: str) -> dict:
+    base = os.path.join(root, name)
+    return {'data': base + '.npy', 'index': base + '.index.json',
+            'valid': base + '.valid.npy', 'lengths': base + '.lengths.npy'}
+
+
+class CohortStore:
+    """
+    One preallocated on-disk array per atlas holding every subject's ROI x time series.
+
+    A store ``<root>/<name>`` consists of
+
+    - ``<name>.npy``: ``[n_subjects, n_roi, T]`` array (float16 or float32),
+      opened with `np.lib.format.open_memmap`;
+    - ``<name>.index.json``: subject IDs in row order plus the array geometry;
+    - ``<name>.valid.npy``: bool per subject, True once a full-length run was written;
+    - ``<name>.lengths.npy``: int32 number of time points actually written
+      (shorter runs are zero-padded and stay invalid).
+
+    Rows of different subjects are disjoint, so several processes can fill one
+    store concurrently, each opening it with ``mode='r+'``. Reading a subject
+    returns a view into the memmap: no open/read/parse per subject. A store
+    is grown with new subjects by `open_or_create` / `append_subjects`
+    (not while other processes have it open).
+    """
+
+    def __init__(self, root: str, name: str, mode='r'):
+        self.root, self.name, self.mode = root, name, mode
+        paths = _paths(root, name)
+        with open(paths['index']) as f:
+            meta = json.load(f)
+        if meta.get('version') != _VERSION:
+            raise ValueError(f'Unsupported cohort store version {meta.get("version")} for {paths["index"]}')
+
+        self.subjects = meta['subjects']
+        self.n_roi, self.n_t = meta['n_roi'], meta['n_t']
+        self._row = {s: i for i, s in enumerate(self.subjects)}
+        self.data = np.lib.format.open_memmap(paths['data'], mode=mode)
+        self.valid = np.lib.format.open_memmap(paths['valid'], mode=mode)
+        self.lengths = np.lib.format.open_memmap(paths['lengths'], mode=mode)
+        if not len(self.data) == len(self.valid) == len(self.lengths) == len(self.subjects):
+            raise ValueError(f'Cohort store {paths["index"]} is inconsistent: {len(self.subjects)} subjects, '
+                             f'{len(self.data)} rows (interrupted append_subjects?)')
+
+    @staticmethod
+    def _check_unique(subjects: list) -> None:
+        if len(set(subjects)) != len(subjects):
+            dup = sorted(s for s, n in collections.Counter(subjects).items() if n > 1)
+            raise ValueError(f'Subject IDs must be unique, duplicated: {dup[:10]}')
+
+    @classmethod
+    def create(cls, root: str, name: str, subjects, n_roi: int, n_t: int, dtype=np.float16, overwrite=False):
+        """Preallocate an empty store (all subjects invalid) and open it for writing."""
+        subjects = [str(s) for s in subjects]
+        cls._check_unique(subjects)
+        paths = _paths(root, name)
+        if os.path.exists(paths['index']) and not overwrite:
+            raise FileExistsError(f'Cohort store {paths["index"]} already exists')
+        os.makedirs(root, exist_ok=True)
+
+        shape = (len(subjects), n_roi, n_t)
+        # open_memmap creates a sparse file: untouched rows read as zeros and take no disk space
+        np.lib.format.open_memmap(paths['data'], mode='w+', dtype=np.dtype(dtype), shape=shape).flush()
+        np.lib.format.open_memmap(paths['valid'], mode='w+', dtype=bool, shape=(len(subjects),)).flush()
+        np.lib.format.open_memmap(paths['lengths'], mode='w+', dtype=np.int32, shape=(len(subjects),)).flush()
+
+        meta = {'version': _VERSION, 'name': name, 'n_roi': n_roi, 'n_t': n_t,
+                'dtype': np.dtype(dtype).str, 'subjects': subjects}
+        with open(paths['index'] + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(paths['index'] + '.tmp', paths['index'])
+        return cls(root, name, mode='r+')
+
+    @classmethod
+    def open_or_create(cls, root: str, name: str, subjects, n_roi: int, n_t: int, dtype=np.float16):
+        """
+        Open an existing store for writing, appending those of `subjects` it
+        does not have yet, or create it.
+
+        An existing store must have the same ``n_roi``, ``n_t`` and dtype.
+        Rows already written (and their valid flags) are kept.
+        """
+        subjects = [str(s) for s in subjects]
+        cls._check_unique(subjects)
+        if not os.path.exists(_paths(root, name)['index']):
+            return cls.create(root, name, subjects, n_roi, n_t, dtype=dtype)
+        store = cls(root, name, mode='r+')
+        if (store.n_roi, store.n_t, store.data.dtype) != (n_roi, n_t, np.dtype(dtype)):
+            raise ValueError(f'Cohort store {name} in {root} is ({store.n_roi}, {store.n_t}) {store.data.dtype}, '
+                             f'expected ({n_roi}, {n_t}) {np.dtype(dtype)}')
+        new = [s for s in subjects if s not in store]
+        return store.append_subjects(new) if new else store
+
+    def append_subjects(self, subjects, block=256):
+        """
+        Grow the store by `subjects` (zero rows, invalid); returns the reopened store.
+
+        The arrays are rewritten to temporary files (copying `block` rows at a
+        time) and swapped in, the index last.
+        """
+        subjects = [str(s) for s in subjects]
+        self._check_unique(self.subjects + subjects)
+        if self.mode == 'r':
+            raise ValueError('append_subjects needs a store opened for writing')
+        paths = _paths(self.root, self.name)
+        n_old, n_new = len(self.subjects), len(self.subjects) + len(subjects)
+        for key, old in (('data', self.data), ('valid', self.valid), ('lengths', self.lengths)):
+            tmp = paths[key] + '.tmp.npy'
+            grown = np.lib.format.open_memmap(tmp, mode='w+', dtype=old.dtype, shape=(n_new,) + old.shape[1:])
+            for i in range(0, n_old, block):
+                j = min(i + block, n_old)
+                grown[i:j] = old[i:j]
+            grown.flush()
+            del grown
+            os.replace(tmp, paths[key])
+
+        with open(paths['index']) as f:
+            meta = json.load(f)
+        meta['subjects'] = self.subjects + subjects
+        with open(paths['index'] + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(paths['index'] + '.tmp', paths['index'])
+        return type(self)(self.root, self.name, mode=self.mode)
+
+    def __len__(self) -> int:
+        return len(self.subjects)
+
+    def __contains__(self, subject) -> bool:
+        return subject in self._row
+
+    def index_of(self, subject: str) -> int:
+        return self._row[subject]
+
+    def write(self, subject: str, arr: np.ndarray) -> bool:
+        """
+        Store one subject's (n_roi, t) series; returns whether it counts as valid.
+
+        Runs longer than the store are truncated, shorter ones are zero-padded
+        and marked invalid.
+        """
+        i = self._row[subject]
+        arr = np.asarray(arr)
+        if arr.ndim != 2 or arr.shape[0] != self.n_roi:
+            raise ValueError(f'{self.name}: expected ({self.n_roi}, T) for {subject}, got {arr.shape}')
+        t = min(arr.shape[1], self.n_t)
+        self.data[i, :, :t] = arr[:, :t]
+        self.data[i, :, t:] = 0
+        self.lengths[i] = t
+        self.valid[i] = t == self.n_t
+        return bool(self.valid[i])
+
+    def invalidate(self, subject: str) -> None:
+        i = self._row[subject]
+        self.valid[i] = False
+        self.lengths[i] = 0
+
+    def __getitem__(self, subject: str) -> np.ndarray:
+        """Zero-copy (n_roi, T) view of one subject."""
+        return self.data[self._row[subject]]
+
+    def get(self, subject: str, valid_only=True):
+        """Like ``store[subject]``, but None for unknown (or, with `valid_only`, invalid) subjects."""
+        i = self._row.get(subject)
+        if i is None or (valid_only and not self.valid[i]):
+            return None
+        return self.data[i]
+
+    def take(self, subjects) -> np.ndarray:
+        """(len(subjects), n_roi, T) copy for a batch of subjects."""
+        return self.data[[self._row[s] for s in subjects]]
+
+    def valid_subjects(self) -> list:
+        return [s for s, ok in zip(self.subjects, self.valid) if ok]
+
+    def flush(self) -> None:
+        if self.mode != 'r':
+            for arr in (self.data, self.valid, self.lengths):
+                arr.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize cohort stores written by atlas_concat.py --store_dir.')
+    parser.add_argument('root', help='Store directory.')
+    parser.add_argument('names', nargs='*', help='Store names (default: every store in the directory).')
+    args = parser.parse_args()
+
+    names = args.names or sorted(f[:-len('.index.json')] for f in os.listdir(args.root) if f.endswith('.index.json'))
+    for name in names:
+        store = CohortStore(args.root, name)
+        n_valid = int(store.valid.sum())
+        print(f'{name}: {len(store)} subjects x {store.n_roi} ROIs x {store.n_t} time points ({store.data.dtype}), '
+              f'{n_valid} valid, {int((store.lengths > 0).sum()) - n_valid} short, '
+              f'{int((store.lengths == 0).sum())} missing')
+
+
+if __name__ == '__main__':
+    main()
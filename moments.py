@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import fnmatch
+import functools
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+class Moments:
+    """
+    Count, mean and sum of squared deviations (M2) of the non-zero entries of an array.
+
+    Statistics are accumulated chunk by chunk: each chunk is reduced with a
+    shifted two-pass sum (deviations from a running estimate of the mean, so
+    high-mean BOLD data does not cancel the way ``sum(x**2)/n - mean**2``
+    does), and partial results combine with Chan et al.'s pairwise update.
+    Accumulators built on different windows, chunks or processes can
+    therefore be merged exactly::
+
+        pre = Moments().update(data[..., :40])
+        post = Moments().update(data[..., -40:])
+        both = pre.copy().merge(post)
+
+    Zeros (background, masked-out voxels) are not counted, as in
+    `nifti_process.global_zscore_nonzero`. Per-subject accumulators are
+    stored with `stats_arrays` and merged across a cohort with `reduce_stats`.
+    """
+
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = int(count)
+        self.mean = float(mean)
+        self.m2 = float(m2)
+
+    def __repr__(self):
+        return f'Moments(count={self.count}, mean={self.mean!r}, m2={self.m2!r})'
+
+    def copy(self):
+        return Moments(self.count, self.mean, self.m2)
+
+    def update(self, chunk: np.ndarray, out=None):
+        """
+        Add the non-zero entries of `chunk`; returns self.
+
+        The deviations are computed in float32 (float64 for float64 input)
+        and summed in float64. `out` is an optional scratch array of the
+        chunk's shape (e.g. reused across the chunks of one file).
+        """
+        chunk = np.asarray(chunk)
+        nz = chunk != 0
+        n = int(np.count_nonzero(nz))
+        if n == 0:
+            return self
+        dtype = np.float64 if chunk.dtype == np.float64 else np.float32
+        # Shift by the running mean (or a rough chunk mean for the first chunk)
+        shift = self.mean if self.count else float(chunk.sum(dtype=np.float64)) / n
+
+        if out is None:
+            out = np.zeros(chunk.shape, dtype=dtype)
+        else:
+            out[...] = 0
+        np.subtract(chunk, dtype(shift), out=out, where=nz, casting='unsafe')
+        d = float(out.sum(dtype=np.float64))
+        np.multiply(out, out, out=out)
+        dd = float(out.sum(dtype=np.float64))
+
+        # float32(shift) rather than shift is what was subtracted
+        mean = float(dtype(shift)) + d / n
+        m2 = max(dd - d * d / n, 0.0)
+        return self.merge(Moments(n, mean, m2))
+
+    def merge(self, other):
+        """Combine with the statistics of another set of entries (Chan et al.); returns self."""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            return self
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / n
+        self.m2 += other.m2 + delta * delta * self.count * other.count / n
+        self.count = n
+        return self
+
+    @property
+    def var(self) -> float:
+        """Population variance (ddof=0)."""
+        return self.m2 / self.count if self.count else 0.0
+
+    def std(self, eps=1e-8) -> float:
+        """Population standard deviation, with the variance floored at `eps`."""
+        return float(np.sqrt(max(self.var, eps)))
+
+    def mean_std(self, eps=1e-8):
+        """``(mean, std)`` to normalize with; ``(0.0, 1.0)`` when nothing was counted."""
+        return (self.mean, self.std(eps)) if self.count else (0.0, 1.0)
+
+    @classmethod
+    def of(cls, arr: np.ndarray, chunk_size=32, dtype=None):
+        """
+        Statistics of a whole (..., T) array, reduced in chunks of `chunk_size` along the last axis.
+
+        With `dtype` (e.g. float32 for float64 data from ``get_fdata``) each
+        chunk is converted first, so the result matches `update` calls on
+        chunks of that dtype.
+        """
+        arr = np.asarray(arr)
+        m = cls()
+        if arr.ndim == 0:
+            return m.update(arr if dtype is None else arr.astype(dtype))
+        n_t = arr.shape[-1]
+        step = chunk_size if chunk_size and chunk_size > 0 else max(n_t, 1)
+        buf = src = None
+        for t0 in range(0, n_t, step):
+            chunk = arr[..., t0:t0 + step]
+            if buf is None or buf.shape != chunk.shape:
+                work = np.dtype(dtype) if dtype is not None else arr.dtype
+                buf = np.empty(chunk.shape, dtype=np.float64 if work == np.float64 else np.float32)
+                src = None if dtype is None else np.empty(chunk.shape, dtype=dtype)
+            if src is not None:
+                src[...] = chunk
+                chunk = src
+            m.update(chunk, out=buf)
+        return m
+
+
+class VoxelMoments:
+    """
+    Per-voxel `Moments` of the non-zero entries along the last (time) axis.
+
+    ``update`` takes (X, Y, Z, t) chunks (a 3D volume counts as one time
+    point per voxel), and ``merge`` combines maps element-wise, e.g. across
+    the subjects of a cohort. Accumulation is in float64; `stats_arrays`
+    stores the maps as int32 counts and float32 mean/M2.
+    """
+
+    def __init__(self, count=None, mean=None, m2=None):
+        self.count = None if count is None else np.asarray(count, dtype=np.int64)
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = None if m2 is None else np.asarray(m2, dtype=np.float64)
+
+    @property
+    def shape(self):
+        return None if self.count is None else self.count.shape
+
+    def copy(self):
+        if self.count is None:
+            return VoxelMoments()
+        return VoxelMoments(self.count.copy(), self.mean.copy(), self.m2.copy())
+
+    def update(self, chunk: np.ndarray):
+        """Add an (X, Y, Z, t) chunk (or an (X, Y, Z) volume); returns self."""
+        chunk = np.asarray(chunk)
+        if chunk.ndim == 3:
+            chunk = chunk[..., np.newaxis]
+        nz = chunk != 0
+        n = np.count_nonzero(nz, axis=-1)
+        s = chunk.sum(axis=-1, dtype=np.float64)
+        mean = np.divide(s, n, out=np.zeros(n.shape), where=n > 0)
+        d = np.subtract(chunk, mean[..., np.newaxis], dtype=np.float64)
+        d *= nz
+        m2 = np.einsum('...t,...t->...', d, d)
+        return self.merge(VoxelMoments(n, mean, m2))
+
+    def merge(self, other):
+        """Element-wise Chan et al. merge with another map of the same shape; returns self."""
+        if other.count is None:
+            return self
+        if self.count is None:
+            self.count, self.mean, self.m2 = other.count.copy(), other.mean.copy(), other.m2.copy()
+            return self
+        if other.shape != self.shape:
+            raise ValueError(f'Cannot merge voxel moments of shapes {self.shape} and {other.shape}')
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        w = np.divide(other.count, n, out=np.zeros(n.shape), where=n > 0)
+        self.mean += delta * w
+        self.m2 += other.m2 + delta * delta * self.count * w
+        self.count = n
+        return self
+
+    @classmethod
+    def of(cls, arr: np.ndarray, chunk_size=32):
+        """Maps of a whole (X, Y, Z[, T]) array, reduced in chunks of `chunk_size` time points."""
+        arr = np.asarray(arr)
+        if arr.ndim == 3:
+            return cls().update(arr)
+        m = cls()
+        step = chunk_size if chunk_size and chunk_size > 0 else max(arr.shape[-1], 1)
+        for t0 in range(0, arr.shape[-1], step):
+            m.update(arr[..., t0:t0 + step])
+        return m
+
+    @property
+    def var(self) -> np.ndarray:
+        return np.divide(self.m2, self.count, out=np.zeros(self.shape), where=self.count > 0)
+
+    def std(self, eps=1e-8) -> np.ndarray:
+        return np.sqrt(np.maximum(self.var, eps))
+
+
+def normalize_nonzero_(chunk: np.ndarray, mean: float, std: float, nz=None) -> np.ndarray:
+    """
+    In place ``chunk[nz] = (chunk[nz] - mean) / std`` on a float32 chunk, zeros untouched.
+
+    No fancy-indexed temporaries are made; `nz` is an optional bool scratch
+    array of the chunk's shape. Returns `chunk`.
+    """
+    if nz is None:
+        nz = chunk != 0
+    else:
+        np.not_equal(chunk, 0, out=nz)
+    np.subtract(chunk, chunk.dtype.type(mean), out=chunk, where=nz)
+    np.divide(chunk, chunk.dtype.type(std), out=chunk, where=nz)
+    return chunk
+
+
+def zscore_nonzero_f16(arr: np.ndarray, mean: float, std: float, chunk_size=32) -> np.ndarray:
+    """
+    float16 copy of `arr` z-scored on its non-zero entries.
+
+    Works through (..., t) chunks along the last axis: each is converted to
+    float32, normalized in place with `normalize_nonzero_` and cast to
+    float16 into the output, so the only full-size allocation is the result.
+    """
+    arr = np.asarray(arr)
+    out = np.empty(arr.shape, dtype=np.float16, order='F' if arr.flags.f_contiguous else 'C')
+    if arr.ndim == 0 or arr.size == 0:
+        out[...] = arr
+        return out
+    n_t = arr.shape[-1]
+    step = chunk_size if chunk_size and chunk_size > 0 else n_t
+    buf = nz = None
+    for t0 in range(0, n_t, step):
+        src = arr[..., t0:t0 + step]
+        if buf is None or buf.shape != src.shape:
+            buf = np.empty(src.shape, dtype=np.float32)
+            nz = np.empty(src.shape, dtype=bool)
+        buf[...] = src
+        out[..., t0:t0 + step] = normalize_nonzero_(buf, mean, std, nz=nz)
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Stored statistics: per-subject files (``<output>_meanstd.npz.zst`` of
+# nifti_process.py, ``_masking_stats.npz.zst`` of nifti_mask_proc.py with
+# ``pre_``/``post_`` prefixes, ``_stats.csv`` of mri_t1_mni2npyzst.py) and the
+# cohort file written by `reduce_stats`, which has the same layout.
+# ---------------------------------------------------------------------------
+
+def stats_arrays(moments: Moments, voxel=None, prefix='', eps=1e-8) -> dict:
+    """
+    Arrays to store for one accumulator: ``mean``/``std`` (what normalization
+    used) plus ``count``/``m2`` for merging, and optional ``voxel_*`` maps.
+    """
+    out = {'mean': moments.mean, 'std': moments.std(eps), 'count': moments.count, 'm2': moments.m2}
+    if voxel is not None and voxel.count is not None:
+        out.update(voxel_count=voxel.count.astype(np.int32), voxel_mean=voxel.mean.astype(np.float32),
+                   voxel_m2=voxel.m2.astype(np.float32))
+    return {prefix + k: v for k, v in out.items()}
+
+
+def parse_stats(data, name: str, prefix=''):
+    """
+    Decode one stored statistics file (raw file contents).
+
+    Returns
+    -------
+    moments : Moments
+    voxel : VoxelMoments or None
+    applied : tuple
+        ``(mean, std)`` the subject was normalized with.
+    """
+    if name.endswith('.csv'):
+        import csv
+        rows = list(csv.DictReader(io.StringIO(bytes(data).decode('utf-8'))))
+        if not rows or 'Count' not in rows[0]:
+            raise ValueError(f'{name} has no Count column; re-run mri_t1_mni2npyzst.py to get mergeable stats')
+        row = rows[0]
+        count, mean, std = int(row['Count']), float(row['Mean']), float(row['Std'])
+        m2 = float(row['M2']) if 'M2' in row else float(row['Var']) * count
+        return Moments(count, mean, m2), None, (mean, std)
+
+    if name.endswith('.zst'):
+        import np_zstd
+        npz = np_zstd.loads(data)
+    else:
+        npz = np.load(io.BytesIO(data))
+    with npz:
+        keys = set(npz.files)
+        if prefix + 'count' not in keys:
+            raise ValueError(f'{name} has no {prefix}count/{prefix}m2; it was written before mergeable stats')
+        moments = Moments(int(npz[prefix + 'count']), float(npz[prefix + 'mean']), float(npz[prefix + 'm2']))
+        applied = (float(npz[prefix + 'mean']), float(npz[prefix + 'std']))
+        voxel = None
+        if prefix + 'voxel_count' in keys:
+            voxel = VoxelMoments(npz[prefix + 'voxel_count'], npz[prefix + 'voxel_mean'], npz[prefix + 'voxel_m2'])
+    return moments, voxel, applied
+
+
+def load_stats(file: str, prefix=''):
+    """`parse_stats` for a file on disk."""
+    with open(file, 'rb') as f:
+        return parse_stats(f.read(), file, prefix=prefix)
+
+
+def tree_reduce(items: list, merge, fanout=16):
+    """Merge `items` in groups of `fanout`, level by level, until one is left (None if empty)."""
+    items = list(items)
+    if not items:
+        return None
+    while len(items) > 1:
+        items = [functools.reduce(merge, items[i:i + fanout]) for i in range(0, len(items), fanout)]
+    return items[0]
+
+
+def _merge_pair(a, b):
+    (ma, va), (mb, vb) = a, b
+    ma.merge(mb)
+    if vb is not None:
+        va = vb if va is None else va.merge(vb)
+    return ma, va
+
+
+def _iter_stats_refs(paths, pattern):
+    """
+    Yield ``(shard, key)`` references to stats files without reading them.
+
+    `shard` is None for files on disk (`key` is the path) and the shard or
+    shard directory path for tar members (`key` is ``(subject, member)``).
+    """
+    for path in paths:
+        if os.path.isfile(path) and not path.endswith('.tar'):
+            yield None, path
+            continue
+        if os.path.isdir(path) and not any(f.endswith('.tar') for f in os.listdir(path)):
+            for root, _, files in os.walk(path):
+                for f in sorted(fnmatch.filter(files, pattern)):
+                    yield None, os.path.join(root, f)
+            continue
+        from shard import ShardSet
+        with ShardSet(path) as shards:
+            for subject in shards.subjects():
+                for member in fnmatch.filter(shards.members(subject), pattern):
+                    yield path, (subject, member)
+
+
+def _read_refs(refs):
+    """Yield ``(name, data)`` for `_iter_stats_refs` references, opening each shard set once."""
+    open_shards = {}
+    try:
+        for shard, key in refs:
+            if shard is None:
+                with open(key, 'rb') as f:
+                    yield key, f.read()
+                continue
+            if shard not in open_shards:
+                from shard import ShardSet
+                open_shards[shard] = ShardSet(shard)
+            subject, member = key
+            yield f'{subject}/{member}', open_shards[shard].read_bytes(subject, member)
+    finally:
+        for shards in open_shards.values():
+            shards.close()
+
+
+def _reduce_group(refs, prefix, voxel, fanout):
+    """
+    Read and reduce one group of stats file references (runs in a worker).
+
+    Files are parsed `fanout` at a time and each batch is merged right away,
+    so at most `fanout` files plus one partial result per batch are held.
+    """
+    partial, batch = [], []
+    for name, data in _read_refs(refs):
+        moments, voxel_moments, _ = parse_stats(data, name, prefix=prefix)
+        batch.append((moments, voxel_moments if voxel else None))
+        if len(batch) == fanout:
+            partial.append(tree_reduce(batch, _merge_pair, fanout=fanout))
+            batch = []
+    if batch:
+        partial.append(tree_reduce(batch, _merge_pair, fanout=fanout))
+    return tree_reduce(partial, _merge_pair, fanout=fanout)
+
+
+def reduce_stats(paths, pattern='*_meanstd.npz.zst', prefix='', voxel=True, workers=1, fanout=16, group_size=256):
+    """
+    Merge many stored statistics files into cohort statistics.
+
+    The files are listed (not read) up front and split into groups of
+    `group_size`; each group is read and tree-reduced by one worker (a
+    process pool with ``workers > 1``), and the group results are
+    tree-reduced again. Only the small statistics members are read: the
+    normalized volumes are never decompressed.
+
+    Parameters
+    ----------
+    paths : list of str
+        Statistics files, directories searched recursively for `pattern`,
+        or tar shards / directories of shards (members matching `pattern`).
+    prefix : str
+        Key prefix inside .npz files (``pre_``/``post_`` for nifti_mask_proc.py).
+    voxel : bool
+        Also merge per-voxel maps when the files have them.
+
+    Returns
+    -------
+    moments : Moments
+    voxel : VoxelMoments or None
+    n_files : int
+    """
+    refs = list(_iter_stats_refs(paths, pattern))
+    if not refs:
+        raise ValueError(f'No statistics files matching {pattern} in {paths}')
+    groups = [refs[i:i + group_size] for i in range(0, len(refs), group_size)]
+    if workers > 1 and len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            partial = list(pool.map(_reduce_group, groups, [prefix] * len(groups), [voxel] * len(groups),
+                                    [fanout] * len(groups)))
+    else:
+        partial = [_reduce_group(g, prefix, voxel, fanout) for g in groups]
+    moments, voxel_moments = tree_reduce(partial, _merge_pair, fanout=fanout)
+    return moments, voxel_moments, len(refs)
+
+
+def renormalize_(z: np.ndarray, applied, cohort, eps=1e-8) -> np.ndarray:
+    """
+    Turn a subject-normalized array into a cohort-normalized one, in place.
+
+    `z` holds ``(x - mean_s) / std_s`` on the non-zero entries, with
+    ``applied = (mean_s, std_s)``. `cohort` is a `Moments` (global z-score)
+    or a `VoxelMoments` ((X, Y, Z) maps broadcast over a trailing time axis);
+    zeros stay zero. `z` must be floating point.
+    """
+    mean_s, std_s = applied
+    nz = z != 0
+    if isinstance(cohort, VoxelMoments):
+        mean, std = cohort.mean, cohort.std(eps)
+        if z.ndim == mean.ndim + 1:
+            mean, std = mean[..., np.newaxis], std[..., np.newaxis]
+        np.multiply(z, z.dtype.type(std_s), out=z, where=nz)
+        np.add(z, z.dtype.type(mean_s), out=z, where=nz)
+        np.subtract(z, mean.astype(z.dtype), out=z, where=nz)
+        np.divide(z, std.astype(z.dtype), out=z, where=nz)
+        return z
+    # (x - m) / s with x = z * std_s + mean_s, as one affine map
+    std = cohort.std(eps)
+    np.multiply(z, z.dtype.type(std_s / std), out=z, where=nz)
+    np.add(z, z.dtype.type((mean_s - cohort.mean) / std), out=z, where=nz)
+    return z
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge per-subject normalization statistics into cohort statistics.')
+    parser.add_argument('output', help='Cohort statistics file (.npz.zst), same layout as the per-subject files.')
+    parser.add_argument('paths', nargs='*', help='Statistics files, directories, or tar shards / shard directories.')
+    parser.add_argument('--list', '-l', type=str, default=None, help='Text file with one path per line.')
+    parser.add_argument('--pattern', '-p', type=str, default='*_meanstd.npz.zst',
+                        help='fnmatch pattern of statistics files in directories and shards '
+                             '(e.g. "*_masking_stats.npz.zst", "*_stats.csv").')
+    parser.add_argument('--prefix', type=str, default='', help='Key prefix inside .npz files (e.g. pre_, post_).')
+    parser.add_argument('--no_voxel', action='store_true', help='Ignore per-voxel maps.')
+    parser.add_argument('--workers', '-w', type=int, default=1, help='Worker processes.')
+    parser.add_argument('--fanout', type=int, default=16, help='Merge tree fan-out.')
+    args = parser.parse_args()
+
+    paths = list(args.paths)
+    if args.list:
+        with open(args.list) as f:
+            paths += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if not paths:
+        parser.error('Give statistics paths or --list.')
+
+    moments, voxel, n_files = reduce_stats(paths, pattern=args.pattern, prefix=args.prefix,
+                                           voxel=not args.no_voxel, workers=args.workers, fanout=args.fanout)
+    import np_zstd
+    np_zstd.savez(args.output, n_files=n_files, **stats_arrays(moments, voxel))
+    print(f'{n_files} files, {moments.count} non-zero entries: mean {moments.mean:.6g}, std {moments.std():.6g}'
+          + (f', voxel maps {voxel.shape}' if voxel is not None else ''))
+
+
+if __name__ == '__main__':
+    main()
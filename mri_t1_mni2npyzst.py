@@ -1,26 +1,186 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import io
 import os
+import sys
 
 import nibabel as nib
 import numpy as np
-import zstandard as zstd
 
-_LEVEL = 8
-_WRITE_CHECKSUM = True
-_WRITE_CONTENT_SIZE = True
+from moments import Moments, normalize_nonzero_
+from np_zstd import load, save, savez
 
-_cctx = zstd.ZstdCompressor(level=_LEVEL, write_checksum=_WRITE_CHECKSUM, write_content_size=_WRITE_CONTENT_SIZE)
 
+def crop_slices(shape, bbox=None, target_shape=None):
+    """
+    Index plan ``out[dst] = data[src]`` for cropping a volume of `shape`.
 
-def save(file, arr, allow_pickle=False) -> None:
-    buf = io.BytesIO()
-    np.save(buf, arr, allow_pickle=allow_pickle)
+    Parameters
+    ----------
+    bbox : sequence of 6 int or None
+        Half-open box ``(x0, x1, y0, y1, z0, z1)`` to keep (e.g. the cohort-wide
+        brain bounding box from `brain_bbox`); must lie inside the volume.
+    target_shape : sequence of 3 int or None
+        Centered crop/pad of the whole volume to this shape (ignored with `bbox`).
 
-    with open(file, 'wb') as _f:
-        _f.write(_cctx.compress(buf.getvalue()))
+    Returns
+    -------
+    src, dst : tuple of slice
+    offset : np.ndarray
+        (3,) position of ``out[0, 0, 0]`` in the original volume (negative where padded).
+    out_shape : tuple of int
+    """
+    src, dst, offset, out_shape = [], [], [], []
+    for axis, n in enumerate(shape):
+        if bbox is not None:
+            lo, hi = int(bbox[2 * axis]), int(bbox[2 * axis + 1])
+            if not 0 <= lo < hi <= n:
+                raise ValueError(f'Bounding box {list(bbox)} does not fit a volume of shape {tuple(shape)}')
+            src.append(slice(lo, hi))
+            dst.append(slice(None))
+            offset.append(lo)
+            out_shape.append(hi - lo)
+            continue
+        new = int(target_shape[axis])
+        # Same split as nifti_process.split_plan: the extra voxel goes to the right
+        left = abs(n - new) // 2
+        if new <= n:
+            src.append(slice(left, left + new))
+            dst.append(slice(None))
+            offset.append(left)
+        else:
+            src.append(slice(None))
+            dst.append(slice(left, left + n))
+            offset.append(-left)
+        out_shape.append(new)
+    return tuple(src), tuple(dst), np.array(offset, dtype=np.int64), tuple(out_shape)
+
+
+def brain_bbox(paths, margin=0):
+    """
+    Cohort-wide bounding box ``[x0, x1, y0, y1, z0, z1]`` of the positive voxels of all volumes in `paths`.
+
+    All volumes must share one grid (e.g. MNI 182x218x182); `margin` voxels
+    are added on every side, clipped to the grid.
+    """
+    lo = hi = shape = None
+    for path in paths:
+        data = np.asanyarray(nib.load(path).dataobj)
+        if shape is not None and data.shape != shape:
+            raise ValueError(f'{path} has shape {data.shape}, expected {shape}')
+        shape = data.shape
+        pos = data > 0
+        idx = [np.flatnonzero(pos.any(axis=tuple(a for a in range(3) if a != axis))) for axis in range(3)]
+        if any(len(i) == 0 for i in idx):
+            continue
+        cur_lo = np.array([i[0] for i in idx])
+        cur_hi = np.array([i[-1] + 1 for i in idx])
+        lo = cur_lo if lo is None else np.minimum(lo, cur_lo)
+        hi = cur_hi if hi is None else np.maximum(hi, cur_hi)
+    if lo is None:
+        raise ValueError('No positive voxels in any volume')
+    lo = np.maximum(lo - margin, 0)
+    hi = np.minimum(hi + margin, shape)
+    return [int(v) for pair in zip(lo, hi) for v in pair]
+
+
+def geometry_path(output_path):
+    return os.path.splitext(output_path)[0] + '_geometry.npz.zst'
+
+
+def restore_geometry(arr, geometry, fill_value=0):
+    """
+    Place a cropped volume back into its original grid.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        Volume written by `convert_nifti_to_npy_cropped`.
+    geometry : str or mapping
+        The ``_geometry.npz.zst`` file written next to it (or its loaded contents).
+
+    Returns
+    -------
+    full : np.ndarray
+        Array of the original shape (same dtype as `arr`), `fill_value` outside the crop.
+    """
+    if isinstance(geometry, str):
+        with load(geometry) as npz:
+            geometry = {k: npz[k] for k in npz.files}
+    shape = tuple(int(v) for v in geometry['orig_shape'])
+    full = np.full(shape, fill_value, dtype=arr.dtype)
+    src, dst = [], []
+    for o, n, m in zip(geometry['offset'], arr.shape, shape):
+        o = int(o)
+        lo, hi = max(o, 0), min(o + n, m)
+        dst.append(slice(lo, hi))
+        src.append(slice(lo - o, hi - o))
+    full[tuple(dst)] = arr[tuple(src)]
+    return full
+
+
+def convert_nifti_to_npy_cropped(input_path, output_path, bbox=None, target_shape=None, dtype=np.float16,
+                                 quiet=False):
+    """
+    Compact variant of `convert_nifti_to_npy`: float32 processing, cropped float16 output.
+
+    The volume is read as float32, negatives are zeroed and the moments of
+    the positive voxels come from one `moments.Moments` pass (instead of
+    three boolean gathers in float64). Normalization runs in place, then the
+    volume is cropped to `bbox` (or centered to `target_shape`) and stored as
+    `dtype`. ``<output>_geometry.npz.zst`` records the crop offset, original
+    shape and affine for `restore_geometry`; the ``_stats.csv`` is the same as
+    in `convert_nifti_to_npy`, plus an ``Outside`` column.
+
+    Positive voxels outside the crop (a subject not covered by the cohort box)
+    are lost; their number is printed as a warning and recorded as
+    ``outside`` in the geometry file and ``Outside`` in the ``_stats.csv``.
+
+    Returns
+    -------
+    info : dict
+        Output shape, dtype, offset, number of positive voxels outside the crop
+        and the statistics.
+    """
+    if bbox is None and target_shape is None:
+        raise ValueError('Give a bounding box or a target shape to crop to.')
+    img = nib.load(input_path)
+    data = img.get_fdata(dtype=np.float32)
+    np.maximum(data, 0, out=data)  # Set negative values to zero
+
+    moments = Moments().update(data)
+    if moments.count == 0:
+        raise ValueError(f'No positive voxels in {input_path}')
+    src, dst, offset, out_shape = crop_slices(data.shape, bbox=bbox, target_shape=target_shape)
+    # Counted before normalization, which can map a voxel to exactly zero
+    outside = moments.count - int(np.count_nonzero(data[src]))
+    if outside:
+        print(f'Warning: {outside} of {moments.count} positive voxels of {input_path} lie outside the crop '
+              f'{[sl.indices(n)[:2] for sl, n in zip(src, data.shape)]} and are dropped', file=sys.stderr)
+
+    mean, std = moments.mean_std()
+    normalize_nonzero_(data, mean, std)
+
+    out = np.zeros(out_shape, dtype=dtype)
+    out[dst] = data[src]
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    save(output_path, out)
+    savez(geometry_path(output_path), offset=offset, orig_shape=np.array(data.shape), affine=img.affine,
+          outside=np.int64(outside))
+
+    stats_path = os.path.splitext(output_path)[0] + '_stats.csv'
+    with open(stats_path, 'w') as f:
+        f.write(f'eid,Mean,Std,Var,Count,M2,Outside\n')
+        f.write(f'{os.path.basename(output_path)},{mean},{std},{moments.var},{moments.count},{moments.m2},'
+                f'{outside}\n')
+
+    if not quiet:
+        print(f'Saved {out.shape} {out.dtype} (offset {offset.tolist()} in {data.shape}) to: {output_path}')
+    return {'shape': list(out.shape), 'dtype': str(out.dtype), 'offset': offset.tolist(), 'outside': outside,
+            'mean': mean, 'std': std}
 
 
 def convert_nifti_to_npy(input_path, output_path, quiet=False):
@@ -43,6 +203,7 @@ def convert_nifti_to_npy(input_path, output_path, quiet=False):
             data_mean = np.mean(data[positive_mask])
             data_std = np.std(data[positive_mask])
             data_var = np.var(data[positive_mask])
+            data_count = int(np.count_nonzero(positive_mask))
             data[positive_mask] = (data[positive_mask] - data_mean) / data_std
 
         # Ensure the output directory exists
@@ -56,11 +217,12 @@ def convert_nifti_to_npy(input_path, output_path, quiet=False):
             print(f'Successfully saved to: {output_path}')
             print(f'Array shape: {data.shape}')
 
-        # save mean / std / var to csv file
+        # save mean / std / var to csv file (count and M2 let moments.reduce_stats merge subjects)
         stats_path = os.path.splitext(output_path)[0] + '_stats.csv'
         with open(stats_path, 'w') as f:
-            f.write(f'eid,Mean,Std,Var\n')
-            f.write(f'{os.path.basename(output_path)},{data_mean},{data_std},{data_var}\n')
+            f.write(f'eid,Mean,Std,Var,Count,M2\n')
+            f.write(f'{os.path.basename(output_path)},{data_mean},{data_std},{data_var},'
+                    f'{data_count},{data_var * data_count}\n')
 
     except Exception as e:
         print(f'Error: {e}')
@@ -70,14 +232,36 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert .nii.gz MRI files to .npy format.')
 
     # Define arguments
-    parser.add_argument('-i', '--input', required=True, help='Path to the input .nii.gz file')
-    parser.add_argument('-o', '--output', required=True, help='Path to save the output .npy.zst file')
+    parser.add_argument('-i', '--input', help='Path to the input .nii.gz file')
+    parser.add_argument('-o', '--output', help='Path to save the output .npy.zst file')
     parser.add_argument('--quiet', '-q', action='store_true', help='Suppress non-error output')
+    parser.add_argument('--bbox', type=int, nargs=6, default=None, metavar=('X0', 'X1', 'Y0', 'Y1', 'Z0', 'Z1'),
+                        help='Crop to this cohort-wide box (half-open) and store float16 (float32 processing, '
+                             'offsets in <output>_geometry.npz.zst).')
+    parser.add_argument('--target_shape', type=int, nargs=3, default=None, metavar=('X', 'Y', 'Z'),
+                        help='Like --bbox, with a centered crop/pad to this shape.')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'],
+                        help='Stored dtype with --bbox/--target_shape. Default is float16.')
+    parser.add_argument('--bbox_of', type=str, default=None,
+                        help='Print the bounding box of the positive voxels of the NIfTI files listed in this '
+                             'file (one per line) for --bbox, and exit.')
+    parser.add_argument('--margin', type=int, default=2, help='Margin added around --bbox_of. Default is 2.')
 
     args = parser.parse_args()
 
+    if args.bbox_of:
+        with open(args.bbox_of) as f:
+            print(*brain_bbox([line.strip() for line in f if line.strip()], margin=args.margin))
+        raise SystemExit(0)
+    if not args.input or not args.output:
+        parser.error('-i/--input and -o/--output are required unless --bbox_of is given.')
+
     if not args.quiet:
         print(f'Processing input: {args.input}')
         print(f'Output path: {args.output}')
 
-    convert_nifti_to_npy(args.input, args.output, quiet=args.quiet)
+    if args.bbox or args.target_shape:
+        convert_nifti_to_npy_cropped(args.input, args.output, bbox=args.bbox, target_shape=args.target_shape,
+                                     dtype=np.dtype(args.dtype), quiet=args.quiet)
+    else:
+        convert_nifti_to_npy(args.input, args.output, quiet=args.quiet)
@@ -1,42 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import io
 
 import nibabel as nib
 import numpy as np
-import zstandard as zstd
 
-_LEVEL = 8
-_WRITE_CHECKSUM = True
-_WRITE_CONTENT_SIZE = True
-
-_cctx = zstd.ZstdCompressor(level=_LEVEL, write_checksum=_WRITE_CHECKSUM, write_content_size=_WRITE_CONTENT_SIZE)
-_dctx = zstd.ZstdDecompressor()
-
-
-def save(file, arr, allow_pickle=False) -> None:
-    buf = io.BytesIO()
-    np.save(buf, arr, allow_pickle=allow_pickle)
-
-    with open(file, 'wb') as _f:
-        _f.write(_cctx.compress(buf.getvalue()))
-
-
-def savez(file, *args, allow_pickle=False, **kwargs) -> None:
-    buf = io.BytesIO()
-    np.savez(buf, *args, allow_pickle=allow_pickle, **kwargs)
-
-    with open(file, 'wb') as _f:
-        _f.write(_cctx.compress(buf.getvalue()))
-
-
-def load(file, allow_pickle=False, fix_imports=True, encoding='ASCII'):
-    with open(file, 'rb') as _f:
-        data = _f.read()
-
-    buf = io.BytesIO(_dctx.decompress(data))
-    return np.load(buf, allow_pickle=allow_pickle, fix_imports=fix_imports, encoding=encoding)
+from moments import Moments, stats_arrays, zscore_nonzero_f16
+from np_zstd import load, save, save_quantized, savez
 
 
 def split_plan(old, new):
@@ -142,27 +112,20 @@ def global_zscore_nonzero(arr: np.ndarray, mean=None, std=None, eps=1e-8):
 
     If mean/std are provided, use them (so you can apply the same global stats
     to multiple arrays, e.g., pre and post).
+
+    Statistics come from a chunked `moments.Moments` accumulator (no
+    ``ss/n - mean**2`` cancellation); normalization runs in float32 chunk by
+    chunk and only the float16 result is allocated at full size.
     """
     arr = np.asarray(arr)
-    nz = (arr != 0)
 
     if mean is None or std is None:
-        n = int(np.count_nonzero(nz))
-        if n == 0:
+        moments = Moments.of(arr)
+        if moments.count == 0:
             return arr, 0.0, 1.0
+        mean, std = moments.mean_std(eps)
 
-        # Because zeros are excluded by count, sums over the whole array are OK
-        s = arr.sum(dtype=np.float64)
-        ss = np.multiply(arr, arr, dtype=np.float64).sum(dtype=np.float64)
-
-        mean = s / n
-        var = ss / n - mean * mean
-        if var < eps:
-            var = eps
-        std = float(np.sqrt(var))
-
-    out = arr.astype(np.float16)
-    out[nz] = (out[nz] - mean) / std
+    out = zscore_nonzero_f16(arr, mean, std)
     return out, float(mean), float(std)
 
 
@@ -171,8 +134,14 @@ if __name__ == '__main__':
     parser.add_argument('fmri_path', type=str, help='Path to the input fMRI NIfTI file.')
     parser.add_argument('mask_path', type=str, help='Path to the binary mask NIfTI file.')
     parser.add_argument('output_prefix', type=str, help='Prefix for saving the masked fMRI NumPy files.')
+    parser.add_argument('--quantize', '-q', type=str, default=None, choices=['int8', 'int16'],
+                        help='Store the z-scored windows as int8/int16 with per-volume scale (.npz.zst).')
+    parser.add_argument('--clip', '-c', type=float, default=None,
+                        help='Clip at +/- this many standard deviations before quantizing.')
 
     args = parser.parse_args()
+    if args.clip is not None and not args.clip > 0:
+        parser.error('--clip must be positive')
 
     # Load fMRI data
     fmri_data = load(args.fmri_path)
@@ -183,11 +152,22 @@ if __name__ == '__main__':
     masked_fmri_data_pre = masked_fmri_data[..., :40]
     masked_fmri_data_post = masked_fmri_data[..., -40:]
 
-    masked_fmri_data_pre_z, pre_mean, pre_std = global_zscore_nonzero(masked_fmri_data_pre)
-    masked_fmri_data_post_z, post_mean, post_std = global_zscore_nonzero(masked_fmri_data_post)
-
-    save(args.output_prefix + '_pre40_masked_z.npy.zst', masked_fmri_data_pre_z)
-    save(args.output_prefix + '_post40_masked_z.npy.zst', masked_fmri_data_post_z)
+    pre_moments = Moments.of(masked_fmri_data_pre)
+    post_moments = Moments.of(masked_fmri_data_post)
+    masked_fmri_data_pre_z, pre_mean, pre_std = global_zscore_nonzero(masked_fmri_data_pre,
+                                                                      *pre_moments.mean_std())
+    masked_fmri_data_post_z, post_mean, post_std = global_zscore_nonzero(masked_fmri_data_post,
+                                                                         *post_moments.mean_std())
+
+    if args.quantize:
+        bits = int(args.quantize[3:])
+        save_quantized(args.output_prefix + f'_pre40_masked_z_{args.quantize}.npz.zst', masked_fmri_data_pre_z,
+                       bits=bits, clip=args.clip)
+        save_quantized(args.output_prefix + f'_post40_masked_z_{args.quantize}.npz.zst', masked_fmri_data_post_z,
+                       bits=bits, clip=args.clip)
+    else:
+        save(args.output_prefix + '_pre40_masked_z.npy.zst', masked_fmri_data_pre_z)
+        save(args.output_prefix + '_post40_masked_z.npy.zst', masked_fmri_data_post_z)
+    # pre_/post_ mean and std, plus count and M2 for merging with moments.reduce_stats
     savez(args.output_prefix + '_masking_stats.npz.zst',
-          pre_mean=pre_mean, pre_std=pre_std,
-          post_mean=post_mean, post_std=post_std)
+          **stats_arrays(pre_moments, prefix='pre_'), **stats_arrays(post_moments, prefix='post_'))
@@ -1,33 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import io
+import functools
 import os
+import sys
+import tempfile
 
 import nibabel as nib
 import numpy as np
-import zstandard as zstd
 
-_LEVEL = 8
-_WRITE_CHECKSUM = True
-_WRITE_CONTENT_SIZE = True
-_cctx = zstd.ZstdCompressor(level=_LEVEL, write_checksum=_WRITE_CHECKSUM, write_content_size=_WRITE_CONTENT_SIZE)
+import batch_runner
+from moments import Moments, VoxelMoments, normalize_nonzero_, stats_arrays, zscore_nonzero_f16
+from np_zstd import save, save_chunked, save_chunked_blocks, save_masked, save_quantized, savez
 
 
-def save(file, arr, allow_pickle=False) -> None:
-    buf = io.BytesIO()
-    np.save(buf, arr, allow_pickle=allow_pickle)
-
-    with open(file, 'wb') as _f:
-        _f.write(_cctx.compress(buf.getvalue()))
-
-
-def savez(file, *args, allow_pickle=False, **kwargs) -> None:
-    buf = io.BytesIO()
-    np.savez(buf, *args, allow_pickle=allow_pickle, **kwargs)
-
-    with open(file, 'wb') as _f:
-        _f.write(_cctx.compress(buf.getvalue()))
+# Volumes per `img.dataobj` read in the streaming path
+_READ_VOLUMES = 4
 
 
 def split_plan(old, new):
@@ -103,6 +91,28 @@ def pad_crop(img_data: np.ndarray,
     return new_data[..., 0] if marker_3d else new_data
 
 
+def pad_crop_slices(shape, target_xyz):
+    """
+    Index plan of `pad_crop` for a grid of `shape`: ``out[dst] = data[src]``.
+
+    Returns
+    -------
+    src, dst : tuple of slice
+        Per-axis slices into the input grid and into the `target_xyz` grid.
+    """
+    src, dst = [], []
+    for old, new in zip(shape, target_xyz):
+        left, right, mode = split_plan(old, new)
+        src.append(slice(left, old - right) if mode == 'crop' else slice(None))
+        dst.append(slice(left, new - right) if mode == 'pad' else slice(None))
+    return tuple(src), tuple(dst)
+
+
+def load_mask(mask_path: str, target_xyz) -> np.ndarray:
+    """Load a NIfTI mask as a boolean array padded/cropped to `target_xyz`."""
+    return pad_crop(nib.load(mask_path).get_fdata().astype(bool), target_xyz=target_xyz, fill_value=0).astype(bool)
+
+
 def mask_fmri(fmri: np.ndarray, mask_path: str) -> np.ndarray:
     """
     Apply a binary mask to fMRI data.
@@ -120,7 +130,7 @@ def mask_fmri(fmri: np.ndarray, mask_path: str) -> np.ndarray:
         Masked fMRI data array.
     """
     # Load the mask
-    mask_data = pad_crop(nib.load(mask_path).get_fdata().astype(bool), target_xyz=fmri.shape[:3], fill_value=0).astype(bool)
+    mask_data = load_mask(mask_path, fmri.shape[:3])
 
     masked_fmri = fmri * mask_data[..., np.newaxis]
 
@@ -133,82 +143,347 @@ def global_zscore_nonzero(arr: np.ndarray, mean=None, std=None, eps=1e-8):
 
     If mean/std are provided, use them (so you can apply the same global stats
     to multiple arrays, e.g., pre and post).
+
+    Statistics come from a chunked `moments.Moments` accumulator (no
+    ``ss/n - mean**2`` cancellation); normalization runs in float32 chunk by
+    chunk and only the float16 result is allocated at full size.
     """
     arr = np.asarray(arr)
-    nz = (arr != 0)
 
     if mean is None or std is None:
-        n = int(np.count_nonzero(nz))
-        if n == 0:
+        moments = Moments.of(arr)
+        if moments.count == 0:
             return arr, 0.0, 1.0
+        mean, std = moments.mean_std(eps)
 
-        # Because zeros are excluded by count, sums over the whole array are OK
-        s = arr.sum(dtype=np.float64)
-        ss = np.multiply(arr, arr, dtype=np.float64).sum(dtype=np.float64)
+    out = zscore_nonzero_f16(arr, mean, std)
+    return out, float(mean), float(std)
 
-        mean = s / n
-        var = ss / n - mean * mean
-        if var < eps:
-            var = eps
-        std = float(np.sqrt(var))
 
-    out = arr.astype(np.float16)
-    out[nz] = (out[nz] - mean) / std
-    return out, float(mean), float(std)
+def iter_masked_chunks(img, mask: np.ndarray, chunk_size: int = 32):
+    """
+    Yield ``(t0, chunk)``: float32 time-chunks of a 4D image, padded/cropped to the mask grid and masked.
 
+    Pad/crop, masking and the float32 conversion happen in one pass over a
+    chunk read from ``img.dataobj``; only the cropped region is read, a few
+    volumes at a time (nibabel returns scaled data as float64). The yielded
+    array is an F-ordered buffer reused for every chunk (the last one may be
+    shorter), so copy it to keep it.
+    """
+    target_xyz = mask.shape
+    src, dst = pad_crop_slices(img.shape[:3], target_xyz)
+    n_t = img.shape[3]
+    chunk_size = min(chunk_size, n_t) if chunk_size and chunk_size > 0 else n_t
+    buf = np.zeros(tuple(target_xyz) + (chunk_size,), dtype=np.float32, order='F')
+    mask_4d = mask[..., np.newaxis]
+    for t0 in range(0, n_t, chunk_size):
+        t1 = min(t0 + chunk_size, n_t)
+        out = buf[..., :t1 - t0]
+        for r0 in range(t0, t1, _READ_VOLUMES):
+            r1 = min(r0 + _READ_VOLUMES, t1)
+            out[dst + (slice(r0 - t0, r1 - t0),)] = img.dataobj[src + (slice(r0, r1),)]
+        # Padding stays zero: the mask is zero outside the input grid as well
+        np.multiply(out, mask_4d, out=out)
+        yield t0, out
+
+
+def stream_zscore_nonzero(img, mask: np.ndarray, chunk_size: int = 32, eps=1e-8, spill_dir=None, voxel=None):
+    """
+    Two-pass, bounded-memory equivalent of ``global_zscore_nonzero(mask_fmri(pad_crop(data)))``.
 
-if __name__ == '__main__':
-    # Parse command-line arguments
-    parser = argparse.ArgumentParser(
-        description='Pad/Crop NIfTI image data to target size and save as NumPy (.npy or .npy.zst).')
-    parser.add_argument('--type', '-t', type=str, required=True, help='Type of NIfTI file to process (2D or 4D).')
-    parser.add_argument('--input', '-i', type=str, required=True, help='Input NIfTI file path.')
-    parser.add_argument('--output', '-o', type=str, required=True, help='Output file path (.npy or .npy.zst).')
-    parser.add_argument('--target_xyz', '-xyz', type=int, nargs=3, default=(96, 96, 96),
-                        help='Target shape for the first three dimensions. Default is (96, 96, 96).')
-    parser.add_argument('--fill_value', '-fv', type=float, default=0, help='Fill value for padding. Default is 0.')
-    parser.add_argument('--force', '-f', action='store_true', help='Overwrite existing output files.')
-    parser.add_argument('--mask', '-m', type=str, default=None, help='Mask NIfTI file path (only for 4D).')
-    args = parser.parse_args()
+    Pass 1 accumulates `moments.Moments` of the non-zero entries over float32
+    chunks from `iter_masked_chunks`; `mean` and `std` are then
+    known and the generator yields the float16 chunks of pass 2, normalized in
+    place in float32. Peak memory is a few chunks, independent of the run
+    length.
+
+    Pass 2 reads the image again, unless `spill_dir` is given: pass 1 then
+    also writes the masked float32 chunks to an anonymous temporary file in
+    `spill_dir`, and pass 2 reads them back unchanged. For .nii.gz input this
+    trades a second gzip decompression for sequential disk I/O (4 bytes per
+    masked-grid entry of temporary disk space).
+
+    A `moments.VoxelMoments` passed as `voxel` is updated with every chunk of
+    pass 1 (per-voxel statistics over time).
 
-    img_type = args.type
+    Returns
+    -------
+    moments : moments.Moments
+        Global statistics of the non-zero entries (normalization uses
+        ``moments.mean_std(eps)``).
+    chunks : generator
+        ``(t0, chunk)`` float16 F-ordered chunks of the normalized array (the
+        buffer is reused, consume each chunk before advancing).
+    """
+    spill = tempfile.TemporaryFile(dir=spill_dir) if spill_dir is not None else None
+    moments = Moments()
+    scratch = None
+    for _, chunk in iter_masked_chunks(img, mask, chunk_size):
+        if scratch is None:
+            scratch = np.empty_like(chunk, order='F')
+        moments.update(chunk, out=scratch[..., :chunk.shape[3]])
+        if voxel is not None:
+            voxel.update(chunk)
+        if spill is not None:
+            # F-contiguous chunk: the flat view is the file layout, no copy
+            spill.write(chunk.reshape(-1, order='F').view(np.uint8))
+    buf_shape = None if scratch is None else scratch.shape
+    del scratch
+
+    mean, std = moments.mean_std(eps)
+
+    def spilled_chunks():
+        with spill:
+            spill.seek(0)
+            buf = np.empty(buf_shape, dtype=np.float32, order='F')
+            for t0 in range(0, img.shape[3], buf_shape[3]):
+                chunk = buf[..., :min(buf_shape[3], img.shape[3] - t0)]
+                spill.readinto(chunk.reshape(-1, order='F').view(np.uint8))
+                yield t0, chunk
+
+    def normalized():
+        nz = out = None
+        chunks = spilled_chunks() if spill is not None else iter_masked_chunks(img, mask, chunk_size)
+        for t0, chunk in chunks:
+            if nz is None:
+                nz = np.empty(chunk.shape, dtype=bool, order='F')
+                out = np.empty(chunk.shape, dtype=np.float16, order='F')
+            t = chunk.shape[3]
+            out_t = out[..., :t]
+            out_t[...] = normalize_nonzero_(chunk, mean, std, nz=nz[..., :t])
+            yield t0, out_t
+
+    return moments, normalized()
+
+
+def save_meanstd(output_path: str, moments: Moments, voxel=None) -> None:
+    """
+    Write the global mean/std next to `output_path` (``<base>_meanstd.npz[.zst]``).
+
+    The file also holds the count and M2 of the non-zero entries (and the
+    optional per-voxel maps of `voxel`), so `moments.reduce_stats` can merge
+    the files of a cohort.
+    """
+    arrays = stats_arrays(moments, voxel)
+    if output_path.endswith('.npz.zst'):
+        savez(output_path.replace('.npz.zst', '_meanstd.npz.zst'), **arrays)
+    elif output_path.endswith('.npy.zst'):
+        savez(output_path.replace('.npy.zst', '_meanstd.npz.zst'), **arrays)
+    else:
+        np.savez(output_path.replace('.npy', '_meanstd.npz'), **arrays)
+
+
+def process_file_streaming(input_path: str, output_path: str, mask_path: str, target_xyz=(96, 96, 96),
+                           chunk_size: int = 32, spill=None, voxel_stats: bool = False, quiet: bool = False) -> dict:
+    """
+    Streaming 4D path of `process_file`: float16 .npy/.npy.zst output in bounded memory.
+
+    The fMRI is read twice in time-chunks of `chunk_size` (statistics, then
+    normalization). Each normalized float16 chunk is compressed as one tile of
+    a chunked .npy.zst (`save_chunked_blocks`, the layout of
+    ``--t_chunk chunk_size``) or written into a memory-mapped .npy. Both
+    paths accumulate the statistics over, and normalize, the same float32
+    chunks, so the loaded array equals the in-memory path's.
+
+    `spill` (default: for .gz input) makes pass 2 read the float32 chunks spilled
+    next to the output instead of decompressing the input again, see
+    `stream_zscore_nonzero`.
+    """
+    img = nib.load(input_path, keep_file_open=True)
+    if len(img.shape) != 4:
+        raise ValueError(f'Expect a 4D image (X, Y, Z, T), got shape {img.shape}')
+    mask = load_mask(mask_path, target_xyz)
+    if spill is None:
+        spill = input_path.endswith('.gz')
+    spill_dir = os.path.dirname(os.path.abspath(output_path)) if spill else None
+    voxel = VoxelMoments() if voxel_stats else None
+    moments, chunks = stream_zscore_nonzero(img, mask, chunk_size=chunk_size, spill_dir=spill_dir, voxel=voxel)
+    save_meanstd(output_path, moments, voxel)
+    mean, std = moments.mean_std()
+
+    shape = tuple(target_xyz) + (img.shape[3],)
+    if output_path.endswith('.npy'):
+        out = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float16, shape=shape)
+        for t0, chunk in chunks:
+            out[..., t0:t0 + chunk.shape[3]] = chunk
+        out.flush()
+        del out
+    else:
+        save_chunked_blocks(output_path, (chunk for _, chunk in chunks), shape, np.float16)
+
+    if not quiet:
+        print(f'Data shape after processing: {shape}, size: {np.prod(shape) * 2 / (1024 ** 2):.2f} MiB')
+    return {'mean': mean, 'std': std, 'shape': list(shape), 'dtype': 'float16'}
+
+
+def process_file(input_path: str, output_path: str, img_type: str = '4D', mask_path=None,
+                 target_xyz=(96, 96, 96), fill_value: float = 0, force: bool = False, layout: str = 'dense',
+                 quantize=None, clip=None, t_chunk=None, z_chunk=None, stream_chunk=None,
+                 voxel_stats: bool = False, quiet: bool = False) -> dict:
+    """
+    Convert one NIfTI file to .npy/.npy.zst (the single-file CLI and each batch job).
+
+    With `stream_chunk`, masked 4D input goes through `process_file_streaming`
+    in time-chunks of that many volumes (`t_chunk` if given) instead of being
+    loaded whole; .npy.zst output is then always chunked. `voxel_stats` adds
+    per-voxel maps over time to the ``_meanstd`` file.
+
+    Returns
+    -------
+    info : dict
+        Output shape, dtype and (for masked 4D input) the global mean/std.
+    """
     if img_type not in ['2D', '4D']:
         raise ValueError(f'Type {img_type} is not supported.')
 
-    input_path = args.input
-    output_path = args.output  # output file path
-    xyz = args.target_xyz
-    fv = args.fill_value
-
     # Handle a single file only
     if not os.path.isfile(input_path):
         raise ValueError(f'Input path {input_path} is not a valid file.')
 
-    if os.path.exists(output_path) and not args.force:
+    if os.path.exists(output_path) and not force:
         raise ValueError(f'Output file {output_path} already exists.')
 
-    if not (output_path.endswith('.npy') or output_path.endswith('.npy.zst')):
+    if layout == 'masked' and quantize:
+        raise ValueError('Masked layout and quantization cannot be combined.')
+    if layout == 'masked' or quantize:
+        if img_type != '4D' or not output_path.endswith('.npz.zst'):
+            raise ValueError('Masked/quantized output needs 4D input and an output file with .npz.zst extension.')
+    elif not (output_path.endswith('.npy') or output_path.endswith('.npy.zst')):
         raise ValueError(f'Output file {output_path} must have .npy or .npy.zst extension.')
 
+    if stream_chunk:
+        if img_type != '4D' or mask_path is None:
+            raise ValueError('Streaming needs 4D input and a mask file.')
+        if layout != 'dense' or quantize or z_chunk:
+            raise ValueError('Streaming writes dense .npy/.npy.zst output only (no masked layout, '
+                             'quantization or Z chunks).')
+        return process_file_streaming(input_path, output_path, mask_path, target_xyz=target_xyz,
+                                      chunk_size=t_chunk or stream_chunk, voxel_stats=voxel_stats, quiet=quiet)
+
+    info = {}
     if img_type == '2D':
         data = nib.load(input_path).get_fdata()
     else:
-        data = pad_crop(nib.load(input_path).get_fdata(), target_xyz=xyz, fill_value=fv)
-        if args.mask is not None:
-            data = mask_fmri(data, args.mask)
-            data, data_mean, data_std = global_zscore_nonzero(data)
-            if output_path.endswith('.npy.zst'):
-                savez(output_path.replace('.npy.zst', '_meanstd.npz.zst'), mean=data_mean, std=data_std)
-            else:
-                np.savez(output_path.replace('.npy', '_meanstd.npz'), mean=data_mean, std=data_std)
+        data = pad_crop(nib.load(input_path).get_fdata(), target_xyz=target_xyz, fill_value=fill_value)
+        if mask_path is not None:
+            data = mask_fmri(data, mask_path)
+            # float32 chunks, as in the streaming path: both normalize with the same statistics
+            moments = Moments.of(data, chunk_size=t_chunk or stream_chunk or 32, dtype=np.float32)
+            voxel = VoxelMoments.of(data) if voxel_stats else None
+            data, data_mean, data_std = global_zscore_nonzero(data, *moments.mean_std())
+            info.update(mean=data_mean, std=data_std)
+            save_meanstd(output_path, moments, voxel)
         else:
             raise ValueError('Mask file must be provided for 4D data processing.')
 
     data = data.astype(np.float16)
 
-    print(f'Data shape after processing: {data.shape}, size: {data.nbytes / (1024 ** 2):.2f} MiB')
+    if not quiet:
+        print(f'Data shape after processing: {data.shape}, size: {data.nbytes / (1024 ** 2):.2f} MiB')
 
-    if output_path.endswith('.npy'):
+    if layout == 'masked':
+        save_masked(output_path, data, load_mask(mask_path, data.shape[:3]))
+    elif quantize:
+        save_quantized(output_path, data, bits=int(quantize[3:]), clip=clip)
+    elif output_path.endswith('.npy'):
         np.save(output_path, data, allow_pickle=False)
+    elif img_type == '4D' and (t_chunk or z_chunk):
+        save_chunked(output_path, data, t_chunk=t_chunk, z_chunk=z_chunk)
     else:
         save(output_path, data, allow_pickle=False)
+
+    info.update(shape=list(data.shape), dtype=str(data.dtype))
+    return info
+
+
+def read_manifest(lines):
+    """
+    Parse batch jobs, one ``input mask output`` per line (whitespace, tab or comma separated).
+
+    Use ``-`` as the mask for jobs without one; blank lines and lines starting
+    with ``#`` are skipped.
+    """
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.replace(',', ' ').split()
+        if len(fields) != 3:
+            raise ValueError(f'Expect "input mask output" per manifest line, got: {line}')
+        input_path, mask_path, output_path = fields
+        jobs.append((input_path, None if mask_path == '-' else mask_path, output_path))
+    return jobs
+
+
+def _run_job(job, options):
+    input_path, mask_path, output_path = job
+    status = {'input': input_path, 'mask': mask_path, 'output': output_path}
+    return batch_runner.run_job(status, process_file, input_path, output_path, mask_path=mask_path, quiet=True,
+                                **options)
+
+
+def run_batch(jobs, options: dict, workers: int = 1, status_file=None) -> int:
+    """
+    Run jobs in this interpreter (or a process pool) and print one JSON status line per job.
+
+    Returns the number of failed jobs.
+    """
+    return batch_runner.run_batch(functools.partial(_run_job, options=options), jobs, workers=workers,
+                                  status_file=status_file)
+
+
+if __name__ == '__main__':
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(
+        description='Pad/Crop NIfTI image data to target size and save as NumPy (.npy or .npy.zst).')
+    parser.add_argument('--type', '-t', type=str, default='4D', help='Type of NIfTI file to process (2D or 4D).')
+    parser.add_argument('--input', '-i', type=str, default=None, help='Input NIfTI file path.')
+    parser.add_argument('--output', '-o', type=str, default=None, help='Output file path (.npy or .npy.zst).')
+    parser.add_argument('--batch', '-b', type=str, default=None,
+                        help='Manifest of "input mask output" jobs (one per line, "-" for stdin); '
+                             'prints one JSON status line per job.')
+    parser.add_argument('--workers', '-w', type=int, default=1, help='Worker processes for --batch. Default is 1.')
+    parser.add_argument('--status_file', type=str, default=None,
+                        help='Append --batch status lines to this file instead of stdout.')
+    parser.add_argument('--target_xyz', '-xyz', type=int, nargs=3, default=(96, 96, 96),
+                        help='Target shape for the first three dimensions. Default is (96, 96, 96).')
+    parser.add_argument('--fill_value', '-fv', type=float, default=0, help='Fill value for padding. Default is 0.')
+    parser.add_argument('--force', '-f', action='store_true', help='Overwrite existing output files.')
+    parser.add_argument('--mask', '-m', type=str, default=None, help='Mask NIfTI file path (only for 4D).')
+    parser.add_argument('--layout', '-l', type=str, default='dense', choices=['dense', 'masked'],
+                        help='Storage layout for 4D output: dense cube, or in-mask voxels + packed mask '
+                             '(requires --mask and a .npz.zst output). Default is dense.')
+    parser.add_argument('--quantize', '-q', type=str, default=None, choices=['int8', 'int16'],
+                        help='Store as int8/int16 with per-volume scale (requires a .npz.zst output).')
+    parser.add_argument('--clip', '-c', type=float, default=None,
+                        help='Clip at +/- this many standard deviations before quantizing.')
+    parser.add_argument('--t_chunk', '-tc', type=int, default=None,
+                        help='Write a chunked .npy.zst with this many timepoints per frame (only for 4D).')
+    parser.add_argument('--z_chunk', '-zc', type=int, default=None,
+                        help='Write a chunked .npy.zst with this many Z slices per frame (only for 4D).')
+    parser.add_argument('--stream', '-s', type=int, nargs='?', const=32, default=None, metavar='T',
+                        help='Process masked 4D input in time-chunks of T volumes (default 32, or --t_chunk) '
+                             'with bounded memory; .npy.zst output is written chunked, one tile per chunk.')
+    parser.add_argument('--voxel_stats', action='store_true',
+                        help='Also store per-voxel mean/M2 maps over time in the _meanstd file (for cohort maps).')
+    args = parser.parse_args()
+    if args.clip is not None and not args.clip > 0:
+        parser.error('--clip must be positive')
+
+    options = dict(img_type=args.type, target_xyz=tuple(args.target_xyz), fill_value=args.fill_value,
+                   force=args.force, layout=args.layout, quantize=args.quantize, clip=args.clip,
+                   t_chunk=args.t_chunk, z_chunk=args.z_chunk, stream_chunk=args.stream,
+                   voxel_stats=args.voxel_stats)
+
+    if args.batch is not None:
+        if args.batch == '-':
+            batch_jobs = read_manifest(sys.stdin)
+        else:
+            with open(args.batch) as f:
+                batch_jobs = read_manifest(f)
+        sys.exit(1 if run_batch(batch_jobs, options, workers=args.workers, status_file=args.status_file) else 0)
+
+    if args.input is None or args.output is None:
+        parser.error('--input and --output are required unless --batch is given.')
+    process_file(args.input, args.output, mask_path=args.mask, **options)
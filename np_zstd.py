@@ -1,41 +1,679 @@
 # -*- coding: utf-8 -*-
 
+import glob
 import io
+import json
+import mmap
+import os
+import pickle
+import struct
+import threading
 
 import numpy as np
 import zstandard as zstd
 
-_LEVEL = 8
+# Codec defaults; each can be overridden per process through the NP_ZSTD_*
+# environment variables or at runtime with `configure`.
+_LEVEL = int(os.environ.get('NP_ZSTD_LEVEL', 8))
+_THREADS = int(os.environ.get('NP_ZSTD_THREADS', 0))  # -1: one worker per logical CPU
+_LONG_DISTANCE = os.environ.get('NP_ZSTD_LONG', '0') not in ('', '0')
+_WINDOW_LOG = int(os.environ.get('NP_ZSTD_WINDOW_LOG', 0))  # 0: derived from the level
 _WRITE_CHECKSUM = True
 _WRITE_CONTENT_SIZE = True
+_MAX_WINDOW_SIZE = 1 << 31  # lets the decoder read frames written with --long windows
 
-_cctx = zstd.ZstdCompressor(level=_LEVEL, write_checksum=_WRITE_CHECKSUM, write_content_size=_WRITE_CONTENT_SIZE)
-_dctx = zstd.ZstdDecompressor()
+
+def make_compressor(level=_LEVEL, threads=_THREADS, long_distance=_LONG_DISTANCE, window_log=_WINDOW_LOG,
+                    dict_data=None):
+    """
+    Build a ZstdCompressor with the settings used for every .npy.zst file.
+
+    Parameters
+    ----------
+    level : int
+        Compression level.
+    threads : int
+        Number of compression worker threads; 0 compresses on the calling
+        thread, -1 uses one worker per logical CPU.
+    long_distance : bool
+        Enable long-distance matching.
+    window_log : int
+        Log2 of the match window size; 0 keeps the level's default.
+    dict_data : zstd.ZstdCompressionDict or None
+        Optional trained dictionary (its ID is written into every frame).
+    """
+    params = zstd.ZstdCompressionParameters.from_level(
+        level,
+        threads=threads,
+        enable_ldm=bool(long_distance),
+        window_log=window_log,
+        write_checksum=_WRITE_CHECKSUM,
+        write_content_size=_WRITE_CONTENT_SIZE,
+        write_dict_id=True,
+    )
+    return zstd.ZstdCompressor(compression_params=params, dict_data=dict_data)
+
+
+def configure(level=None, threads=None, long_distance=None, window_log=None) -> None:
+    """Change the module-wide compression settings (None keeps the current value)."""
+    global _LEVEL, _THREADS, _LONG_DISTANCE, _WINDOW_LOG, _cctx, _cdict_cctx
+
+    _LEVEL = _LEVEL if level is None else int(level)
+    _THREADS = _THREADS if threads is None else int(threads)
+    _LONG_DISTANCE = _LONG_DISTANCE if long_distance is None else bool(long_distance)
+    _WINDOW_LOG = _WINDOW_LOG if window_log is None else int(window_log)
+    _cctx = make_compressor(_LEVEL, _THREADS, _LONG_DISTANCE, _WINDOW_LOG)
+    if _cdict is not None:
+        _cdict_cctx = make_compressor(_LEVEL, _THREADS, _LONG_DISTANCE, _WINDOW_LOG, dict_data=_cdict)
+
+
+def make_decompressor(dict_data=None):
+    """Build a ZstdDecompressor able to read every frame `make_compressor` can produce."""
+    return zstd.ZstdDecompressor(dict_data=dict_data, max_window_size=_MAX_WINDOW_SIZE)
+
+
+_cctx = make_compressor()
+# ZstdDecompressor objects must not be shared between threads, so readers keep
+# one per thread (and per dictionary ID), see `_thread_decompressor`.
+_tls = threading.local()
+
+
+# ---------------------------------------------------------------------------
+# Trained dictionaries for the many small per-subject artifacts (stats .npz,
+# ROI .npy, CSV). Frames record the dictionary ID, and loads look the ID up in
+# the registry (filled by `register_dictionary`/`use_dictionary`, or lazily
+# from *.zdict files in NP_ZSTD_DICT_DIR).
+# ---------------------------------------------------------------------------
+
+_DICT_SIZE = 112640  # zstd CLI default
+_DICT_MAX_BYTES = 1 << 20  # payloads above this are written without the dictionary
+_DICT_DIR = os.environ.get('NP_ZSTD_DICT_DIR')
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_FRAME_HEADER_MAX = 18
+
+_dicts = {}
+_cdict = None
+_cdict_cctx = None
+
+
+def _as_dict(d):
+    if isinstance(d, zstd.ZstdCompressionDict):
+        return d
+    if isinstance(d, (bytes, bytearray, memoryview)):
+        return zstd.ZstdCompressionDict(bytes(d))
+    with open(d, 'rb') as _f:
+        return zstd.ZstdCompressionDict(_f.read())
+
+
+def register_dictionary(d):
+    """Make a dictionary (object, raw bytes or file path) available to `load`; returns it."""
+    d = _as_dict(d)
+    _dicts[d.dict_id()] = d
+    return d
+
+
+def use_dictionary(d) -> None:
+    """Compress small payloads with dictionary `d` from now on (None turns it off)."""
+    global _cdict, _cdict_cctx
+
+    if d is None:
+        _cdict = _cdict_cctx = None
+        return
+    _cdict = register_dictionary(d)
+    _cdict_cctx = make_compressor(_LEVEL, _THREADS, _LONG_DISTANCE, _WINDOW_LOG, dict_data=_cdict)
+
+
+def save_dictionary(file, d) -> None:
+    with open(file, 'wb') as _f:
+        _f.write(_as_dict(d).as_bytes())
+
+
+def _compressor_for(nbytes: int):
+    if _cdict_cctx is not None and nbytes <= _DICT_MAX_BYTES:
+        return _cdict_cctx
+    return _cctx
+
+
+def _thread_decompressor(dict_id=0):
+    cache = getattr(_tls, 'dctx', None)
+    if cache is None:
+        cache = _tls.dctx = {}
+    dctx = cache.get(dict_id)
+    if dctx is None:
+        dctx = cache[dict_id] = make_decompressor(_dicts[dict_id] if dict_id else None)
+    return dctx
+
+
+def _decompressor_for(frame_head: bytes):
+    dict_id = zstd.get_frame_parameters(frame_head).dict_id
+    if dict_id and dict_id not in _dicts and _DICT_DIR:
+        for path in glob.glob(os.path.join(_DICT_DIR, '*.zdict')):
+            register_dictionary(path)
+    if dict_id and dict_id not in _dicts:
+        raise ValueError(f'Frame needs zstd dictionary {dict_id}; register it with np_zstd.register_dictionary '
+                         f'or put it in NP_ZSTD_DICT_DIR')
+    return _thread_decompressor(dict_id)
+
+
+def save_bytes(file, data) -> None:
+    """Compress raw bytes (e.g. a small CSV) to `file`."""
+    with open(file, 'wb') as _f:
+        _f.write(_compressor_for(len(data)).compress(data))
+
+
+def load_bytes(file) -> bytes:
+    """Return the raw contents of `file`, decompressing it if it is a zstd file."""
+    with open(file, 'rb') as _f:
+        data = _f.read()
+    if not data.startswith(_ZSTD_MAGIC):
+        return data
+    return _decompressor_for(data[:_FRAME_HEADER_MAX]).decompress(data)
+
+
+def train_dictionary(files, dict_size=_DICT_SIZE):
+    """
+    Train a zstd dictionary on a sample of small files.
+
+    Parameters
+    ----------
+    files : iterable of str
+        Sample files; .zst files are decompressed first, anything else is used as is.
+    dict_size : int
+        Target dictionary size in bytes.
+
+    Returns
+    -------
+    d : zstd.ZstdCompressionDict
+    """
+    samples = [load_bytes(f) for f in files]
+    if not samples:
+        raise ValueError('No sample files given for dictionary training.')
+    return zstd.train_dictionary(dict_size, samples, level=_LEVEL)
+
+
+if os.environ.get('NP_ZSTD_DICT'):
+    use_dictionary(os.environ['NP_ZSTD_DICT'])
+
+
+_NPY_MAGIC = np.lib.format.MAGIC_PREFIX
+_NPY_MAGIC_LEN = np.lib.format.MAGIC_LEN
+
+
+def _byte_view(arr: np.ndarray) -> np.ndarray:
+    """Flat uint8 view over the memory of a C- or F-contiguous array (no copy)."""
+    return arr.reshape(-1, order='A').view(np.uint8)
+
+
+def _npy_header(arr: np.ndarray) -> bytes:
+    hdr = io.BytesIO()
+    d = np.lib.format.header_data_from_array_1_0(arr)
+    try:
+        np.lib.format.write_array_header_1_0(hdr, d)
+    except ValueError:
+        # Header does not fit the 1.0 length field (very large structured dtypes)
+        hdr = io.BytesIO()
+        np.lib.format.write_array_header_2_0(hdr, d)
+    return hdr.getvalue()
 
 
 def save(file, arr, allow_pickle=False) -> None:
-    buf = io.BytesIO()
-    np.save(buf, arr, allow_pickle=allow_pickle)
+    """
+    Save an array as a zstd-compressed .npy stream.
+
+    The .npy header and the raw array bytes are written straight into the
+    compressor, so no serialized copy of the array is kept in memory (strided
+    arrays are made contiguous first). Every frame records its content size,
+    so one-shot decoders such as `load_bytes` can read it.
+    """
+    arr = np.asanyarray(arr)
 
+    if arr.dtype.hasobject:
+        # Pickled arrays: the serialized size is only known after pickling
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, arr, allow_pickle=allow_pickle)
+        save_bytes(file, buf.getbuffer())
+        return
+    if not (arr.flags.c_contiguous or arr.flags.f_contiguous):
+        arr = np.ascontiguousarray(arr)
+
+    cctx = _compressor_for(arr.nbytes)
+    header = _npy_header(arr)
     with open(file, 'wb') as _f:
-        _f.write(_cctx.compress(buf.getvalue()))
+        with cctx.stream_writer(_f, size=len(header) + arr.nbytes, closefd=False) as writer:
+            writer.write(header)
+            writer.write(_byte_view(arr))
 
 
 def savez(file, *args, allow_pickle=False, **kwargs) -> None:
     buf = io.BytesIO()
     np.savez(buf, *args, allow_pickle=allow_pickle, **kwargs)
-
-    with open(file, 'wb') as _f:
-        _f.write(_cctx.compress(buf.getvalue()))
+    save_bytes(file, buf.getbuffer())
 
 
 def savez_compressed(file, *args, allow_pickle=False, **kwargs) -> None:
     savez(file, *args, allow_pickle=allow_pickle, **kwargs)
 
 
+def _read_npy_header(reader, magic: bytes):
+    major, minor = magic[-2], magic[-1]
+    if (major, minor) == (1, 0):
+        return np.lib.format.read_array_header_1_0(reader)
+    if (major, minor) == (2, 0):
+        return np.lib.format.read_array_header_2_0(reader)
+    return None
+
+
+def _readinto_exact(reader, buf: np.ndarray) -> None:
+    view = memoryview(buf)
+    pos, n = 0, buf.nbytes
+    while pos < n:
+        k = reader.readinto(view[pos:])
+        if not k:
+            raise ValueError(f'Truncated .npy.zst stream: expected {n} data bytes, got {pos}')
+        pos += k
+
+
+def _load_stream(source, frame_head: bytes, allow_pickle, fix_imports, encoding):
+    """Decode one .npy/.npz zstd payload from a file object or buffer."""
+    dctx = _decompressor_for(frame_head)
+    with dctx.stream_reader(source, closefd=False) as reader:
+        magic = reader.read(_NPY_MAGIC_LEN)
+
+        header = None
+        if magic.startswith(_NPY_MAGIC) and len(magic) == _NPY_MAGIC_LEN:
+            header = _read_npy_header(reader, magic)
+
+        if header is None:
+            buf = io.BytesIO(magic + reader.readall())
+            return np.load(buf, allow_pickle=allow_pickle, fix_imports=fix_imports, encoding=encoding)
+
+        shape, fortran_order, dtype = header
+        if dtype.hasobject:
+            if not allow_pickle:
+                raise ValueError('Object arrays cannot be loaded when allow_pickle=False')
+            return pickle.load(reader, fix_imports=fix_imports, encoding=encoding)
+
+        arr = np.empty(shape, dtype=dtype, order='F' if fortran_order else 'C')
+        _readinto_exact(reader, _byte_view(arr))
+        return arr
+
+
 def load(file, allow_pickle=False, fix_imports=True, encoding='ASCII'):
+    """
+    Load an array (or .npz archive) from a zstd-compressed file.
+
+    Plain .npy payloads are decompressed straight into a preallocated array of
+    the stored dtype/shape, and chunked files (see `save_chunked`) are read in
+    full through `load_slice`; anything else (.npz, pickled objects) falls back to
+    `np.load` on the decompressed bytes.
+    """
+    if is_chunked(file):
+        return load_slice(file)
+
     with open(file, 'rb') as _f:
-        data = _f.read()
+        head = _f.read(_FRAME_HEADER_MAX)
+        _f.seek(0)
+        return _load_stream(_f, head, allow_pickle, fix_imports, encoding)
+
+
+def loads(data, allow_pickle=False, fix_imports=True, encoding='ASCII'):
+    """Like `load`, for the compressed contents of a file already in memory (bytes, mmap slice...)."""
+    data = memoryview(data)
+    index = _read_chunk_index(data)
+    if index is not None:
+        return _slice_buffer(data, index, slice(None), slice(None))
+    return _load_stream(data, bytes(data[:_FRAME_HEADER_MAX]), allow_pickle, fix_imports, encoding)
+
+
+# ---------------------------------------------------------------------------
+# Chunked container: one zstd frame per (Z-slab, time-chunk) tile of a 4D
+# (X, Y, Z, T) array, followed by a zstd skippable frame holding a JSON index.
+# The file stays a valid zstd stream; the last 8 bytes of the file are
+# <uint32 index length><_CHUNK_MAGIC> so readers can find the index directly.
+# ---------------------------------------------------------------------------
+
+_CHUNK_MAGIC = b'NZCK'
+_CHUNK_VERSION = 1
+_SKIPPABLE_FRAME_MAGIC = 0x184D2A5A
+_CHUNK_TRAILER = struct.Struct('<I4s')
+
+
+def save_chunked(file, arr, t_chunk=8, z_chunk=None) -> None:
+    """
+    Save a 4D array as independently compressed (Z-slab, time-chunk) tiles.
+
+    Parameters
+    ----------
+    file : str
+        Output path (conventionally .npy.zst).
+    arr : np.ndarray
+        4D array with shape (X, Y, Z, T).
+    t_chunk : int or None
+        Number of timepoints per tile. None keeps the full time axis in each tile.
+    z_chunk : int or None
+        Number of Z slices per tile. None keeps the full Z axis in each tile.
+    """
+    arr = np.asarray(arr)
+    if arr.ndim != 4:
+        raise ValueError(f'Expect 4D array (X, Y, Z, T), got shape {arr.shape}')
+    if arr.dtype.hasobject:
+        raise ValueError('Object arrays cannot be saved in the chunked format')
+
+    _, _, n_z, n_t = arr.shape
+    z_chunk = n_z if not z_chunk else int(z_chunk)
+    t_chunk = n_t if not t_chunk else int(t_chunk)
+
+    def tiles():
+        for z0 in range(0, max(n_z, 1), z_chunk):
+            z1 = min(z0 + z_chunk, n_z)
+            for t0 in range(0, max(n_t, 1), t_chunk):
+                t1 = min(t0 + t_chunk, n_t)
+                yield z0, z1, t0, t1, arr[:, :, z0:z1, t0:t1]
+
+    _write_chunked(file, tiles(), arr.shape, arr.dtype, [z_chunk, t_chunk])
+
+
+def save_chunked_blocks(file, blocks, shape, dtype) -> None:
+    """
+    Save a 4D array that arrives as consecutive time-chunks in the chunked format.
+
+    Each block becomes one (full-Z, time-chunk) tile, compressed as soon as it
+    arrives, so the full array is never held in memory. The file is the same
+    as ``save_chunked(file, arr, t_chunk=<block length>)``.
+
+    Parameters
+    ----------
+    file : str
+        Output path (conventionally .npy.zst).
+    blocks : iterable of np.ndarray
+        Blocks ``arr[..., t0:t1]`` in time order, each of shape (X, Y, Z, t).
+    shape : tuple of int
+        Shape (X, Y, Z, T) of the full array.
+    dtype : np.dtype
+        Stored dtype (blocks are converted if needed).
+    """
+    shape = tuple(int(s) for s in shape)
+    if len(shape) != 4:
+        raise ValueError(f'Expect 4D shape (X, Y, Z, T), got {shape}')
+    chunks = [shape[2], None]
+
+    def tiles():
+        t0 = 0
+        for block in blocks:
+            if block.shape[:3] != shape[:3]:
+                raise ValueError(f'Block shape {block.shape} does not match array shape {shape}')
+            t1 = t0 + block.shape[3]
+            if chunks[1] is None:
+                chunks[1] = block.shape[3]
+            yield 0, shape[2], t0, t1, block
+            t0 = t1
+        if t0 != shape[3]:
+            raise ValueError(f'Blocks hold {t0} timepoints, expected {shape[3]}')
+
+    _write_chunked(file, tiles(), shape, dtype, chunks)
+
+
+def _write_chunked(file, tiles, shape, dtype, chunks) -> None:
+    """Compress ``(z0, z1, t0, t1, tile)`` tiles one frame each and append the index."""
+    dtype = np.dtype(dtype)
+    if dtype.hasobject:
+        raise ValueError('Object arrays cannot be saved in the chunked format')
+
+    frames = []
+    with open(file, 'wb') as _f:
+        offset = 0
+        for z0, z1, t0, t1, tile in tiles:
+            tile = np.ascontiguousarray(tile, dtype=dtype)
+            frame = _cctx.compress(_byte_view(tile))
+            _f.write(frame)
+            frames.append([z0, z1, t0, t1, offset, len(frame)])
+            offset += len(frame)
+
+        index = json.dumps({
+            'version': _CHUNK_VERSION,
+            'dtype': dtype.str,
+            'shape': list(shape),
+            'chunks': chunks,
+            'frames': frames,
+        }, separators=(',', ':')).encode('utf-8')
+        payload = index + _CHUNK_TRAILER.pack(len(index), _CHUNK_MAGIC)
+        _f.write(struct.pack('<II', _SKIPPABLE_FRAME_MAGIC, len(payload)))
+        _f.write(payload)
+
+
+def _read_chunk_index(buf):
+    """Parse the footer index from a buffer (bytes or mmap) holding a chunked file."""
+    if len(buf) < _CHUNK_TRAILER.size:
+        return None
+    index_len, magic = _CHUNK_TRAILER.unpack(buf[-_CHUNK_TRAILER.size:])
+    if magic != _CHUNK_MAGIC:
+        return None
+    start = len(buf) - _CHUNK_TRAILER.size - index_len
+    index = json.loads(bytes(buf[start:start + index_len]).decode('utf-8'))
+    if index.get('version') != _CHUNK_VERSION:
+        raise ValueError(f'Unsupported chunked .npy.zst version {index.get("version")}')
+    return index
+
+
+def is_chunked(file) -> bool:
+    """Return True if `file` was written by `save_chunked`."""
+    with open(file, 'rb') as _f:
+        _f.seek(0, os.SEEK_END)
+        if _f.tell() < _CHUNK_TRAILER.size:
+            return False
+        _f.seek(-_CHUNK_TRAILER.size, os.SEEK_END)
+        return _CHUNK_TRAILER.unpack(_f.read(_CHUNK_TRAILER.size))[1] == _CHUNK_MAGIC
+
+
+def _as_range(sl, n):
+    if sl is None:
+        sl = slice(None)
+    if isinstance(sl, (int, np.integer)):
+        i = int(sl) + n if sl < 0 else int(sl)
+        if not 0 <= i < n:
+            raise IndexError(f'Index {sl} out of range for axis of size {n}')
+        return i, i + 1, 1
+    start, stop, step = sl.indices(n)
+    if step < 1:
+        raise ValueError('load_slice only supports positive slice steps')
+    return start, max(start, stop), step
+
+
+def load_slice(file, t=slice(None), z=slice(None)):
+    """
+    Read part of a chunked 4D file, decompressing only the tiles it touches.
+
+    Parameters
+    ----------
+    file : str
+        Path written by `save_chunked`.
+    t : slice or int
+        Selection along the time axis.
+    z : slice or int
+        Selection along the Z axis.
+
+    Returns
+    -------
+    arr : np.ndarray
+        Array with shape (X, Y, len(z), len(t)). Integer selections keep their
+        axis with length 1.
+    """
+    with open(file, 'rb') as _f, mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        index = _read_chunk_index(mm)
+        if index is None:
+            raise ValueError(f'{file} is not a chunked .npy.zst file')
+        return _slice_buffer(mm, index, t, z)
+
+
+def _slice_buffer(buf, index, t, z):
+    dtype = np.dtype(index['dtype'])
+    n_x, n_y, n_z, n_t = index['shape']
+    z0, z1, z_step = _as_range(z, n_z)
+    t0, t1, t_step = _as_range(t, n_t)
+
+    out = np.empty((n_x, n_y, z1 - z0, t1 - t0), dtype=dtype)
+    dctx = _thread_decompressor()
+    for fz0, fz1, ft0, ft1, offset, length in index['frames']:
+        oz0, oz1 = max(z0, fz0), min(z1, fz1)
+        ot0, ot1 = max(t0, ft0), min(t1, ft1)
+        if oz0 >= oz1 or ot0 >= ot1:
+            continue
+
+        raw = dctx.decompress(buf[offset:offset + length])
+        tile = np.frombuffer(raw, dtype=dtype).reshape(n_x, n_y, fz1 - fz0, ft1 - ft0)
+        out[:, :, oz0 - z0:oz1 - z0, ot0 - t0:ot1 - t0] = tile[:, :, oz0 - fz0:oz1 - fz0, ot0 - ft0:ot1 - ft0]
+
+    if z_step != 1 or t_step != 1:
+        out = np.ascontiguousarray(out[:, :, ::z_step, ::t_step])
+    return out
+
+
+def save_masked(file, arr, mask) -> None:
+    """
+    Save only the in-mask voxels of a (X, Y, Z, T) array plus a bit-packed mask.
+
+    Parameters
+    ----------
+    file : str
+        Output path (conventionally .npz.zst).
+    arr : np.ndarray
+        Array with shape (X, Y, Z) or (X, Y, Z, T); voxels outside `mask` are dropped.
+    mask : np.ndarray
+        Boolean array with shape (X, Y, Z).
+    """
+    arr = np.asarray(arr)
+    mask = np.asarray(mask, dtype=bool)
+    if arr.shape[:3] != mask.shape:
+        raise ValueError(f'Mask shape {mask.shape} does not match array spatial shape {arr.shape[:3]}')
+
+    savez(file,
+          values=arr[mask],  # (N_vox, T), C order of the mask
+          mask_bits=np.packbits(mask, axis=None),
+          shape=np.asarray(arr.shape, dtype=np.int64))
+
+
+def load_masked(file, dense=True):
+    """
+    Load a file written by `save_masked`.
+
+    Parameters
+    ----------
+    file : str
+        Path written by `save_masked`.
+    dense : bool
+        If True, return the full array with zeros outside the mask. Otherwise
+        return the packed in-mask matrix (N_vox, T) and the boolean mask.
+
+    Returns
+    -------
+    arr : np.ndarray
+        Dense array (X, Y, Z[, T]) when `dense` is True.
+    values, mask : np.ndarray, np.ndarray
+        Packed values (N_vox[, T]) and mask (X, Y, Z) when `dense` is False.
+    """
+    with load(file) as npz:
+        return _unpack_masked(npz, dense)
+
+
+def _unpack_masked(npz, dense=True):
+    values = npz['values']
+    shape = tuple(int(s) for s in npz['shape'])
+    n_vox = int(np.prod(shape[:3]))
+    mask = np.unpackbits(npz['mask_bits'], count=n_vox).view(bool).reshape(shape[:3])
+
+    if not dense:
+        return values, mask
+
+    arr = np.zeros(shape, dtype=values.dtype)
+    arr[mask] = values
+    return arr
+
+
+_QUANT_DTYPES = {8: np.int8, 16: np.int16}
+
+
+def quantize(arr, bits=8, clip=None, per_frame=True):
+    """
+    Symmetric linear quantization to int8/int16 (zeros stay exactly zero).
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        Array to quantize, e.g. a z-scored (X, Y, Z, T) volume.
+    bits : int
+        8 or 16.
+    clip : float or None
+        If given, clip at +/- `clip` standard deviations of the non-zero values
+        before quantizing, so outliers do not waste the integer range. Must be
+        positive.
+    per_frame : bool
+        Use one scale per entry of the last axis (per volume of a 4D array)
+        instead of one scale for the whole array.
+
+    Returns
+    -------
+    q : np.ndarray
+        Integer array with the shape of `arr`.
+    scale, offset : np.ndarray
+        float32 arrays such that ``arr ~= q * scale + offset``; they broadcast
+        against the last axis when `per_frame` is True.
+    """
+    if bits not in _QUANT_DTYPES:
+        raise ValueError(f'Quantization supports 8 or 16 bits, got {bits}')
+    if clip is not None and not clip > 0:
+        raise ValueError(f'clip must be a positive number of standard deviations, got {clip}')
+    arr = np.asarray(arr)
+    q_max = np.iinfo(_QUANT_DTYPES[bits]).max
+    reduce_axes = tuple(range(arr.ndim - 1)) if per_frame and arr.ndim > 1 else None
+
+    limit = np.max(np.abs(arr), axis=reduce_axes).astype(np.float64)
+    if clip is not None:
+        nz = arr[arr != 0].astype(np.float64)
+        if nz.size:
+            limit = np.minimum(limit, clip * nz.std())
+
+    scale = np.where(limit > 0, limit / q_max, 1.0).astype(np.float32)
+    q = np.empty(arr.shape, dtype=_QUANT_DTYPES[bits])
+    x = np.divide(arr, scale, dtype=np.float32)
+    np.clip(x, -q_max, q_max, out=x)
+    np.rint(x, out=x, casting='unsafe')
+    q[...] = x
+    return q, scale, np.zeros_like(scale)
+
+
+def dequantize(q, scale, offset, dtype=np.float32):
+    """Vectorized inverse of `quantize`: ``q * scale + offset`` in `dtype`."""
+    out = q.astype(dtype)
+    out *= np.asarray(scale, dtype=dtype)
+    out += np.asarray(offset, dtype=dtype)
+    return out
+
+
+def save_quantized(file, arr, bits=8, clip=None, per_frame=True) -> None:
+    """Quantize `arr` (see `quantize`) and save it with its scale/offset (conventionally .npz.zst)."""
+    q, scale, offset = quantize(arr, bits=bits, clip=clip, per_frame=per_frame)
+    savez(file, q=q, scale=scale, offset=offset)
+
+
+def load_quantized(file, dtype=np.float32):
+    """Load a file written by `save_quantized` and dequantize it to `dtype`."""
+    with load(file) as npz:
+        return dequantize(npz['q'], npz['scale'], npz['offset'], dtype=dtype)
+
+
+def unpack(obj, dtype=np.float32):
+    """
+    Turn the result of `load`/`loads` into a plain array.
 
-    buf = io.BytesIO(_dctx.decompress(data))
-    return np.load(buf, allow_pickle=allow_pickle, fix_imports=fix_imports, encoding=encoding)
+    Archives written by `save_quantized` are dequantized to `dtype`, archives
+    written by `save_masked` are expanded to the dense array; plain arrays are
+    returned unchanged.
+    """
+    if not isinstance(obj, np.lib.npyio.NpzFile):
+        return obj
+    with obj:
+        if 'q' in obj.files and 'scale' in obj.files:
+            return dequantize(obj['q'], obj['scale'], obj['offset'], dtype=dtype)
+        if 'mask_bits' in obj.files:
+            return _unpack_masked(obj)
+    raise ValueError(f'Archive with keys {obj.files} is not a quantized or masked array')
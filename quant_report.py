@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import glob
+import itertools
+import random
+
+import numpy as np
+
+import np_zstd
+
+
+def quantization_error(ref: np.ndarray, bits: int, clip=None) -> dict:
+    """
+    Quantize `ref` and measure the error of the dequantized result against it.
+
+    Returns
+    -------
+    row : dict
+        RMSE and max absolute error over all voxels, RMSE and SNR (dB) over
+        the non-zero (in-mask) voxels, and the compressed size relative to the
+        float16 .npy.zst of `ref`.
+    """
+    ref32 = ref.astype(np.float32)
+    q, scale, offset = np_zstd.quantize(ref, bits=bits, clip=clip)
+    err = np_zstd.dequantize(q, scale, offset) - ref32
+
+    nz = ref32 != 0
+    err_nz = err[nz]
+    signal_power = float(np.mean(np.square(ref32[nz], dtype=np.float64))) if err_nz.size else 0.0
+    noise_power = float(np.mean(np.square(err_nz, dtype=np.float64))) if err_nz.size else 0.0
+
+    f16_bytes = len(np_zstd._cctx.compress(np_zstd._npy_header(ref) + np.ascontiguousarray(ref).tobytes()))
+    q_bytes = len(np_zstd._cctx.compress(np_zstd._npy_header(q) + q.tobytes()))
+    return {
+        'rmse': float(np.sqrt(np.mean(np.square(err, dtype=np.float64)))),
+        'max_abs': float(np.max(np.abs(err))),
+        'rmse_nonzero': float(np.sqrt(noise_power)),
+        'snr_db': float(10 * np.log10(signal_power / noise_power)) if noise_power > 0 else float('inf'),
+        'size_vs_float16': q_bytes / f16_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure int8/int16 quantization error against float16 nifti_process.py outputs.')
+    parser.add_argument('inputs', nargs='+', help='float16 .npy.zst outputs or glob patterns.')
+    parser.add_argument('--bits', '-b', type=int, nargs='+', default=[8, 16], help='Bit depths to test.')
+    parser.add_argument('--clips', '-c', type=float, nargs='+', default=[0, 4, 6, 8],
+                        help='Clip thresholds in standard deviations (0: no clipping).')
+    parser.add_argument('--n_subjects', '-n', type=int, default=10, help='Number of files to sample.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for sampling.')
+    parser.add_argument('--csv', type=str, default=None, help='Optional CSV path for per-subject results.')
+    args = parser.parse_args()
+
+    paths = sorted(set(itertools.chain.from_iterable(glob.glob(p) or [p] for p in args.inputs)))
+    if len(paths) > args.n_subjects:
+        paths = sorted(random.Random(args.seed).sample(paths, args.n_subjects))
+
+    rows = []
+    for path in paths:
+        ref = np_zstd.load(path)
+        for bits, clip in itertools.product(args.bits, args.clips):
+            row = {'file': path, 'bits': bits, 'clip': clip}
+            row.update(quantization_error(ref, bits, clip or None))
+            rows.append(row)
+
+    print(f'{len(paths)} subjects')
+    print(f'{"bits":>4} {"clip":>5} {"rmse":>10} {"max_abs":>10} {"rmse_nz":>10} {"snr_db":>8} {"size":>6}')
+    for bits, clip in itertools.product(args.bits, args.clips):
+        sel = [r for r in rows if r['bits'] == bits and r['clip'] == clip]
+        mean = {k: float(np.mean([r[k] for r in sel])) for k in ('rmse', 'rmse_nonzero', 'snr_db', 'size_vs_float16')}
+        worst = max(r['max_abs'] for r in sel)
+        print(f'{bits:>4} {clip:>5g} {mean["rmse"]:>10.2e} {worst:>10.2e} {mean["rmse_nonzero"]:>10.2e} '
+              f'{mean["snr_db"]:>8.1f} {mean["size_vs_float16"]:>6.2f}')
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f'Results saved to {args.csv}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,97 @@
 import argparse
 import glob
 import os
+import sys
+import time
 
-import nibabel as nib
 import numpy as np
-import pandas as pd
-from nilearn.image import resample_img
 from tqdm import tqdm
 
+# roi_extract.py / roi_sampler.py live at the repo root (or next to this script when all are downloaded)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from roi_extract import label_sums_multi, load_atlas, load_fmri, peak_rss_mb
+from roi_sampler import (LABEL_SUMS_NAME, WEIGHTINGS, RegionSampler, adjacency_suffix, load_adjacency, merged_means,
+                         save_label_sums)
+
+
+def add_label_sums(fmri, processed_atlases, chunk_size=64, dtype=np.float32):
+    """Attach per-label 'sums' and 'counts' to every atlas, from a single pass over the fMRI."""
+    tables = label_sums_multi(fmri, {a['name']: a['data'] for a in processed_atlases}, chunk_size, dtype)
+    for atlas_info in processed_atlases:
+        atlas_info['sums'], atlas_info['counts'] = tables[atlas_info['name']]
+
+
+def benchmark(fmri_img, processed_atlases, n_samples=200, seed=0, chunk_size=64, dtype=np.float32):
+    """
+    Compare samples/sec of the per-sample mask path and the label-sum path on the same draws.
+
+    The mask path is the original implementation (float64 data, as `get_fdata`);
+    the label sums are built as for the real output (`chunk_size`, `dtype`), so
+    the reported difference is that of the output against the original.
+    """
+    # The per-sample mask path needs the whole run in memory
+    fmri_data = np.asarray(fmri_img.dataobj, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    draws = []
+    for _ in range(n_samples):
+        atlas_info = processed_atlases[rng.integers(len(processed_atlases))]
+        roi1, roi2 = atlas_info['adjacency'][rng.integers(len(atlas_info['adjacency']))]
+        draws.append((atlas_info, roi1, roi2))
+
+    t0 = time.perf_counter()
+    ref = []
+    for atlas_info, roi1, roi2 in draws:
+        mask = (atlas_info['data'] == roi1) | (atlas_info['data'] == roi2)
+        ref.append(fmri_data[mask].mean(axis=0) if mask.any() else np.zeros(fmri_data.shape[3]))
+    t_mask = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    add_label_sums(fmri_img, processed_atlases, chunk_size=chunk_size, dtype=dtype)
+    t_setup = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    out = [merged_means(a['sums'], a['counts'], [(r1, r2)])[0] for a, r1, r2 in draws]
+    t_sum = time.perf_counter() - t0
+
+    max_diff = max(float(np.max(np.abs(a - b))) for a, b in zip(ref, out))
+    print(f"Mask path:      {n_samples / t_mask:12.1f} samples/s")
+    print(f"Label-sum path: {n_samples / t_sum:12.1f} samples/s "
+          f"(+ {t_setup:.2f} s one-off for {len(processed_atlases)} atlases)")
+    print(f"Max abs difference to the float64 mask path: {max_diff:.3e}")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Augment ROIs by merging adjacent regions.")
     parser.add_argument("--fmri", type=str, required=True, help="Path to the input 4D fMRI NIfTI file.")
     parser.add_argument("--adjacency_dir", type=str, required=False, help="Directory containing adjacency .npy files.")
     parser.add_argument("--atlas_dir", type=str, required=True, help="Directory containing atlas NIfTI files.")
+    parser.add_argument("--connectivity", type=int, choices=(6, 18, 26), default=6,
+                        help="Use the adjacency files prepared with this --connectivity (default: 6).")
     parser.add_argument("--output_dir", type=str, required=True, help="Directory to save outputs.")
     parser.add_argument("--n_samples", type=int, default=2000, help="Number of augmented samples to generate.")
+    parser.add_argument("--k", type=int, default=2, help="Number of connected ROIs merged per sample (>= 2).")
+    parser.add_argument("--weighting", type=str, choices=WEIGHTINGS, default="uniform",
+                        help="Draw ROI pairs/neighbours uniformly or proportionally to their shared boundary size.")
+    parser.add_argument("--atlas_weights", type=str, nargs="+", default=None,
+                        help="Relative atlas probabilities as name=weight (unlisted atlases get 0; default: uniform).")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed.")
+    parser.add_argument("--no_label_sums", action="store_true",
+                        help=f"Do not write the per-atlas label sum tables ({LABEL_SUMS_NAME}) used for "
+                             "on-the-fly augmentation during training.")
+    parser.add_argument("--chunk_size", type=int, default=64,
+                        help="Time points read per chunk; bounds peak memory (0: whole run at once).")
+    parser.add_argument("--dtype", type=str, default="float32",
+                        help="dtype of the loaded chunks ('native' keeps the on-disk dtype).")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Time the per-sample mask path against the label-sum path and exit.")
     args = parser.parse_args()
 
     os.makedirs(args.output_dir, exist_ok=True)
 
-    print(f"Loading fMRI data from {args.fmri}...")
+    print(f"Opening fMRI data from {args.fmri}...")
     try:
-        fmri_img = nib.load(args.fmri)
-        fmri_data = fmri_img.get_fdata()  # (X, Y, Z, T)
-        fmri_affine = fmri_img.affine
-        print(f"fMRI shape: {fmri_data.shape}")
+        # Voxel data is only read in time-chunks when the label sums are built
+        fmri_img = load_fmri(args.fmri)
+        print(f"fMRI shape: {fmri_img.shape}")  # (X, Y, Z, T)
     except Exception as e:
         print(f"Error loading fMRI file: {e}")
         return
@@ -40,15 +106,16 @@ def main():
             f"Error: Adjacency directory {adj_dir} not found. Please run roi_augmentation/prepare_atlas_neighbors.py first.")
         return
 
-    processed_atlases = []  # List of (filename, data_array, adjacency_list)
+    processed_atlases = []  # List of {name, data, adjacency, graph}
 
-    adj_files = glob.glob(os.path.join(adj_dir, "*_adj.npy"))
+    suffix = adjacency_suffix(args.connectivity)
+    adj_files = glob.glob(os.path.join(adj_dir, "*" + suffix + ".npy"))
 
     for adj_fpath in tqdm(adj_files, desc="Loading Atlases"):
         # Infer atlas filename from adjacency filename
-        # adj file: name_adj.npy
+        # adj file: name_adj.npy (name_adj18.npy / name_adj26.npy for other connectivities)
         # atlas file: name.nii.gz or name.nii
-        base_name = os.path.basename(adj_fpath).replace("_adj.npy", "")
+        base_name = os.path.basename(adj_fpath)[:-len(suffix + ".npy")]
 
         # Try to find the corresponding atlas file
         # We prefer the one that matches the base name exactly (which should be the 2mm one if prep script ran)
@@ -68,29 +135,23 @@ def main():
             continue
 
         try:
-            # Load Adjacency
+            # Load Adjacency (pair list, plus the boundary-weighted CSR graph when prepared)
             adj = np.load(adj_fpath)
             if len(adj) == 0:
                 continue
+            graph = load_adjacency(adj_dir, base_name, connectivity=args.connectivity)
 
             # Load Atlas Data
-            img = nib.load(atlas_path)
-
-            # Check if we need to resample to match fMRI geometry exactly
             # We assume the prep script made them 2mm isotropic.
             # If the fMRI is also 2mm isotropic but has a different affine (e.g. shifted origin),
-            # we still need to resample to be safe.
-            if img.shape[:3] != fmri_data.shape[:3] or not np.allclose(img.affine, fmri_affine):
-                # Resample to match fMRI geometry (nearest neighbor for labels)
-                img = resample_img(img, target_affine=fmri_affine, target_shape=fmri_data.shape[:3],
-                                   interpolation='nearest')
-
-            data = img.get_fdata().astype(int)
+            # load_atlas still resamples (nearest neighbor for labels) to be safe.
+            data = load_atlas(atlas_path, fmri_img)
 
             processed_atlases.append({
                 'name': base_name,
                 'data': data,
-                'adjacency': adj
+                'adjacency': adj,
+                'graph': graph
             })
 
         except Exception as e:
@@ -100,55 +161,55 @@ def main():
         print("No valid atlases available after processing.")
         return
 
-    # 2. Sampling Loop
-    print(f"Starting sampling of {args.n_samples} regions...")
-
-    augmented_timeseries = []
-    augmentation_log = []
-
-    for i in tqdm(range(args.n_samples), desc="Sampling"):
-        # Randomly select an atlas
-        atlas_info = processed_atlases[np.random.randint(len(processed_atlases))]
-
-        # Randomly select a pair of connected ROIs
-        pair_idx = np.random.randint(len(atlas_info['adjacency']))
-        roi1, roi2 = atlas_info['adjacency'][pair_idx]
-
-        # Create merged mask
-        mask = (atlas_info['data'] == roi1) | (atlas_info['data'] == roi2)
-
-        # Extract time series
-        # fmri_data is (X, Y, Z, T), mask is (X, Y, Z)
-        # We want mean over the mask
-
-        if np.sum(mask) == 0:
-            # Should not happen if adjacency is correct, but safety check
-            ts = np.zeros(fmri_data.shape[3])
-        else:
-            # Masking: fmri_data[mask] returns (N_voxels, T)
-            # Mean over voxels -> (T,)
-            ts = fmri_data[mask].mean(axis=0)
-
-        augmented_timeseries.append(ts)
-
-        augmentation_log.append({
-            'sample_id': i,
-            'atlas_name': atlas_info['name'],
-            'roi1': roi1,
-            'roi2': roi2
-        })
+    dtype = None if args.dtype == "native" else np.dtype(args.dtype)
+    if args.benchmark:
+        benchmark(fmri_img, processed_atlases, chunk_size=args.chunk_size, dtype=dtype)
+        return
 
-    # 3. Save Results
+    # 2. Per-label sums of all atlases in one pass over the fMRI:
+    # every merged region is then (S[r1] + S[r2]) / (n[r1] + n[r2])
+    print(f"Computing label sums for {len(processed_atlases)} atlases...")
+    add_label_sums(fmri_img, processed_atlases, chunk_size=args.chunk_size, dtype=dtype)
+    print(f"Peak RSS after label sums: {peak_rss_mb():.0f} MB")
+
+    if not args.no_label_sums:
+        # Lets training draw fresh merged regions every epoch (roi_sampler.LabelSums) without voxel data
+        label_sums_path = os.path.join(args.output_dir, LABEL_SUMS_NAME)
+        save_label_sums(label_sums_path, {a['name']: (a['sums'], a['counts']) for a in processed_atlases})
+        print(f"Saved label sums to {label_sums_path}")
+
+    # 3. Sampling: whole batches of connected k-ROI sets, then vectorized means from the label sums
+    print(f"Starting sampling of {args.n_samples} regions (k={args.k}, {args.weighting} weighting)...")
+    atlas_weights = None
+    if args.atlas_weights:
+        atlas_weights = {name: float(w) for name, w in (item.split("=", 1) for item in args.atlas_weights)}
+    sampler = RegionSampler({a['name']: a['graph'] for a in processed_atlases}, weighting=args.weighting,
+                            atlas_weights=atlas_weights)
+    atlas_idx, members = sampler.sample(args.n_samples, k=args.k, rng=np.random.default_rng(args.seed))
+
+    by_name = {a['name']: a for a in processed_atlases}
+    augmented_timeseries = np.zeros((args.n_samples, fmri_img.shape[3]))
+    for a, name in enumerate(sampler.names):
+        rows = np.flatnonzero(atlas_idx == a)
+        augmented_timeseries[rows] = merged_means(by_name[name]['sums'], by_name[name]['counts'], members[rows])
+
+    augmentation_log = {'sample_id': np.arange(args.n_samples),
+                        'atlas_name': np.asarray(sampler.names)[atlas_idx]}
+    for j in range(args.k):
+        augmentation_log[f'roi{j + 1}'] = members[:, j]
+
+    # 4. Save Results
     output_ts_path = os.path.join(args.output_dir, "augmented_timeseries.npy")
     output_log_path = os.path.join(args.output_dir, "augmentation_log.tsv")
 
     print(f"Saving time series to {output_ts_path}...")
-    np.save(output_ts_path, np.array(augmented_timeseries))
+    np.save(output_ts_path, augmented_timeseries)
 
     print(f"Saving log to {output_log_path}...")
+    import pandas as pd
     pd.DataFrame(augmentation_log).to_csv(output_log_path, sep='\t', index=False)
 
-    print("Done!")
+    print(f"Done! Peak RSS: {peak_rss_mb():.0f} MB")
 
 
 if __name__ == "__main__":
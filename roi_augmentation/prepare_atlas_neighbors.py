@@ -1,116 +1,175 @@
-import os
+import argparse
 import glob
-import numpy as np
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import nibabel as nib
+import numpy as np
+import scipy.sparse
 from nibabel.processing import resample_to_output
 from tqdm import tqdm
 
-def get_adjacency_graph(atlas_data):
+
+# Half of each neighbourhood (one offset per pair of opposite directions), keyed by connectivity:
+# 6 = faces, 18 = + edges, 26 = + corners
+_OFFSETS = {
+    n: [o for o in itertools.product((-1, 0, 1), repeat=3) if o > (0, 0, 0) and sum(map(abs, o)) <= r]
+    for n, r in ((6, 1), (18, 2), (26, 3))
+}
+
+
+def _shifted_views(atlas_data, offset):
+    """Views (d1, d2) of the atlas such that d2[i] is the neighbour of d1[i] along `offset`."""
+    sl1, sl2 = [], []
+    for d in offset:
+        sl1.append(slice(0, -d) if d > 0 else slice(-d, None) if d < 0 else slice(None))
+        sl2.append(slice(d, None) if d > 0 else slice(0, d) if d < 0 else slice(None))
+    return atlas_data[tuple(sl1)], atlas_data[tuple(sl2)]
+
+
+def boundary_counts(atlas_data, connectivity=6):
     """
-    Finds all pairs of adjacent ROIs in the 3D atlas.
-    Returns a list of tuples (roi1, roi2).
+    Finds all pairs of adjacent ROIs in the 3D atlas with their shared-boundary size.
+
+    Every pair of neighbouring voxels (6: faces, 18: + edges, 26: + corners)
+    with two different non-zero labels is encoded as one int64 key
+    ``min * (max_label + 1) + max`` and the keys are counted with np.unique.
+
+    Returns:
+        pairs: (n_pairs, 2) int64 array of (roi1, roi2) with roi1 < roi2, sorted
+        counts: (n_pairs,) int64 number of neighbouring voxel pairs across each boundary
     """
-    pairs = set()
-    
-    # Check neighbors in x, y, z directions
-    for axis in range(3):
-        # Compare slice i with slice i+1
-        # We want to find voxels where the label changes
-        
-        # Create views shifted by 1 voxel
-        sl_d1 = [slice(None)] * 3
-        sl_d1[axis] = slice(0, -1)
-        
-        sl_d2 = [slice(None)] * 3
-        sl_d2[axis] = slice(1, None)
-        
-        d1 = atlas_data[tuple(sl_d1)]
-        d2 = atlas_data[tuple(sl_d2)]
-        
+    if connectivity not in _OFFSETS:
+        raise ValueError(f"connectivity must be one of {sorted(_OFFSETS)}, got {connectivity}")
+
+    atlas_data = np.asarray(atlas_data, dtype=np.int64)
+    base = int(atlas_data.max()) + 1 if atlas_data.size else 1
+
+    keys = []
+    for offset in _OFFSETS[connectivity]:
+        d1, d2 = _shifted_views(atlas_data, offset)
         # Find boundaries between different non-zero regions
         mask = (d1 != d2) & (d1 != 0) & (d2 != 0)
-        
-        if not np.any(mask):
-            continue
-            
-        # Extract the pairs of labels at the boundaries
-        p1 = d1[mask]
-        p2 = d2[mask]
-        
-        # Stack and sort to ensure (a,b) is treated same as (b,a)
-        p_stacked = np.stack([p1, p2], axis=1)
-        p_stacked.sort(axis=1)
-        
-        # Find unique pairs in this axis
-        unique_pairs = np.unique(p_stacked, axis=0)
-        
-        for row in unique_pairs:
-            pairs.add(tuple(row))
-            
-    return list(pairs)
+        p1, p2 = d1[mask], d2[mask]
+        keys.append(np.minimum(p1, p2) * base + np.maximum(p1, p2))
+
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    pairs = np.stack([keys // base, keys % base], axis=1)
+    return pairs, counts
+
+
+def get_adjacency_graph(atlas_data, connectivity=6):
+    """
+    Finds all pairs of adjacent ROIs in the 3D atlas.
+    Returns a list of tuples (roi1, roi2) with roi1 < roi2.
+    """
+    pairs, _ = boundary_counts(atlas_data, connectivity)
+    return [tuple(p) for p in pairs.tolist()]
+
+
+def adjacency_csr(pairs, counts, n_labels=None):
+    """
+    Symmetric (n_labels, n_labels) CSR adjacency indexed by label value,
+    weighted by shared-boundary voxel counts.
+    """
+    if n_labels is None:
+        n_labels = int(pairs.max()) + 1 if len(pairs) else 1
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    weights = np.concatenate([counts, counts]).astype(np.int64)
+    return scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(n_labels, n_labels))
+
+
+def adjacency_suffix(connectivity=6):
+    """
+    File name suffix of the adjacency outputs for a connectivity: `_adj` for the
+    default 6, `_adj18` / `_adj26` otherwise, so runs with different
+    neighbourhoods never overwrite (or skip) each other's files.
+    """
+    return "_adj" if connectivity == 6 else f"_adj{connectivity}"
+
+
+def process_atlas(fpath, atlas_dir, adj_dir, connectivity=6, force=False):
+    """
+    Resample one atlas to 2mm if needed and write its adjacency pairs (`_adj.npy`)
+    and weighted graph (`_adj_csr.npz`); see `adjacency_suffix` for 18/26-connectivity names.
+    """
+    fname = os.path.basename(fpath)
+    img = nib.load(fpath)
+
+    # 1. Check and Enforce 2mm Resolution
+    zooms = img.header.get_zooms()[:3]
+    is_2mm = np.allclose(zooms, [2.0, 2.0, 2.0], atol=0.05)
+
+    if not is_2mm:
+        print(f"Resampling {fname} to 2mm isotropic...")
+        img = resample_to_output(img, voxel_sizes=(2.0, 2.0, 2.0), order=0)
+
+        # Save the resampled version
+        # If original was 'atlas.nii.gz', new is 'atlas_2mm.nii.gz'
+        if "_2mm" not in fname:
+            new_fname = fname.replace(".nii", "_2mm.nii")
+            nib.save(img, os.path.join(atlas_dir, new_fname))
+            fname = new_fname  # Adjacency is named after the 2mm version
+        else:
+            # It says 2mm but header wasn't close enough? Overwrite.
+            nib.save(img, fpath)
+
+    # 2. Compute Adjacency, unless both outputs already exist
+    base_name = fname.replace(".nii.gz", "").replace(".nii", "")
+    suffix = adjacency_suffix(connectivity)
+    adj_fpath = os.path.join(adj_dir, base_name + suffix + ".npy")
+    csr_fpath = os.path.join(adj_dir, base_name + suffix + "_csr.npz")
+    if not force and os.path.exists(adj_fpath) and os.path.exists(csr_fpath):
+        return f"{fname}: exists, skipped"
+
+    t0 = time.perf_counter()
+    data = np.rint(np.asarray(img.dataobj)).astype(np.int64)
+    pairs, counts = boundary_counts(data, connectivity)
+    elapsed = time.perf_counter() - t0
+
+    # 3. Save Adjacency: plain pairs (read by augment_rois.py) and the weighted CSR graph
+    np.save(adj_fpath, pairs)
+    scipy.sparse.save_npz(csr_fpath, adjacency_csr(pairs, counts, int(data.max()) + 1))
+
+    if not len(pairs):
+        return f"Warning: No adjacent ROIs found in {fname}"
+    return f"{fname}: {len(pairs)} pairs in {elapsed:.3f} s"
+
 
 def main():
-    atlas_dir = r"C:\Users\47841\Desktop\ICML2026\atlas_data"
-    adj_dir = os.path.join(atlas_dir, "adjacency")
+    parser = argparse.ArgumentParser(description="Resample atlases to 2mm and compute ROI adjacency graphs.")
+    parser.add_argument("--atlas_dir", type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "atlas_data"),
+                        help="Directory containing atlas NIfTI files (default: atlas_data next to this script).")
+    parser.add_argument("--adj_dir", type=str, default=None,
+                        help="Output directory for adjacency files (default: <atlas_dir>/adjacency).")
+    parser.add_argument("--connectivity", type=int, choices=sorted(_OFFSETS), default=6,
+                        help="Voxel neighbourhood: 6 (faces), 18 (+ edges) or 26 (+ corners).")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all CPUs).")
+    parser.add_argument("--force", action="store_true", help="Recompute existing adjacency files.")
+    args = parser.parse_args()
+
+    atlas_dir = args.atlas_dir
+    adj_dir = args.adj_dir or os.path.join(atlas_dir, "adjacency")
     os.makedirs(adj_dir, exist_ok=True)
-    
+
     print(f"Scanning atlases in {atlas_dir}...")
-    files = glob.glob(os.path.join(atlas_dir, "*.nii.gz")) + glob.glob(os.path.join(atlas_dir, "*.nii"))
-    
-    for fpath in tqdm(files, desc="Preparing Atlases"):
-        fname = os.path.basename(fpath)
-        
-        # Skip if it's a file we just generated (avoid loops if running multiple times)
-        if "_2mm.nii" in fname and os.path.exists(fpath.replace("_2mm.nii", ".nii")):
-             # This logic is tricky, let's just process everything but be careful about overwriting
-             pass
-
-        try:
-            img = nib.load(fpath)
-            
-            # 1. Check and Enforce 2mm Resolution
-            zooms = img.header.get_zooms()[:3]
-            is_2mm = np.allclose(zooms, [2.0, 2.0, 2.0], atol=0.05)
-            
-            if not is_2mm:
-                print(f"Resampling {fname} to 2mm isotropic...")
-                img = resample_to_output(img, voxel_sizes=(2.0, 2.0, 2.0), order=0)
-                
-                # Save the resampled version
-                # If original was 'atlas.nii.gz', new is 'atlas_2mm.nii.gz'
-                # If it already has _2mm, we might be re-resampling, which is fine but maybe redundant.
-                if "_2mm" not in fname:
-                    new_fname = fname.replace(".nii", "_2mm.nii")
-                    new_fpath = os.path.join(atlas_dir, new_fname)
-                    nib.save(img, new_fpath)
-                    fpath = new_fpath # Update fpath to point to the 2mm version
-                    fname = new_fname
-                else:
-                    # It says 2mm but header wasn't close enough? Overwrite.
-                    nib.save(img, fpath)
-            
-            # 2. Compute Adjacency
-            # Check if adjacency file already exists
-            adj_fname = fname.replace(".nii.gz", "").replace(".nii", "") + "_adj.npy"
-            adj_fpath = os.path.join(adj_dir, adj_fname)
-            
-            if os.path.exists(adj_fpath):
-                # print(f"Adjacency file exists for {fname}, skipping computation.")
-                continue
-
-            data = img.get_fdata().astype(int)
-            adj = get_adjacency_graph(data)
-            
-            if not adj:
-                print(f"Warning: No adjacent ROIs found in {fname}")
-            
-            # 3. Save Adjacency
-            np.save(adj_fpath, np.array(adj))
-            
-        except Exception as e:
-            print(f"Error processing {fname}: {e}")
+    files = sorted(glob.glob(os.path.join(atlas_dir, "*.nii.gz")) + glob.glob(os.path.join(atlas_dir, "*.nii")))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(process_atlas, fpath, atlas_dir, adj_dir, args.connectivity, args.force): fpath
+                   for fpath in files}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Preparing Atlases"):
+            try:
+                tqdm.write(future.result())
+            except Exception as e:
+                tqdm.write(f"Error processing {os.path.basename(futures[future])}: {e}")
 
     print("Preparation complete.")
 
+
 if __name__ == "__main__":
     main()
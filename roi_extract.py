@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import resource
+import sys
+
+import nibabel as nib
+import numpy as np
+
+
+def load_fmri(path: str):
+    """
+    Open a 4D NIfTI without reading its data.
+
+    The file handle is kept open so that successive time-chunk reads of a
+    ``.nii.gz`` continue the same gzip stream instead of decompressing from
+    the start of the file for every chunk.
+    """
+    return nib.load(path, keep_file_open=True)
+
+
+def iter_time_chunks(img, chunk_size=64, dtype=np.float32):
+    """
+    Yield ``(t0, chunk)`` with ``chunk = data[..., t0:t0 + chunk_size]``.
+
+    Parameters
+    ----------
+    img : nibabel image or np.ndarray
+        4D series; images are read lazily from ``img.dataobj``.
+    chunk_size : int or None
+        Time points per chunk (None or <= 0: the whole run at once).
+    dtype : np.dtype or None
+        Chunk dtype (None keeps the stored dtype, scaled if the header asks for it).
+    """
+    data = img.dataobj if hasattr(img, 'dataobj') else img
+    n_t = data.shape[3]
+    step = chunk_size if chunk_size and chunk_size > 0 else n_t
+    for t0 in range(0, n_t, step):
+        chunk = np.asarray(data[..., t0:t0 + step])
+        if dtype is not None:
+            chunk = chunk.astype(dtype, copy=False)
+        yield t0, chunk
+
+
+def load_atlas(atlas_path: str, fmri_img) -> np.ndarray:
+    """
+    Integer label array of `atlas_path` on the voxel grid of `fmri_img`.
+
+    Atlases already warped onto the fMRI grid are used as they are; anything
+    else is resampled with nearest-neighbour interpolation (nilearn, imported
+    only in that case).
+    """
+    img = nib.load(atlas_path)
+    if img.shape[:3] != fmri_img.shape[:3] or not np.allclose(img.affine, fmri_img.affine):
+        from nilearn.image import resample_img
+        img = resample_img(img, target_affine=fmri_img.affine, target_shape=fmri_img.shape[:3],
+                           interpolation='nearest')
+    return np.rint(np.asarray(img.dataobj)).astype(np.intp)
+
+
+class LabelIndex:
+    """
+    Flat voxel indices of one atlas grouped by label.
+
+    ROI means of a (V, t) chunk are then one gather (in the chunk dtype,
+    float32 by default) and one `np.add.reduceat`. The sums accumulate in
+    float64: the temporal signal is a small fraction of the voxel mean, and
+    float32 sums over thousands of voxels would lose it. Labels ascend (the
+    ROI order of nilearn's `NiftiLabelsMasker`); label 0 is background.
+    """
+
+    def __init__(self, atlas_data: np.ndarray):
+        self.shape = atlas_data.shape
+        # Fortran order, the layout of NIfTI data and of dataobj chunks
+        flat = np.asarray(atlas_data).ravel(order='F')
+        voxels = np.flatnonzero(flat > 0)
+        self.voxels = voxels[np.argsort(flat[voxels], kind='stable')]
+        self.labels, self.starts, self.counts = np.unique(flat[self.voxels], return_index=True, return_counts=True)
+
+    def means(self, chunk: np.ndarray) -> np.ndarray:
+        """(n_rois, t) ROI means of an (X, Y, Z, t) chunk."""
+        data_2d = chunk.reshape(-1, chunk.shape[3], order='F')
+        if not len(self.labels):
+            return np.empty((0, data_2d.shape[1]))
+        return np.add.reduceat(data_2d[self.voxels], self.starts, axis=0, dtype=np.float64) / self.counts[:, None]
+
+
+def roi_means(img, atlas_data: np.ndarray, chunk_size=64, dtype=np.float32, standardize_ts=True):
+    """
+    ROI x time mean series of one atlas, read in time-chunks.
+
+    Matches ``NiftiLabelsMasker(standardize=standardize_ts, strategy='mean')``.
+    Voxel data is read as `dtype` (None: stored dtype).
+
+    Returns
+    -------
+    labels : np.ndarray
+        (n_rois,) label values.
+    roi_time_series : np.ndarray
+        (n_rois, T) float32.
+    """
+    index = LabelIndex(atlas_data)
+    if img.shape[:3] != index.shape:
+        raise ValueError(f'fMRI grid {img.shape[:3]} does not match the atlas grid {index.shape}')
+    ts = np.empty((len(index.labels), img.shape[3]))
+    for t0, chunk in iter_time_chunks(img, chunk_size, dtype):
+        ts[:, t0:t0 + chunk.shape[3]] = index.means(chunk)
+    if standardize_ts:
+        ts = standardize(ts)
+    return index.labels, ts.astype(np.float32)
+
+
+class LabelOperator:
+    """
+    Sparse label-assignment matrix stacking the ROIs of several atlases.
+
+    Row ``i`` holds a 1 for every voxel of one (atlas, label) pair, so a
+    single ``matrix @ chunk`` with a (V, t) chunk of the fMRI gives the voxel
+    sums of every ROI of every atlas for those t time points. Rows are grouped
+    by atlas in insertion order, labels ascending within an atlas (the ROI
+    order of nilearn's `NiftiLabelsMasker`); label 0 is background.
+
+    Parameters
+    ----------
+    atlases : dict
+        Atlas name -> (X, Y, Z) non-negative integer label array, all on the fMRI grid.
+    dtype : np.dtype
+        Accumulation dtype of the matrix product.
+    """
+
+    def __init__(self, atlases: dict, dtype=np.float64):
+        import scipy.sparse
+
+        shapes = {a.shape for a in atlases.values()}
+        if len(shapes) != 1:
+            raise ValueError(f'Atlases must share one voxel grid, got shapes {sorted(shapes)}')
+        self.shape = shapes.pop()
+        self.labels, self.counts, self.rows = {}, {}, {}
+
+        row_idx, col_idx = [], []
+        n_rows = 0
+        for name, data in atlases.items():
+            # Voxels are flattened in Fortran order, the layout of NIfTI data and of dataobj chunks
+            flat = np.asarray(data).ravel(order='F')
+            voxels = np.flatnonzero(flat > 0)
+            labels, inverse, counts = np.unique(flat[voxels], return_inverse=True, return_counts=True)
+            self.labels[name] = labels
+            self.counts[name] = counts
+            self.rows[name] = slice(n_rows, n_rows + len(labels))
+            row_idx.append(inverse.ravel() + n_rows)
+            col_idx.append(voxels)
+            n_rows += len(labels)
+
+        row_idx = np.concatenate(row_idx) if row_idx else np.empty(0, dtype=np.intp)
+        col_idx = np.concatenate(col_idx) if col_idx else np.empty(0, dtype=np.intp)
+        self.matrix = scipy.sparse.csr_matrix((np.ones(len(row_idx), dtype=dtype), (row_idx, col_idx)),
+                                              shape=(n_rows, int(np.prod(self.shape))))
+
+    @property
+    def names(self) -> list:
+        return list(self.rows)
+
+    def sums(self, img, chunk_size=64, dtype=np.float32) -> np.ndarray:
+        """(n_rows, T) voxel sums of every ROI, one sparse product per time-chunk."""
+        if img.shape[:3] != self.shape:
+            raise ValueError(f'fMRI grid {img.shape[:3]} does not match the atlas grid {self.shape}')
+        out = np.empty((self.matrix.shape[0], img.shape[3]), dtype=self.matrix.dtype)
+        for t0, chunk in iter_time_chunks(img, chunk_size, dtype):
+            data_2d = chunk.reshape(-1, chunk.shape[3], order='F')
+            out[:, t0:t0 + chunk.shape[3]] = self.matrix @ data_2d
+        return out
+
+    def split(self, stacked: np.ndarray) -> dict:
+        """Per-atlas blocks of an (n_rows, ...) array."""
+        return {name: stacked[rows] for name, rows in self.rows.items()}
+
+
+def label_sums_multi(img, atlases: dict, chunk_size=64, dtype=np.float32) -> dict:
+    """
+    Per-label voxel sums and counts for several atlases from one pass over the fMRI.
+
+    Returns
+    -------
+    out : dict
+        Atlas name -> ``(sums, counts)``, indexed by label value:
+        `sums` is (max_label + 1, T) float64 with
+        ``sums[r] = data[atlas == r].sum(axis=0)`` and `counts` is
+        (max_label + 1,) int64. Row 0 (background) is left at zero.
+    """
+    op = LabelOperator(atlases)
+    stacked = op.split(op.sums(img, chunk_size, dtype))
+    out = {}
+    for name, block in stacked.items():
+        labels = op.labels[name]
+        n_labels = int(labels.max()) + 1 if labels.size else 1
+        sums = np.zeros((n_labels, block.shape[1]), dtype=block.dtype)
+        counts = np.zeros(n_labels, dtype=np.int64)
+        sums[labels] = block
+        counts[labels] = op.counts[name]
+        out[name] = (sums, counts)
+    return out
+
+
+def label_sums(img, atlas_data: np.ndarray, chunk_size=64, dtype=np.float32):
+    """
+    Per-label voxel sums and counts of a 4D series, accumulated over time-chunks.
+
+    Only one chunk of `chunk_size` time points is held in memory at a time,
+    so peak memory does not grow with the run length. See `label_sums_multi`
+    for the output layout.
+    """
+    return label_sums_multi(img, {'atlas': atlas_data}, chunk_size, dtype)['atlas']
+
+
+def extract_multi(img, atlases: dict, chunk_size=64, dtype=np.float32, standardize_ts=True) -> dict:
+    """
+    ROI x time mean series of several atlases from one pass over the fMRI.
+
+    Matches ``NiftiLabelsMasker(standardize=standardize_ts, strategy='mean')``
+    applied to each atlas separately (ROIs in ascending label order, background excluded).
+
+    Returns
+    -------
+    out : dict
+        Atlas name -> ``(labels, roi_time_series)`` with `roi_time_series` of
+        shape (n_rois, T), float32.
+    """
+    op = LabelOperator(atlases)
+    sums = op.sums(img, chunk_size, dtype)
+    out = {}
+    for name, block in op.split(sums).items():
+        ts = block / op.counts[name][:, None]
+        if standardize_ts:
+            ts = standardize(ts)
+        out[name] = (op.labels[name], ts.astype(np.float32))
+    return out
+
+
+def standardize(ts: np.ndarray, ddof=1) -> np.ndarray:
+    """
+    Z-score (n_rois, T) time series along time, as nilearn's ``standardize=True``.
+
+    Recent nilearn releases use the sample std (``ddof=1``); older ones used ``ddof=0``.
+    Series with a zero std are only centred; a single time point is returned as is.
+    """
+    if ts.shape[1] < 2:
+        return ts.copy()
+    ts = ts - ts.mean(axis=1, keepdims=True)
+    std = ts.std(axis=1, ddof=ddof, keepdims=True)
+    std[std < np.finfo(np.float64).eps] = 1.0
+    ts /= std
+    return ts
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, KB on Linux
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import scipy.sparse
+
+import np_zstd
+
+WEIGHTINGS = ('uniform', 'boundary')
+LABEL_SUMS_NAME = 'label_sums.npz.zst'
+
+
+def adjacency_suffix(connectivity=6) -> str:
+    """Adjacency file suffix of ``prepare_atlas_neighbors.py``: ``_adj``, or ``_adj18`` / ``_adj26``."""
+    return '_adj' if connectivity == 6 else f'_adj{connectivity}'
+
+
+def load_adjacency(adj_dir: str, base_name: str, connectivity=6):
+    """
+    Label adjacency graph of one atlas as a symmetric CSR matrix indexed by label value.
+
+    Reads ``<base_name>_adj_csr.npz`` (weighted by shared-boundary voxel
+    counts, written by ``prepare_atlas_neighbors.py``) and falls back to the
+    ``<base_name>_adj.npy`` pair list with unit weights; 18/26-connectivity
+    files carry the connectivity in the suffix (``_adj26_csr.npz``).
+    """
+    suffix = adjacency_suffix(connectivity)
+    csr_path = os.path.join(adj_dir, base_name + suffix + '_csr.npz')
+    if os.path.exists(csr_path):
+        return scipy.sparse.load_npz(csr_path).tocsr()
+
+    pairs = np.asarray(np.load(os.path.join(adj_dir, base_name + suffix + '.npy')), dtype=np.int64).reshape(-1, 2)
+    n_labels = int(pairs.max()) + 1 if len(pairs) else 1
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    graph = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=(n_labels, n_labels))
+    graph.data[:] = 1  # duplicate pairs were summed
+    return graph
+
+
+class RegionSampler:
+    """
+    Draw connected sets of k ROIs from the adjacency graphs of one or more atlases.
+
+    A sample starts from one edge of the graph (uniformly, or proportionally to
+    the shared boundary size with ``weighting='boundary'``) and grows by
+    repeatedly stepping from a random member to a random neighbour (again
+    uniform or boundary-weighted) that is not in the set yet. Every step is
+    vectorized over the whole batch; with ``k=2`` and uniform weighting this
+    is the same distribution as drawing one pair from the adjacency list.
+
+    Parameters
+    ----------
+    graphs : dict
+        Atlas name -> symmetric CSR adjacency indexed by label value (see `load_adjacency`).
+    weighting : str
+        'uniform' or 'boundary'.
+    atlas_weights : dict or None
+        Atlas name -> relative probability of drawing from that atlas (default: uniform).
+    max_tries : int
+        Neighbour draws per growth step before a sample is restarted from a new edge.
+    """
+
+    def __init__(self, graphs: dict, weighting='uniform', atlas_weights=None, max_tries=32):
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f'weighting must be one of {WEIGHTINGS}, got {weighting!r}')
+        self.names = [name for name, g in graphs.items() if g.nnz]
+        if not self.names:
+            raise ValueError('No atlas has any adjacent ROI pair')
+        self.weighting = weighting
+        self.max_tries = max_tries
+
+        weights = np.array([1.0 if atlas_weights is None else float(atlas_weights.get(n, 0.0)) for n in self.names])
+        if weights.sum() <= 0:
+            raise ValueError('atlas_weights must give a positive weight to at least one atlas')
+        self.atlas_p = weights / weights.sum()
+
+        self._graphs = []
+        for name in self.names:
+            g = graphs[name].tocsr()
+            g.sort_indices()
+            upper = scipy.sparse.triu(g, k=1).tocoo()
+            w = upper.data.astype(np.float64)
+            self._graphs.append({
+                'indptr': g.indptr, 'indices': g.indices,
+                'degree': np.diff(g.indptr),
+                # Global running sum of the row weights, for vectorized weighted neighbour draws
+                'cum': np.cumsum(g.data, dtype=np.float64),
+                'edges': np.stack([upper.row, upper.col], axis=1).astype(np.int64),
+                'edge_cdf': np.cumsum(w) / w.sum(),
+            })
+
+    def _neighbours(self, g: dict, src: np.ndarray, rng) -> np.ndarray:
+        start, deg = g['indptr'][src], g['degree'][src]
+        if self.weighting == 'uniform':
+            pos = start + (rng.random(len(src)) * deg).astype(np.int64)
+        else:
+            before = np.where(start > 0, g['cum'][start - 1], 0.0)
+            total = g['cum'][start + deg - 1] - before
+            pos = np.searchsorted(g['cum'], before + rng.random(len(src)) * total, side='right')
+            pos = np.clip(pos, start, start + deg - 1)
+        return g['indices'][pos]
+
+    def _sample_atlas(self, g: dict, n: int, k: int, rng):
+        if self.weighting == 'uniform':
+            seed = rng.integers(len(g['edges']), size=n)
+        else:
+            seed = np.minimum(np.searchsorted(g['edge_cdf'], rng.random(n), side='right'), len(g['edges']) - 1)
+        members = np.zeros((n, k), dtype=np.int64)
+        members[:, :2] = g['edges'][seed]
+        valid = np.ones(n, dtype=bool)
+
+        for step in range(2, k):
+            pending = np.flatnonzero(valid)
+            for _ in range(self.max_tries):
+                src = members[pending, rng.integers(step, size=len(pending))]
+                cand = self._neighbours(g, src, rng)
+                ok = ~(members[pending, :step] == cand[:, None]).any(axis=1)
+                members[pending[ok], step] = cand[ok]
+                pending = pending[~ok]
+                if not len(pending):
+                    break
+            # Sets stuck in a component smaller than k (or unlucky) are redrawn by the caller
+            valid[pending] = False
+        return members, valid
+
+    def sample(self, n: int, k=2, rng=None):
+        """
+        Draw `n` connected k-ROI sets.
+
+        Returns
+        -------
+        atlas_idx : np.ndarray
+            (n,) index into `names` of the atlas of each sample.
+        members : np.ndarray
+            (n, k) int64 label values of the merged ROIs.
+        """
+        if k < 2:
+            raise ValueError(f'k must be >= 2, got {k}')
+        rng = rng if isinstance(rng, np.random.Generator) else np.random.default_rng(rng)
+
+        atlas_idx = rng.choice(len(self.names), size=n, p=self.atlas_p)
+        members = np.zeros((n, k), dtype=np.int64)
+        for a, g in enumerate(self._graphs):
+            rows = np.flatnonzero(atlas_idx == a)
+            for _ in range(100):
+                if not len(rows):
+                    break
+                drawn, valid = self._sample_atlas(g, len(rows), k, rng)
+                members[rows[valid]] = drawn[valid]
+                rows = rows[~valid]
+            if len(rows):
+                raise ValueError(f'Could not draw connected sets of {k} ROIs from atlas {self.names[a]}')
+        return atlas_idx, members
+
+
+def merged_means(sums: np.ndarray, counts: np.ndarray, members: np.ndarray, batch_size=4096, dtype=np.float64):
+    """
+    Mean time series of merged regions from a per-label sum table, in O(k * T) per region.
+
+    Parameters
+    ----------
+    sums : np.ndarray
+        (n_labels, T) per-label voxel sums, indexed by label value.
+    counts : np.ndarray
+        (n_labels,) voxels per label.
+    members : np.ndarray
+        (n, k) label values of each merged region (labels outside the table count as empty).
+
+    Returns
+    -------
+    ts : np.ndarray
+        (n, T) in `dtype`; regions without any voxel are all zeros.
+    """
+    members = np.asarray(members, dtype=np.int64)
+    if members.ndim == 1:
+        members = members[None]
+    in_table = members < len(counts)
+    members = np.where(in_table, members, 0)
+
+    out = np.zeros((len(members), sums.shape[1]), dtype=dtype)
+    for b0 in range(0, len(members), batch_size):
+        m, inside = members[b0:b0 + batch_size], in_table[b0:b0 + batch_size]
+        n = (counts[m] * inside).sum(axis=1)
+        total = (sums[m] * inside[:, :, None]).sum(axis=1)
+        np.divide(total, n[:, None], out=out[b0:b0 + batch_size], where=n[:, None] > 0)
+    return out
+
+
+def save_label_sums(file, tables: dict) -> None:
+    """
+    Save per-atlas label sum tables as one .npz.zst (float32 sums, int32 counts).
+
+    Parameters
+    ----------
+    file : str
+        Output path, conventionally ``<subject output dir>/label_sums.npz.zst``.
+    tables : dict
+        Atlas name -> ``(sums, counts)`` indexed by label value, as from
+        `roi_extract.label_sums_multi`.
+    """
+    arrays = {'atlases': np.array(list(tables))}
+    for i, (sums, counts) in enumerate(tables.values()):
+        arrays[f'sums_{i}'] = np.asarray(sums, dtype=np.float32)
+        arrays[f'counts_{i}'] = np.asarray(counts, dtype=np.int32)
+    np_zstd.savez(file, **arrays)
+
+
+class LabelSums:
+    """
+    Label sum tables of one subject, for drawing merged-region time series without voxel data.
+
+    Any merged region's mean series costs O(k * T), so a training loop can
+    draw fresh augmentations every epoch, e.g.::
+
+        sampler = RegionSampler({name: load_adjacency(adj_dir, name) for name in names})
+        sums = LabelSums.loads(shards.read_bytes(subject, LABEL_SUMS_NAME))
+        ts, atlas_idx, members = sums.sample(sampler, 256, k=3, rng=rng)
+    """
+
+    def __init__(self, tables: dict):
+        self.tables = tables
+
+    @classmethod
+    def _from_npz(cls, npz):
+        with npz:
+            names = [str(n) for n in npz['atlases']]
+            return cls({name: (npz[f'sums_{i}'], npz[f'counts_{i}']) for i, name in enumerate(names)})
+
+    @classmethod
+    def load(cls, file):
+        """Read a file written by `save_label_sums`."""
+        return cls._from_npz(np_zstd.load(file))
+
+    @classmethod
+    def loads(cls, data):
+        """Decode `save_label_sums` output held in memory (e.g. a tar shard member)."""
+        return cls._from_npz(np_zstd.loads(data))
+
+    @property
+    def names(self) -> list:
+        return list(self.tables)
+
+    @property
+    def n_timepoints(self) -> int:
+        return next(iter(self.tables.values()))[0].shape[1]
+
+    def regions(self, atlas: str, members, dtype=np.float32) -> np.ndarray:
+        """(n, T) mean series of the regions given by (n, k) label values of `atlas`."""
+        sums, counts = self.tables[atlas]
+        return merged_means(sums, counts, members, dtype=dtype)
+
+    def region(self, atlas: str, rois, dtype=np.float32) -> np.ndarray:
+        """(T,) mean series of the union of the labels `rois` of `atlas`."""
+        return self.regions(atlas, [list(rois)], dtype=dtype)[0]
+
+    def sample(self, sampler: RegionSampler, n: int, k=2, rng=None, dtype=np.float32):
+        """
+        Draw `n` connected k-ROI regions with `sampler` and return their series.
+
+        Returns
+        -------
+        ts : np.ndarray
+            (n, T) mean series.
+        atlas_idx, members : np.ndarray
+            As from `RegionSampler.sample` (`atlas_idx` indexes `sampler.names`).
+        """
+        missing = [name for name in sampler.names if name not in self.tables]
+        if missing:
+            raise KeyError(f'No label sums for atlases {missing}')
+        atlas_idx, members = sampler.sample(n, k=k, rng=rng)
+        ts = np.zeros((n, self.n_timepoints), dtype=dtype)
+        for a, name in enumerate(sampler.names):
+            rows = np.flatnonzero(atlas_idx == a)
+            if len(rows):
+                ts[rows] = self.regions(name, members[rows], dtype=dtype)
+        return ts, atlas_idx, members
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import glob
+import io
+import json
+import mmap
+import os
+import sys
+import tarfile
+import zlib
+
+import numpy as np
+
+import np_zstd
+
+_INDEX_SUFFIX = '.idx.json'
+_INDEX_VERSION = 1
+
+
+def index_path_for(tar_path: str) -> str:
+    return tar_path + _INDEX_SUFFIX
+
+
+def build_index(tar_path: str, index_path=None, write=True) -> dict:
+    """
+    Index a plain (uncompressed) tar of per-subject directories.
+
+    Every regular file ``<subject>/<member>`` is recorded as
+    ``[data offset, length, crc32]`` so it can later be read with one ranged
+    read. The index is written next to the tar as ``<tar>.idx.json`` unless
+    `write` is False.
+    """
+    subjects = {}
+    with tarfile.open(tar_path, 'r:') as tar, open(tar_path, 'rb') as _f, \
+            mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for info in tar:
+            if not info.isfile():
+                continue
+            subject, _, member = info.name.partition('/')
+            if not member:
+                continue
+            start, stop = info.offset_data, info.offset_data + info.size
+            subjects.setdefault(subject, {})[member] = [start, info.size, zlib.crc32(mm[start:stop])]
+
+    index = {
+        'version': _INDEX_VERSION,
+        'tar': os.path.basename(tar_path),
+        'size': os.path.getsize(tar_path),
+        'subjects': subjects,
+    }
+    if write:
+        index_path = index_path or index_path_for(tar_path)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(index_path + '.tmp', index_path)
+    return index
+
+
+def write_shard(tar_path: str, src_dir: str, subjects=None) -> dict:
+    """
+    Tar the subject directories of `src_dir` (no top-level dir, no compression) and index the result.
+
+    The tar is the same as ``tar -cf <tar_path> -C <src_dir> <subjects...>``, so
+    existing consumers keep working; the sidecar index adds random access.
+    """
+    if subjects is None:
+        subjects = sorted(d for d in os.listdir(src_dir) if os.path.isdir(os.path.join(src_dir, d)))
+
+    tmp_path = tar_path + '.tmp'
+    with tarfile.open(tmp_path, 'w', format=tarfile.GNU_FORMAT) as tar:
+        for subject in subjects:
+            tar.add(os.path.join(src_dir, subject), arcname=subject)
+    os.replace(tmp_path, tar_path)
+
+    return build_index(tar_path)
+
+
+class ShardReader:
+    """
+    Random access to the members of one indexed tar shard through mmap.
+
+    A sidecar index whose recorded tar size differs from the tar on disk (the
+    tar was rewritten after indexing) is stale: the tar is re-indexed, and the
+    sidecar rewritten where the directory is writable.
+    """
+
+    def __init__(self, tar_path: str, index_path=None, verify=False):
+        self.tar_path = tar_path
+        self.verify = verify
+
+        index_path = index_path or index_path_for(tar_path)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+            if self.index.get('version') == _INDEX_VERSION and self.index.get('size') != os.path.getsize(tar_path):
+                print(f'Stale index {index_path} ({self.index.get("size")} bytes recorded, tar is '
+                      f'{os.path.getsize(tar_path)} bytes), re-indexing {tar_path}', file=sys.stderr)
+                try:
+                    self.index = build_index(tar_path, index_path)
+                except OSError:
+                    self.index = build_index(tar_path, write=False)
+        else:
+            self.index = build_index(tar_path, write=False)
+        if self.index.get('version') != _INDEX_VERSION:
+            raise ValueError(f'Unsupported shard index version {self.index.get("version")} for {tar_path}')
+
+        self._f = open(tar_path, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self) -> None:
+        self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, subject) -> bool:
+        return subject in self.index['subjects']
+
+    def subjects(self) -> list:
+        return list(self.index['subjects'])
+
+    def members(self, subject: str) -> list:
+        return list(self.index['subjects'][subject])
+
+    def fingerprint(self, subject: str, member: str) -> str:
+        """Length and CRC32 of a member, e.g. to key caches of decoded members."""
+        _, length, crc = self.index['subjects'][subject][member]
+        return f'{length}:{crc}'
+
+    def read_bytes(self, subject: str, member: str) -> bytes:
+        offset, length, crc = self.index['subjects'][subject][member]
+        data = self._mm[offset:offset + length]
+        if self.verify and zlib.crc32(data) != crc:
+            raise ValueError(f'Checksum mismatch for {subject}/{member} in {self.tar_path}')
+        return data
+
+    def load(self, subject: str, member: str, **kwargs):
+        """Decode a .npy.zst/.npz.zst (via np_zstd) or plain .npy/.npz member."""
+        data = self.read_bytes(subject, member)
+        if member.endswith('.zst'):
+            return np_zstd.loads(data, **kwargs)
+        return np.load(io.BytesIO(data), **kwargs)
+
+
+class ShardSet:
+    """Subject-level view over one shard or a directory of shards (e.g. a local mirror of the remote tar dir)."""
+
+    def __init__(self, path: str, verify=False):
+        tar_paths = sorted(glob.glob(os.path.join(path, '*.tar'))) if os.path.isdir(path) else [path]
+        if not tar_paths:
+            raise ValueError(f'No .tar shards found in {path}')
+
+        self.shards = [ShardReader(p, verify=verify) for p in tar_paths]
+        self._where = {}
+        for shard in self.shards:
+            for subject in shard.subjects():
+                self._where.setdefault(subject, shard)
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, subject) -> bool:
+        return subject in self._where
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def subjects(self) -> list:
+        return list(self._where)
+
+    def members(self, subject: str) -> list:
+        return self._where[subject].members(subject)
+
+    def fingerprint(self, subject: str, member: str) -> str:
+        return self._where[subject].fingerprint(subject, member)
+
+    def read_bytes(self, subject: str, member: str) -> bytes:
+        return self._where[subject].read_bytes(subject, member)
+
+    def load(self, subject: str, member: str, **kwargs):
+        return self._where[subject].load(subject, member, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write, index and read tar shards of per-subject directories.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('write', help='Tar subject directories and write the sidecar index.')
+    p.add_argument('--src', '-s', required=True, help='Staging directory with one sub-directory per subject.')
+    p.add_argument('--out', '-o', required=True, help='Output .tar path (index goes to <out>.idx.json).')
+    p.add_argument('--subjects', type=str, default=None, help='Optional text file listing subjects to include.')
+
+    p = sub.add_parser('index', help='Write sidecar indexes for existing tars.')
+    p.add_argument('tars', nargs='+', help='Tar files.')
+
+    p = sub.add_parser('ls', help='List subjects, or the members of one subject.')
+    p.add_argument('path', help='Tar shard or directory of shards.')
+    p.add_argument('subject', nargs='?', default=None, help='Subject to list members of.')
+
+    p = sub.add_parser('get', help='Extract one member without unpacking the tar.')
+    p.add_argument('path', help='Tar shard or directory of shards.')
+    p.add_argument('subject', help='Subject ID.')
+    p.add_argument('member', help='Member path inside the subject directory.')
+    p.add_argument('--out', '-o', required=True, help='Output file path.')
+
+    p = sub.add_parser('verify', help='Check every member checksum.')
+    p.add_argument('path', help='Tar shard or directory of shards.')
+
+    args = parser.parse_args()
+
+    if args.command == 'write':
+        subjects = None
+        if args.subjects:
+            with open(args.subjects) as f:
+                subjects = [line.strip() for line in f if line.strip()]
+        index = write_shard(args.out, args.src, subjects)
+        print(f'Wrote {args.out}: {len(index["subjects"])} subjects')
+    elif args.command == 'index':
+        for tar_path in args.tars:
+            index = build_index(tar_path)
+            print(f'Indexed {tar_path}: {len(index["subjects"])} subjects')
+    elif args.command == 'ls':
+        with ShardSet(args.path) as shards:
+            for name in (shards.members(args.subject) if args.subject else shards.subjects()):
+                print(name)
+    elif args.command == 'get':
+        with ShardSet(args.path) as shards, open(args.out, 'wb') as f:
+            f.write(shards.read_bytes(args.subject, args.member))
+    elif args.command == 'verify':
+        with ShardSet(args.path, verify=True) as shards:
+            n = 0
+            for subject in shards.subjects():
+                for member in shards.members(subject):
+                    shards.read_bytes(subject, member)
+                    n += 1
+        print(f'{n} members OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,7 @@ Upload destination:
 Env (optional):
   TAR_DIR=./tars
   WORK_ROOT=./work_batches
+  SHARD_PY=./shard.py    # 若存在则为每个 tar 生成 <tar>.idx.json 随机访问索引并一起上传
   CLEANUP=1              # 上传成功后删除本地 tar（默认不删）；下载内容会在打包后必然清理
 EOF
 }
@@ -43,6 +44,7 @@ REMOTE_UPLOAD_DIR="/datasets/fMRI_rb_tar"
 
 TAR_DIR="${TAR_DIR:-./tars}"
 WORK_ROOT="${WORK_ROOT:-./work_batches}"
+SHARD_PY="${SHARD_PY:-./shard.py}"
 mkdir -p "$TAR_DIR" "$WORK_ROOT"
 
 TS="$(date +%Y%m%d_%H%M%S)"
@@ -124,7 +126,13 @@ while (( batch_start <= END_LINE )); do
   TARBALL_PATH="${ABS_TAR_DIR}/${TARBALL_BASENAME}"
 
   echo "Packing ${#SUCCEEDED_IDS[@]} subject directories into: ${TARBALL_PATH}"
-  tar -cf "$TARBALL_PATH" -C "$OUT_DIR" "${SUCCEEDED_IDS[@]}"
+  if [[ -f "$SHARD_PY" ]] && command -v python3 >/dev/null 2>&1; then
+    printf "%s\n" "${SUCCEEDED_IDS[@]}" > "${OUT_DIR}.subjects.txt"
+    python3 "$SHARD_PY" write --src "$OUT_DIR" --out "$TARBALL_PATH" --subjects "${OUT_DIR}.subjects.txt"
+    rm -f "${OUT_DIR}.subjects.txt"
+  else
+    tar -cf "$TARBALL_PATH" -C "$OUT_DIR" "${SUCCEEDED_IDS[@]}"
+  fi
 
   # 打包后立刻清理下载内容（必做）
   echo "Cleaning downloaded content for batch ${pack_tag}: rm -rf ${OUT_DIR}"
@@ -139,10 +147,15 @@ while (( batch_start <= END_LINE )); do
   else
     echo "Upload done. File ID: ${UPLOADED_ID}"
 
+    if [[ -f "${TARBALL_PATH}.idx.json" ]]; then
+      dx upload "${TARBALL_PATH}.idx.json" --path "${REMOTE_DEST}.idx.json" --parents --brief >/dev/null ||
+        echo "WARNING: index upload failed for ${TARBALL_BASENAME}" >&2
+    fi
+
     # 可选：上传成功后删本地 tar
     if [[ "${CLEANUP:-0}" == "1" ]]; then
       echo "Cleanup enabled: removing tar ${TARBALL_PATH}"
-      rm -f "$TARBALL_PATH"
+      rm -f "$TARBALL_PATH" "${TARBALL_PATH}.idx.json"
     fi
   fi
 
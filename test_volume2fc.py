@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""在合成数据上比较 volume2fc.py 的 native、nilearn 后端与多图谱提取的结果。"""
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from volume2fc import BACKENDS, extract_roi_time_series, extract_roi_time_series_multi
+
+pytest.importorskip('nilearn')
+
+SHAPE = (40, 48, 36, 120)
+N_ROIS = (50, 200)
+TOL = 1e-4
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    """int16 合成 fMRI（与 UKB rfMRI 相同）和含空标签、不连续标签编号的 atlas。"""
+    tmp = tmp_path_factory.mktemp('volume2fc')
+    rng = np.random.default_rng(0)
+    affine = np.diag([2.4, 2.4, 2.4, 1.0])
+
+    fmri_path = str(tmp / 'fmri.nii.gz')
+    data = rng.normal(1000, 50, size=SHAPE) + rng.normal(0, 20, size=SHAPE[:3] + (1,))
+    nib.save(nib.Nifti1Image(data.astype(np.int16), affine), fmri_path)
+
+    atlas_paths = []
+    for n in N_ROIS:
+        labels = rng.integers(0, n + 1, size=SHAPE[:3]) * 3  # 不连续的标签编号
+        labels[labels == 3] = 0  # 一个完全为空的标签
+        atlas_paths.append(str(tmp / f'atlas{n}.nii.gz'))
+        nib.save(nib.Nifti1Image(labels.astype(np.int16), affine), atlas_paths[-1])
+    return fmri_path, atlas_paths
+
+
+@pytest.fixture(scope='module')
+def reference(synthetic):
+    """nilearn 不分块（float64）的结果作为参考。"""
+    fmri_path, atlas_paths = synthetic
+    return [extract_roi_time_series(fmri_path, atlas_path, backend='nilearn', return_labels=True)
+            for atlas_path in atlas_paths]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('chunk_size', [None, 32])
+def test_backends_match_nilearn(synthetic, reference, backend, chunk_size):
+    fmri_path, atlas_paths = synthetic
+    for atlas_path, (ref_labels, ref) in zip(atlas_paths, reference):
+        labels, ts = extract_roi_time_series(fmri_path, atlas_path, chunk_size=chunk_size, backend=backend,
+                                             return_labels=True)
+        assert ts.dtype == np.float32
+        assert ts.shape == ref.shape
+        np.testing.assert_array_equal(labels, ref_labels)
+        assert np.abs(ts - ref).max() < TOL
+
+
+def test_multi_matches_nilearn(synthetic, reference):
+    fmri_path, atlas_paths = synthetic
+    multi = extract_roi_time_series_multi(fmri_path, atlas_paths, return_labels=True)
+    assert len(multi) == len(atlas_paths)
+    for (labels, ts), (ref_labels, ref) in zip(multi, reference):
+        np.testing.assert_array_equal(labels, ref_labels)
+        assert ts.shape == ref.shape
+        assert np.abs(ts - ref).max() < TOL
+
+
+def test_unknown_backend(synthetic):
+    fmri_path, atlas_paths = synthetic
+    with pytest.raises(ValueError):
+        extract_roi_time_series(fmri_path, atlas_paths[0], backend='fsl')
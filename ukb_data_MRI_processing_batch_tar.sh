@@ -190,6 +190,8 @@ process_subject() {
 # MAIN PIPELINE
 # ==============================
 
+wget -q https://raw.githubusercontent.com/OneMore1/UKB_utils/master/np_zstd.py
+wget -q https://raw.githubusercontent.com/OneMore1/UKB_utils/master/moments.py
 wget -q https://raw.githubusercontent.com/OneMore1/UKB_utils/master/mri_t1_mni2npyzst.py
 
 TXT_FILE="${3:-fMRI_20227_id.txt}"
@@ -217,7 +219,7 @@ done < <(
 final_flush
 
 # 清理环境
-rm -f mri_t1_mni2npyzst.py "$TXT_FILE"
+rm -f np_zstd.py moments.py mri_t1_mni2npyzst.py "$TXT_FILE"
 rm -rf "${STAGE_ROOT}"
 
 echo "All batch tasks finished!"
@@ -18,10 +18,14 @@ if [[ ! -f "$TXT_FILE" ]]; then
 fi
 
 SCRIPT_NAME="atlas_concat.py"
-if [[ ! -f "$SCRIPT_NAME" ]]; then
-    echo "Getting $SCRIPT_NAME from dx folder..."
-    dx download ${DX_PROJECT_CONTEXT_ID}:/codes/${SCRIPT_NAME} -o ${SCRIPT_NAME}
-fi
+# atlas_concat.py imports batch_runner.py and cohort_store.py
+SCRIPT_DEPS=("batch_runner.py" "cohort_store.py")
+for script in "$SCRIPT_NAME" "${SCRIPT_DEPS[@]}"; do
+    if [[ ! -f "$script" ]]; then
+        echo "Getting $script from dx folder..."
+        dx download ${DX_PROJECT_CONTEXT_ID}:/codes/${script} -o ${script}
+    fi
+done
 
 prepare_subject_data() {
     local base_path="$1"
@@ -116,5 +120,5 @@ sed -n "${START_LINE},${END_LINE}p" "$TXT_FILE" | while IFS= read -r sub_file_id
   process_atlas "$BASE_PATH" "$sub_id" "$session" || { echo "skip $sub_id $session"; continue; }
 done
 
-rm -f "$SCRIPT_NAME"
+rm -f "$SCRIPT_NAME" "${SCRIPT_DEPS[@]}"
 rm -f "$TXT_FILE"
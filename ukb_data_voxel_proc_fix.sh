@@ -29,6 +29,8 @@ SUB_LIST="voxel_fix_list_dedup.txt"
 dx download --no-progress "voxel_fix_list_dedup.txt"
 
 SCRIPT_NAME="nifti_mask_proc.py"
+wget https://raw.githubusercontent.com/OneMore1/UKB_utils/master/np_zstd.py
+wget https://raw.githubusercontent.com/OneMore1/UKB_utils/master/moments.py
 wget https://raw.githubusercontent.com/OneMore1/UKB_utils/master/$SCRIPT_NAME
 
 prepare_subject_data() {
@@ -130,7 +132,7 @@ sed -n "${START_LINE},${END_LINE}p" "$SUB_LIST" | while IFS= read -r sub_file_id
   }
 done
 
-rm "$SCRIPT_NAME"
+rm np_zstd.py moments.py "$SCRIPT_NAME"
 rm "$SUB_LIST"
 
 tar -cvf fMRI_masked_s${START_LINE}_e${END_LINE}.tar fMRI_masked/
@@ -58,6 +58,15 @@ atlas_list_vox2fc=(
   Tian_Subcortex_S3_3T
 )
 
+# Atlas warping into example_func space: "applywarp" (FSL, one call per atlas) or "python"
+# (warp_atlas.py, loads the inverse warp once for all atlases). Keep applywarp until
+# "warp_atlas.py --compare_fsl" agrees with it on real subjects.
+ATLAS_WARP="${ATLAS_WARP:-applywarp}"
+if [[ "${ATLAS_WARP}" != "applywarp" && "${ATLAS_WARP}" != "python" ]]; then
+  echo "ATLAS_WARP must be applywarp or python, got ${ATLAS_WARP}."
+  exit 1
+fi
+
 process_rfMRI() {
   local sub_file_idx="$1"
   local base_path="$2"
@@ -119,25 +128,49 @@ process_rfMRI() {
   mkdir -p "${SUBJECT_DIR}/atlas_data"
   mkdir -p "${SUBJECT_DIR}/voxel2atlas/${sub_file_idx}"
 
+  local atlas_inputs=() atlas_outputs=() vox2fc_atlases=() vox2fc_outputs=()
   for atlas in "${atlas_list[@]}"; do
-    echo "[${sub_file_idx}] Processing atlas: ${atlas}..."
-
-    applywarp \
-      -i ./roi_augmentation/atlas_data/${atlas}.nii.gz \
-      -r "${SUBJECT_DIR}/fMRI/rfMRI.ica/example_func.nii.gz" \
-      -w "${SUBJECT_DIR}/fMRI/rfMRI.ica/reg/standard2example_func_warp.nii" \
-      -o "${SUBJECT_DIR}/atlas_data/${atlas}.nii" \
-      --interp=nn
+    atlas_inputs+=("./roi_augmentation/atlas_data/${atlas}.nii.gz")
+    atlas_outputs+=("${SUBJECT_DIR}/atlas_data/${atlas}.nii")
+
+    if [[ "${ATLAS_WARP}" == "applywarp" ]]; then
+      echo "[${sub_file_idx}] Processing atlas: ${atlas}..."
+      applywarp \
+        -i "./roi_augmentation/atlas_data/${atlas}.nii.gz" \
+        -r "${SUBJECT_DIR}/fMRI/rfMRI.ica/example_func.nii.gz" \
+        -w "${SUBJECT_DIR}/fMRI/rfMRI.ica/reg/standard2example_func_warp.nii" \
+        -o "${SUBJECT_DIR}/atlas_data/${atlas}.nii" \
+        --interp=nn
+    fi
 
     if [[ " ${atlas_list_vox2fc[*]} " == *" ${atlas} "* ]]; then
-      echo "[${sub_file_idx}] Generating voxel-to-FC for atlas: ${atlas}..."
-      python3 volume2fc.py \
-        --fmri "${SUBJECT_DIR}/fMRI/rfMRI.nii.gz" \
-        --atlas "${SUBJECT_DIR}/atlas_data/${atlas}.nii" \
-        --out-npy "${SUBJECT_DIR}/voxel2atlas/${sub_file_idx}/vox2fc_${atlas}.npy"
+      vox2fc_atlases+=("${SUBJECT_DIR}/atlas_data/${atlas}.nii")
+      vox2fc_outputs+=("${SUBJECT_DIR}/voxel2atlas/${sub_file_idx}/vox2fc_${atlas}.npy")
     fi
   done
 
+  # ATLAS_WARP=python: one warp_atlas call loads the inverse warp once and nearest-neighbour
+  # warps every atlas (meant to reproduce one "applywarp --interp=nn" per atlas)
+  if [[ "${ATLAS_WARP}" == "python" ]]; then
+    echo "[${sub_file_idx}] Warping ${#atlas_inputs[@]} atlases..."
+    python3 warp_atlas.py \
+      -w "${SUBJECT_DIR}/fMRI/rfMRI.ica/reg/standard2example_func_warp.nii" \
+      -r "${SUBJECT_DIR}/fMRI/rfMRI.ica/example_func.nii.gz" \
+      -i "${atlas_inputs[@]}" \
+      -o "${atlas_outputs[@]}" \
+      --cache "${SUBJECT_DIR}/fMRI/rfMRI.ica/reg/standard2example_func_index.npz.zst"
+  fi
+
+  # One volume2fc call reads rfMRI.nii.gz once for all voxel-to-FC atlases
+  if ((${#vox2fc_atlases[@]})); then
+    echo "[${sub_file_idx}] Generating voxel-to-FC for ${#vox2fc_atlases[@]} atlases..."
+    python3 volume2fc.py \
+      --fmri "${SUBJECT_DIR}/fMRI/rfMRI.nii.gz" \
+      --atlas "${vox2fc_atlases[@]}" \
+      --out-npy "${vox2fc_outputs[@]}" \
+      --fc correlation
+  fi
+
   python3 roi_augmentation/augment_rois.py \
     --fmri "${SUBJECT_DIR}/fMRI/rfMRI.nii.gz" \
     --adjacency_dir "./roi_augmentation/atlas_data/adjacency" \
@@ -1,62 +1,266 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
-from nilearn.maskers import NiftiLabelsMasker
 
+import np_zstd
+from roi_extract import extract_multi, iter_time_chunks, load_atlas, load_fmri, peak_rss_mb, roi_means, standardize
 
-def extract_roi_time_series(fmri_path: str, atlas_path: str) -> np.ndarray:
+
+BACKENDS = ('native', 'nilearn')
+
+
+def extract_roi_time_series(fmri_path: str, atlas_path: str, chunk_size=None, backend='native',
+                            return_labels=False):
     """使用 3D atlas 从 4D fMRI 中提取 ROI 时间序列。
 
     Args:
         fmri_path: 4D fMRI NIfTI 路径
         atlas_path: 3D atlas NIfTI 路径（例如合并后的 150 ROI 图谱）
+        chunk_size: 每次读取的时间点数；为 None/0 时一次性读入整个序列。
+            分块时以 float32 逐块提取 ROI 均值，最后统一标准化，峰值内存只取决于块大小
+        backend: 'native'（默认，NumPy 预计算体素索引 + reduceat，float32）
+            或 'nilearn'（NiftiLabelsMasker，作为参考实现）。两者结果一致
+        return_labels: 为 True 时同时返回每行对应的 atlas 标签值（升序）
 
     Returns:
         roi_time_series: np.ndarray, shape (n_rois, n_timepoints)
+        （return_labels=True 时返回 (labels, roi_time_series)）
     """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend 必须是 {BACKENDS} 之一，而不是 {backend!r}")
+
     print(f"\n加载功能数据: {fmri_path}")
     print(f"加载图谱: {atlas_path}")
 
-    fmri_img = nib.load(fmri_path)
+    if backend == 'native':
+        fmri_img = load_fmri(fmri_path)
+        print("正在提取 ROI 时间序列 (降维, native)...")
+        labels, roi_time_series = roi_means(fmri_img, load_atlas(atlas_path, fmri_img), chunk_size=chunk_size)
+    else:
+        roi_time_series = _extract_nilearn(fmri_path, atlas_path, chunk_size)
+        labels = np.unique(np.rint(np.asarray(nib.load(atlas_path).dataobj)).astype(np.intp))
+        labels = labels[labels > 0]
+
+    print(f"提取完成，ROI 时间序列形状: {roi_time_series.shape} (ROI, timepoints)")
+    return (labels, roi_time_series) if return_labels else roi_time_series
+
+
+def _extract_nilearn(fmri_path: str, atlas_path: str, chunk_size=None) -> np.ndarray:
+    """NiftiLabelsMasker 参考实现，返回 (n_rois, n_timepoints) float32。"""
+    fmri_img = load_fmri(fmri_path) if chunk_size else nib.load(fmri_path)
     atlas_img = nib.load(atlas_path)
 
+    # nilearn 导入耗时数秒，只在真正需要时导入
+    from nilearn.maskers import NiftiLabelsMasker
+
     # 这里假设 atlas 已经是和 fMRI 对齐/重采样好的（例如通过 combine_atlas.py 之后得到的 merged_atlas150）
     print("初始化 NiftiLabelsMasker...")
     masker = NiftiLabelsMasker(
         labels_img=atlas_img,
-        standardize=True,
+        # 分块时每块只求均值，标准化需要整条序列的均值/方差，留到拼接之后
+        standardize=not chunk_size,
         strategy='mean',
-        verbose=1,
+        verbose=0 if chunk_size else 1,
     )
 
-    print("正在提取 ROI 时间序列 (降维)...")
-    roi_time_series_t = masker.fit_transform(fmri_img)  # (n_timepoints, n_rois)
+    print("正在提取 ROI 时间序列 (降维, nilearn)...")
+    if chunk_size:
+        masker.fit()
+        # 参考实现按 float64 分块，与不分块时 nilearn 的精度一致
+        parts = [masker.transform(nib.Nifti1Image(chunk, fmri_img.affine, fmri_img.header))
+                 for _, chunk in iter_time_chunks(fmri_img, chunk_size, dtype=np.float64)]
+        roi_time_series_t = standardize(np.concatenate(parts).T).T
+    else:
+        roi_time_series_t = masker.fit_transform(fmri_img)  # (n_timepoints, n_rois)
 
     # 转置成 (n_rois, n_timepoints)
-    roi_time_series = roi_time_series_t.T.astype(np.float32)
-    print(f"提取完成，ROI 时间序列形状: {roi_time_series.shape} (ROI, timepoints)")
-    return roi_time_series
+    return roi_time_series_t.T.astype(np.float32)
+
+
+def extract_roi_time_series_multi(fmri_path: str, atlas_paths: list, chunk_size=64, return_labels=False) -> list:
+    """一次读取 fMRI，同时提取多个 atlas 的 ROI 时间序列。
+
+    所有 atlas 合并为一个稀疏的标签分配矩阵，每个时间块只做一次矩阵乘法；
+    结果与逐个 atlas 调用 `extract_roi_time_series`（NiftiLabelsMasker, standardize=True,
+    strategy='mean'）一致，但解压和读取 fMRI 的开销不再随 atlas 数量增长。
+
+    Returns:
+        与 atlas_paths 顺序对应的 list，每项 shape (n_rois, n_timepoints)，float32
+        （return_labels=True 时每项为 (labels, roi_time_series)）
+    """
+    print(f"\n加载功能数据: {fmri_path}")
+    fmri_img = load_fmri(fmri_path)
+    atlases = {}
+    for path in atlas_paths:
+        print(f"加载图谱: {path}")
+        atlases[path] = load_atlas(path, fmri_img)
+
+    print(f"正在提取 {len(atlases)} 个图谱的 ROI 时间序列 (单次读取)...")
+    out = extract_multi(fmri_img, atlases, chunk_size=chunk_size)
+    return [out[path] if return_labels else out[path][1] for path in atlas_paths]
+
+
+def ledoit_wolf_shrinkage(ts: np.ndarray) -> np.ndarray:
+    """Ledoit-Wolf 收缩系数（与 sklearn.covariance.ledoit_wolf_shrinkage 相同的估计）。
+
+    Args:
+        ts: (..., n_rois, n_timepoints)，已按时间去均值
+
+    Returns:
+        shape (...) 的收缩系数，取值 [0, 1]
+    """
+    n, t = ts.shape[-2:]
+    x2 = ts ** 2
+    emp_cov_trace = x2.sum(axis=-1) / t
+    mu = emp_cov_trace.sum(axis=-1) / n
+    beta_ = (x2 @ x2.swapaxes(-1, -2)).sum(axis=(-2, -1))
+    delta_ = ((ts @ ts.swapaxes(-1, -2)) ** 2).sum(axis=(-2, -1)) / t ** 2
+    beta = (beta_ / t - delta_) / (n * t)
+    delta = (delta_ - 2 * mu * emp_cov_trace.sum(axis=-1) + n * mu ** 2) / n
+    beta = np.minimum(beta, delta)
+    return np.where(delta > 0, beta / np.where(delta > 0, delta, 1), 0.0)
+
+
+def connectivity(roi_ts: np.ndarray, kind='correlation', shrinkage=None, fisher_z=False) -> np.ndarray:
+    """由 ROI 时间序列计算功能连接矩阵。
+
+    时间序列先按 ROI z-score，Pearson 相关即一次（批量）矩阵乘法 Z Z^T / (T - 1)，
+    前面的维度作为 batch 交给 BLAS（例如多个被试堆叠成 (n_subjects, n_rois, T)）。
+
+    Args:
+        roi_ts: (..., n_rois, n_timepoints)
+        kind: 'correlation'（Pearson 相关）或 'partial'（偏相关，由收缩后相关矩阵的逆得到）
+        shrinkage: None（不收缩）、[0, 1] 的浮点数，或 'auto'（Ledoit-Wolf 估计）。
+            相关矩阵收缩为 (1 - a) R + a I；kind='partial' 且未指定时使用 'auto'，
+            因为 ROI 数多于时间点（如 Schaefer-1000）时 R 不可逆
+        fisher_z: 是否做 Fisher z 变换 arctanh(r)（对角线置 0）
+
+    Returns:
+        (..., n_rois, n_rois) float64
+    """
+    if kind not in ('correlation', 'partial'):
+        raise ValueError(f"kind 必须是 'correlation' 或 'partial'，而不是 {kind!r}")
+    if kind == 'partial' and shrinkage is None:
+        shrinkage = 'auto'
+
+    z = np.asarray(roi_ts, dtype=np.float64)
+    z = z - z.mean(axis=-1, keepdims=True)
+    t = z.shape[-1]
+    std = np.sqrt((z ** 2).sum(axis=-1, keepdims=True) / (t - 1))
+    std[std < np.finfo(np.float64).eps] = 1.0
+    z /= std
+
+    fc = z @ z.swapaxes(-1, -2) / (t - 1)
+    eye = np.eye(fc.shape[-1], dtype=bool)
+    if shrinkage is not None:
+        alpha = ledoit_wolf_shrinkage(z) if shrinkage == 'auto' else np.asarray(float(shrinkage))
+        alpha = alpha[..., None, None]
+        fc = (1 - alpha) * fc + alpha * eye
+
+    if kind == 'partial':
+        precision = np.linalg.inv(fc)
+        d = np.sqrt(np.diagonal(precision, axis1=-2, axis2=-1))
+        fc = -precision / (d[..., :, None] * d[..., None, :])
+
+    fc[..., eye] = 1.0
+    if fisher_z:
+        fc = np.arctanh(np.clip(fc, -1 + 1e-7, 1 - 1e-7))
+        fc[..., eye] = 0.0
+    return fc
+
+
+def pack_upper(fc: np.ndarray) -> np.ndarray:
+    """取 (..., n, n) 矩阵的上三角（不含对角线），按行展开为 (..., n * (n - 1) / 2)。"""
+    rows, cols = np.triu_indices(fc.shape[-1], k=1)
+    return fc[..., rows, cols]
+
+
+def unpack_upper(packed: np.ndarray, n_rois: int, diagonal=1.0) -> np.ndarray:
+    """`pack_upper` 的逆：还原对称矩阵，对角线填 `diagonal`。"""
+    rows, cols = np.triu_indices(n_rois, k=1)
+    fc = np.full(packed.shape[:-1] + (n_rois, n_rois), diagonal, dtype=packed.dtype)
+    fc[..., rows, cols] = packed
+    fc[..., cols, rows] = packed
+    return fc
+
+
+def save_fc(path: str, fc: np.ndarray, labels: np.ndarray, kind='correlation', fisher_z=False,
+            dtype=np.float16) -> None:
+    """只保存上三角（`pack_upper`）和 ROI 顺序（atlas 标签值），用 np_zstd 压缩为 .npz.zst。"""
+    np_zstd.savez(path, fc=pack_upper(fc).astype(dtype), labels=np.asarray(labels, dtype=np.int32),
+                  kind=np.array(kind), fisher_z=np.array(fisher_z))
+
+
+def load_fc(path: str, dense=True):
+    """读取 `save_fc` 的输出。
+
+    Returns:
+        (fc, labels, meta)：dense=True 时 fc 为 (n_rois, n_rois) float32，否则为打包的上三角；
+        meta 为 {'kind', 'fisher_z'}
+    """
+    with np_zstd.load(path) as npz:
+        labels = npz['labels']
+        fc = npz['fc']
+        meta = {'kind': str(npz['kind']), 'fisher_z': bool(npz['fisher_z'])}
+    if dense:
+        fc = unpack_upper(fc.astype(np.float32), len(labels), diagonal=0.0 if meta['fisher_z'] else 1.0)
+    return fc, labels, meta
+
+
+def default_fc_path(out_npy: str) -> str:
+    base = out_npy[:-len('.npy')] if out_npy.endswith('.npy') else out_npy
+    return base + '_fc.npz.zst'
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description="从 4D fMRI 和 3D atlas 计算 ROI×time 序列，并保存为 .npy 和可视化图像。")
+        description="从 4D fMRI 和 3D atlas 计算 ROI×time 序列，并保存为 .npy（可选同时保存 FC）。")
     parser.add_argument('--fmri', default='/mnt/dataset4/wangmo/fMRI_ukb/rfMRI.nii.gz',
                         help='4D fMRI NIfTI 路径，例如 /path/to/rfMRI.nii.gz')
-    parser.add_argument('--atlas', default='merged_atlas150.nii.gz',
-                        help='3D atlas NIfTI 路径（默认: merged_atlas150.nii.gz）')
-    parser.add_argument('--out-npy', default='roi_time_series150.npy',
-                        help='输出 ROI×time numpy 文件名（默认: roi_time_series150.npy）')
-    parser.add_argument('--out-fig', default='roi_matrix_heatmap.png',
-                        help='输出 ROI 时间序列热力图文件名（默认: roi_matrix_heatmap.png）')
+    parser.add_argument('--atlas', nargs='+', default=['merged_atlas150.nii.gz'],
+                        help='3D atlas NIfTI 路径，可给多个（默认: merged_atlas150.nii.gz）')
+    parser.add_argument('--out-npy', nargs='+', default=['roi_time_series150.npy'],
+                        help='输出 ROI×time numpy 文件名，与 --atlas 一一对应（默认: roi_time_series150.npy）')
+    parser.add_argument('--chunk_size', type=int, default=64,
+                        help='每块读取的时间点数，限制峰值内存（0: 一次性读入整个序列）')
+    parser.add_argument('--backend', choices=BACKENDS, default='native',
+                        help='ROI 提取后端：native（NumPy，默认）或 nilearn（NiftiLabelsMasker 参考实现）')
+    parser.add_argument('--fc', choices=['none', 'correlation', 'partial'], default='none',
+                        help='同时计算并保存功能连接矩阵（只存上三角）：none（默认）、correlation 或 partial')
+    parser.add_argument('--out-fc', nargs='+', default=None,
+                        help='FC 输出文件名，与 --atlas 一一对应（默认: <out-npy 去掉 .npy>_fc.npz.zst）')
+    parser.add_argument('--shrinkage', default=None,
+                        help="相关矩阵收缩系数：[0, 1] 的数值或 auto（Ledoit-Wolf）；partial 默认 auto")
+    parser.add_argument('--fisher_z', action='store_true', help='保存 Fisher z 变换后的 FC')
+    parser.add_argument('--fc_dtype', choices=['float16', 'float32'], default='float16', help='FC 保存精度')
     args = parser.parse_args()
 
-    roi_ts = extract_roi_time_series(args.fmri, args.atlas)
-    np.save(args.out_npy, roi_ts)
-    print(f"ROI 时间序列已保存到 {args.out_npy}")
+    if len(args.atlas) != len(args.out_npy):
+        parser.error('--atlas 与 --out-npy 的数量必须相同')
+
+    out_fc = args.out_fc or [default_fc_path(p) for p in args.out_npy]
+    if len(out_fc) != len(args.atlas):
+        parser.error('--atlas 与 --out-fc 的数量必须相同')
+
+    if len(args.atlas) == 1 or args.backend == 'nilearn':
+        # nilearn 参考实现没有多图谱版本，逐个图谱提取
+        results = [extract_roi_time_series(args.fmri, atlas, chunk_size=args.chunk_size,
+                                           backend=args.backend, return_labels=True) for atlas in args.atlas]
+    else:
+        results = extract_roi_time_series_multi(args.fmri, args.atlas, chunk_size=args.chunk_size,
+                                                return_labels=True)
+
+    for (labels, roi_ts), out_npy, fc_path in zip(results, args.out_npy, out_fc):
+        np.save(out_npy, roi_ts)
+        print(f"ROI 时间序列已保存到 {out_npy}")
+
+        if args.fc != 'none':
+            fc = connectivity(roi_ts, kind=args.fc, shrinkage=args.shrinkage, fisher_z=args.fisher_z)
+            save_fc(fc_path, fc, labels, kind=args.fc, fisher_z=args.fisher_z, dtype=np.dtype(args.fc_dtype))
+            print(f"功能连接矩阵 ({args.fc}, {fc.shape[0]} ROI) 已保存到 {fc_path}")
+    print(f"峰值内存 (RSS): {peak_rss_mb():.0f} MB")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import os
+import time
+
+import nibabel as nib
+import numpy as np
+
+import np_zstd
+
+# NIfTI intent codes of FSL warp files stored as spline/DCT coefficients rather than as a field
+_COEF_INTENTS = (2007, 2008, 2009, 2016, 2017)
+
+
+def fsl_vox2mm(shape, zooms, flip) -> np.ndarray:
+    """
+    4x4 voxel -> FSL "scaled mm" matrix, the coordinate system of FSL warp fields.
+
+    FSL coordinates are voxel indices times voxel size; the origin of the
+    s/qform is ignored and images stored with a positive determinant
+    (neurological storage, `flip`) have their x axis reversed. FSL's MNI152
+    templates are radiological and keep it.
+    """
+    m = np.diag([float(z) for z in zooms[:3]] + [1.0])
+    if flip:
+        reverse_x = np.eye(4)
+        reverse_x[0, 0], reverse_x[0, 3] = -1.0, shape[0] - 1
+        m = m @ reverse_x
+    return m
+
+
+def _grid_of(img) -> tuple:
+    """Hashable (nx, ny, nz, dx, dy, dz, flip) geometry of an image as far as FSL coordinates are concerned."""
+    flip = np.linalg.det(img.affine[:3, :3]) > 0
+    return tuple(int(n) for n in img.shape[:3]) + tuple(float(z) for z in img.header.get_zooms()[:3]) + (float(flip),)
+
+
+def _warp_digest(warp_path, absolute) -> str:
+    """SHA-1 of the warp file contents and the --abs setting, to tell stale index map caches apart."""
+    h = hashlib.sha1(b'abs' if absolute else b'rel')
+    with open(warp_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _vox2mm_of(img) -> np.ndarray:
+    grid = _grid_of(img)
+    return fsl_vox2mm(grid[:3], grid[3:6], grid[6])
+
+
+def load_displacement(warp_img, absolute=False) -> np.ndarray:
+    """
+    (X, Y, Z, 3) float32 relative displacement (FSL mm) of a warp field image.
+
+    Absolute fields (``applywarp --abs``) are converted by subtracting the FSL
+    coordinates of each voxel.
+    """
+    if int(warp_img.header['intent_code']) in _COEF_INTENTS:
+        raise ValueError('Warp file holds spline coefficients; convert it to a field first '
+                         '(fnirtfileutils -i coef -r ref -o field)')
+    data = np.asarray(warp_img.dataobj, dtype=np.float32)
+    if data.ndim == 5:
+        data = data[:, :, :, 0, :]
+    if data.ndim != 4 or data.shape[3] != 3:
+        raise ValueError(f'Expected a (X, Y, Z, 3) warp field, got shape {data.shape}')
+    if absolute:
+        m = _vox2mm_of(warp_img)
+        ijk = np.indices(data.shape[:3], dtype=np.float32)
+        for a in range(3):
+            data[..., a] -= m[a, a] * ijk[a] + m[a, 3]
+    return data
+
+
+class AtlasWarper:
+    """
+    Nearest-neighbour resampling of label volumes through one FSL warp field.
+
+    Follows FSL's ``applywarp -i atlas -r ref -w warp --interp=nn`` for many
+    atlases at the cost of a single field load (check it against applywarp on
+    real fields with `compare_fsl` / ``--compare_fsl``): the standard-space position
+    of every reference voxel (``ref voxel -> FSL mm + displacement``) is
+    computed once, each distinct atlas grid turns it into a flat index map
+    (FSL rounding, ``floor(x + 0.5)``; outside the atlas -> 0), and each atlas
+    is then one `np.take`.
+
+    Parameters
+    ----------
+    warp_path : str
+        Warp field on (or resampled to) the reference grid, e.g. the
+        ``standard2example_func_warp`` written by ``invwarp``.
+    ref_path : str
+        Reference image defining the output grid (``example_func``).
+    absolute : bool
+        The field holds absolute positions (``--abs``); ``invwarp`` writes relative ones.
+    cache : str or None
+        ``.npz.zst`` index map cache. Maps found there are reused without
+        decoding the warp, as long as the cache was written for the same
+        reference grid and the same warp file contents (SHA-1, checked on
+        load); `save_cache` writes the maps computed so far.
+    """
+
+    def __init__(self, warp_path, ref_path, absolute=False, cache=None):
+        self.warp_path, self.absolute = warp_path, absolute
+        self.ref = nib.load(ref_path)
+        self.ref_shape = tuple(int(n) for n in self.ref.shape[:3])
+        self._positions = None
+        self._maps = {}
+        self._dirty = False
+        if cache is not None and os.path.exists(cache):
+            self.load_cache(cache)
+
+    @property
+    def positions(self) -> np.ndarray:
+        """(N, 3) float64 FSL mm positions in atlas space of the reference voxels (Fortran order)."""
+        if self._positions is None:
+            warp_img = nib.load(self.warp_path)
+            disp = load_displacement(warp_img, absolute=self.absolute)
+            ijk = np.indices(self.ref_shape, dtype=np.float64).reshape(3, -1, order='F')
+            m = _vox2mm_of(self.ref)
+            mm = m[:3, :3] @ ijk + m[:3, 3:]
+            if disp.shape[:3] == self.ref_shape and _grid_of(warp_img)[:6] == _grid_of(self.ref)[:6]:
+                d = disp.reshape(-1, 3, order='F').T
+            else:
+                # Field on another grid: sample it trilinearly at the reference positions, as applywarp does
+                from scipy.ndimage import map_coordinates
+                inv = np.linalg.inv(_vox2mm_of(warp_img))
+                coords = inv[:3, :3] @ mm + inv[:3, 3:]
+                d = np.stack([map_coordinates(disp[..., a], coords, order=1, mode='nearest') for a in range(3)])
+            self._positions = (mm + d).T
+        return self._positions
+
+    def index_map(self, grid) -> np.ndarray:
+        """
+        int32 flat (Fortran order) atlas index of every reference voxel for an atlas grid.
+
+        Voxels mapping outside the atlas point one past its last voxel, where
+        `warp` keeps a zero.
+        """
+        index = self._maps.get(grid)
+        if index is None:
+            shape = grid[:3]
+            inv = np.linalg.inv(fsl_vox2mm(shape, grid[3:6], grid[6]))
+            vox = np.floor(self.positions @ inv[:3, :3].T + inv[:3, 3] + 0.5)
+            inside = np.all((vox >= 0) & (vox < shape), axis=1)
+            vox = vox.astype(np.int64)
+            flat = vox[:, 0] + shape[0] * (vox[:, 1] + shape[1] * vox[:, 2])
+            index = np.where(inside, flat, int(np.prod(shape))).astype(np.int32)
+            self._maps[grid] = index
+            self._dirty = True
+        return index
+
+    def warp(self, atlas_img) -> np.ndarray:
+        """Atlas labels resampled onto the reference grid, in the atlas dtype."""
+        data = np.asarray(atlas_img.dataobj)
+        if data.ndim != 3:
+            raise ValueError(f'Expected a 3D label volume, got shape {data.shape}')
+        flat = np.append(data.ravel(order='F'), np.zeros(1, dtype=data.dtype))
+        return flat.take(self.index_map(_grid_of(atlas_img))).reshape(self.ref_shape, order='F')
+
+    def warp_file(self, atlas_path, output_path) -> np.ndarray:
+        """Warp one atlas file and save it with the reference geometry (like applywarp ``-o``)."""
+        atlas_img = nib.load(atlas_path)
+        out = self.warp(atlas_img)
+        img = nib.Nifti1Image(out, self.ref.affine)
+        img.set_qform(*self.ref.get_qform(coded=True))
+        img.set_sform(*self.ref.get_sform(coded=True))
+        img.header.set_xyzt_units(*self.ref.header.get_xyzt_units())
+        img.set_data_dtype(atlas_img.get_data_dtype())
+        nib.save(img, output_path)
+        return out
+
+    def save_cache(self, path) -> None:
+        """Write the reference geometry and every index map computed so far."""
+        arrays = {'ref_shape': np.array(self.ref_shape, dtype=np.int64),
+                  'ref_vox2mm': _vox2mm_of(self.ref),
+                  'warp_sha1': np.array(_warp_digest(self.warp_path, self.absolute)),
+                  'grids': np.array(list(self._maps), dtype=np.float64).reshape(-1, 7)}
+        for i, index in enumerate(self._maps.values()):
+            arrays[f'index_{i}'] = index
+        np_zstd.savez(path, **arrays)
+        self._dirty = False
+
+    def load_cache(self, path) -> int:
+        """
+        Reuse the index maps of a cache written for the same reference grid and warp; returns how many.
+
+        A cache from another warp (e.g. invwarp was rerun), another reference
+        grid or without a warp digest is ignored and overwritten by the next
+        `save_cache`.
+        """
+        with np_zstd.load(path) as npz:
+            if tuple(npz['ref_shape']) != self.ref_shape or not np.allclose(npz['ref_vox2mm'], _vox2mm_of(self.ref)):
+                return 0
+            if 'warp_sha1' not in npz.files or str(npz['warp_sha1']) != _warp_digest(self.warp_path, self.absolute):
+                return 0
+            for i, row in enumerate(npz['grids']):
+                grid = tuple(int(n) for n in row[:3]) + tuple(float(z) for z in row[3:])
+                self._maps[grid] = npz[f'index_{i}']
+        return len(self._maps)
+
+
+def compare_fsl(atlas_path, output, warp_path, ref_path, absolute=False) -> int:
+    """
+    Number of voxels where `output` differs from ``applywarp --interp=nn`` of the same atlas.
+
+    Runs FSL's applywarp (which must be on the PATH) into a temporary file,
+    for checking `AtlasWarper` on real subjects before it replaces applywarp.
+    """
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fsl_out = os.path.join(tmp, 'fsl.nii.gz')
+        subprocess.run(['applywarp', '-i', atlas_path, '-r', ref_path, '-w', warp_path, '-o', fsl_out,
+                        '--interp=nn', '--abs' if absolute else '--rel'], check=True)
+        return int((np.asarray(nib.load(fsl_out).dataobj) != output).sum())
+
+
+def check_synthetic(seed=0) -> bool:
+    """
+    Compare `AtlasWarper` with the analytic result on a synthetic displacement field.
+
+    The field shifts every reference voxel by a random whole number of voxels
+    (plus sub-half-voxel noise, which nearest-neighbour rounding must absorb),
+    so the expected label of each voxel is a plain array lookup. Atlas and
+    reference use neurological storage, so the x axis is reversed. When FSL's ``applywarp`` is
+    on the PATH the same case is also compared with its output.
+    """
+    import shutil
+    import tempfile
+
+    rng = np.random.default_rng(seed)
+    shape, zooms = (45, 54, 45), (2.0, 2.0, 2.0)
+    affine = np.diag(list(zooms) + [1.0])
+    affine[:3, 3] = (-90, -126, -72)
+    labels = rng.integers(0, 400, size=shape).astype(np.int16)
+    shift = rng.integers(-3, 4, size=shape + (3,))
+    noise = rng.uniform(-0.45, 0.45, size=shape + (3,))
+    # Relative FSL mm displacement: the flipped x axis moves the other way in voxel indices
+    disp = ((shift * (-1, 1, 1) + noise) * zooms).astype(np.float32)
+
+    i, j, k = np.indices(shape)
+    src = np.stack([i + shift[..., 0], j + shift[..., 1], k + shift[..., 2]])
+    inside = np.all((src >= 0) & (src < np.array(shape)[:, None, None, None]), axis=0)
+    expected = np.where(inside, labels[tuple(np.clip(src, 0, np.array(shape)[:, None, None, None] - 1))], 0)
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {name: os.path.join(tmp, name + '.nii.gz') for name in ('ref', 'atlas', 'warp')}
+        nib.save(nib.Nifti1Image(rng.normal(size=shape).astype(np.float32), affine), paths['ref'])
+        nib.save(nib.Nifti1Image(labels, affine), paths['atlas'])
+        warp_img = nib.Nifti1Image(disp, affine)
+        warp_img.header['intent_code'] = 2006
+        nib.save(warp_img, paths['warp'])
+
+        t0 = time.perf_counter()
+        warper = AtlasWarper(paths['warp'], paths['ref'], cache=os.path.join(tmp, 'index.npz.zst'))
+        out = warper.warp_file(paths['atlas'], os.path.join(tmp, 'out.nii.gz'))
+        elapsed = time.perf_counter() - t0
+        n_diff = int((out != expected).sum())
+        ok &= n_diff == 0
+        print(f'synthetic field: {n_diff} / {out.size} voxels differ, {(expected > 0).mean():.0%} labelled, '
+              f'{elapsed * 1000:.0f} ms')
+
+        cache = os.path.join(tmp, 'index.npz.zst')
+        warper.save_cache(cache)
+        cached = AtlasWarper(paths['warp'], paths['ref'], cache=cache)
+        ok &= np.array_equal(cached.warp(nib.load(paths['atlas'])), out) and cached._positions is None
+
+        # A different warp at the same path must not reuse the stale maps
+        warp_img = nib.Nifti1Image(np.zeros_like(disp), affine)
+        nib.save(warp_img, paths['warp'])
+        stale = AtlasWarper(paths['warp'], paths['ref'], cache=cache)
+        ok &= not stale._maps and np.array_equal(stale.warp(nib.load(paths['atlas'])), labels)
+
+        if shutil.which('applywarp'):
+            n_fsl = compare_fsl(paths['atlas'], out, paths['warp'], paths['ref'])
+            ok &= n_fsl == 0
+            print(f'applywarp: {n_fsl} / {out.size} voxels differ')
+        else:
+            print('applywarp not found, FSL comparison skipped')
+    print('OK' if ok else 'MISMATCH')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Warp many label atlases into subject space with one FSL warp field '
+                    '(replaces one "applywarp --interp=nn" call per atlas).')
+    parser.add_argument('--warp', '-w', help='Warp field, e.g. standard2example_func_warp from invwarp.')
+    parser.add_argument('--ref', '-r', help='Reference image defining the output grid, e.g. example_func.')
+    parser.add_argument('--input', '-i', nargs='+', default=[], help='Atlas label volumes (standard space).')
+    parser.add_argument('--output', '-o', nargs='+', default=[], help='Output paths, one per --input.')
+    parser.add_argument('--abs', action='store_true', help='The warp holds absolute positions (default: relative).')
+    parser.add_argument('--cache', default=None,
+                        help='Per-subject .npz.zst index map cache: reused when present, (re)written otherwise.')
+    parser.add_argument('--compare_fsl', action='store_true',
+                        help='Also run FSL applywarp --interp=nn for every atlas and report differing voxels '
+                             '(exit status 1 on any difference).')
+    parser.add_argument('--check', action='store_true',
+                        help='Validate against a synthetic displacement field (and applywarp, if found) and exit.')
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check_synthetic() else 1)
+    if not args.warp or not args.ref or not args.input:
+        parser.error('--warp, --ref and --input are required')
+    if len(args.input) != len(args.output):
+        parser.error('--input and --output must have the same length')
+
+    t0 = time.perf_counter()
+    warper = AtlasWarper(args.warp, args.ref, absolute=args.abs, cache=args.cache)
+    n_diff = 0
+    for atlas_path, output_path in zip(args.input, args.output):
+        out = warper.warp_file(atlas_path, output_path)
+        print(f'{atlas_path} -> {output_path}')
+        if args.compare_fsl:
+            n = compare_fsl(atlas_path, out, args.warp, args.ref, absolute=args.abs)
+            n_diff += n
+            print(f'  applywarp: {n} / {out.size} voxels differ')
+    if args.cache and warper._dirty:
+        warper.save_cache(args.cache)
+    print(f'Warped {len(args.input)} atlases in {time.perf_counter() - t0:.2f} s')
+    if n_diff:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+
+import np_zstd
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; only in-process locking then
+    fcntl = None
+
+
+class DecompressedCache:
+    """
+    Size-bounded local cache of decompressed arrays, returned as read-only memmaps.
+
+    The first `get` of a key decodes the array once and writes it as a plain
+    `.npy` under `cache_dir` (temp file + atomic rename, under a per-key lock
+    that also holds across processes on POSIX). Later calls return
+    ``np.load(..., mmap_mode='r')`` views, so warm reads only cost page-cache
+    traffic. When the cache grows past `max_bytes`, the least recently used
+    entries (by file mtime, refreshed on every hit) are deleted together with
+    their `.lock` files, down to `low_water` of the budget.
+
+    Entry sizes and access times are tracked in memory (one directory scan at
+    start-up), so a miss does not rescan the directory. The directory is only
+    rescanned when the tracked size exceeds the budget, which also picks up
+    entries added by other processes sharing it.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Local directory for the cached `.npy` files.
+    max_bytes : int
+        Byte budget for the cache directory.
+    dtype : np.dtype or None
+        If given (e.g. float16, the precision of most stored .npy.zst members),
+        floating-point arrays wider than `dtype` are cached as `dtype`, so
+        float32 results of dequantization or re-normalization do not double the
+        footprint. This is lossy (float16 overflows above 65504); the default
+        None caches arrays exactly as produced.
+    low_water : float
+        Fraction of `max_bytes` to evict down to.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, dtype=None, low_water=0.9):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.low_water = low_water
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._index = {}  # path -> [atime, size]
+        self._total = 0
+        self._rescan()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'bytes': self.size_bytes(), 'max_bytes': self.max_bytes}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def _key_lock(self, path: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(path, threading.Lock())
+
+    def _entries(self):
+        out = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                out.append((st.st_mtime, st.st_size, entry.path))
+        return out
+
+    def size_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _rescan(self) -> None:
+        entries = self._entries()
+        with self._lock:
+            self._index = {path: [atime, size] for atime, size, path in entries}
+            self._total = sum(size for _, size, _ in entries)
+
+    def _touch(self, path: str, size=None) -> None:
+        with self._lock:
+            entry = self._index.get(path)
+            if entry is None:
+                if size is None:
+                    size = os.path.getsize(path)
+                self._index[path] = entry = [0.0, size]
+                self._total += size
+            entry[0] = time.time()
+
+    def _evict(self, keep: str) -> None:
+        if self._total <= self.max_bytes:
+            return
+        self._rescan()
+        with self._lock:
+            entries = sorted((atime, size, path) for path, (atime, size) in self._index.items())
+        target = self.max_bytes * self.low_water
+        for _, size, path in entries:
+            if self._total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            else:
+                with self._lock:
+                    self.evictions += 1
+            try:
+                os.remove(path + '.lock')
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                if self._index.pop(path, None) is not None:
+                    self._total -= size
+
+    def _open_hit(self, path: str):
+        try:
+            os.utime(path)
+            arr = np.load(path, mmap_mode='r')
+        except FileNotFoundError:  # evicted by another worker in between
+            with self._lock:
+                entry = self._index.pop(path, None)
+                if entry is not None:
+                    self._total -= entry[1]
+            return None
+        self._touch(path)
+        with self._lock:
+            self.hits += 1
+        return arr
+
+    def get(self, key: str, producer):
+        """Return the cached array for `key`, calling `producer()` to build it on a miss."""
+        # Downcast entries must not be served to a cache with another (or no) dtype
+        path = self._path(key if self.dtype is None else f'{key}:{self.dtype.str}')
+        if os.path.exists(path):
+            arr = self._open_hit(path)
+            if arr is not None:
+                return arr
+
+        with self._key_lock(path), open(path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another thread/process may have filled it while we waited
+                if os.path.exists(path):
+                    arr = self._open_hit(path)
+                    if arr is not None:
+                        return arr
+
+                with self._lock:
+                    self.misses += 1
+                arr = np.asarray(producer())
+                if (self.dtype is not None and arr.dtype.kind == 'f' and self.dtype.kind == 'f'
+                        and arr.dtype.itemsize > self.dtype.itemsize):
+                    arr = arr.astype(self.dtype)
+                tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, arr, allow_pickle=False)
+                size = os.path.getsize(tmp_path)
+                os.replace(tmp_path, path)
+                self._touch(path, size)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self._evict(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def load(self, file: str):
+        """Cached `np_zstd.load` (plus `np_zstd.unpack`) keyed by path, size and mtime."""
+        st = os.stat(file)
+        key = f'{os.path.abspath(file)}:{st.st_size}:{st.st_mtime_ns}'
+        return self.get(key, lambda: np_zstd.unpack(np_zstd.load(file)))
+
+    def clear(self) -> None:
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy') or name.endswith('.lock'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+        self._rescan()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or clear a decompressed .npy cache directory.')
+    parser.add_argument('cache_dir', help='Cache directory.')
+    parser.add_argument('--max_gb', type=float, default=100.0, help='Byte budget in GB.')
+    parser.add_argument('--clear', action='store_true', help='Delete every cached entry.')
+    args = parser.parse_args()
+
+    cache = DecompressedCache(args.cache_dir, int(args.max_gb * 1e9))
+    if args.clear:
+        cache.clear()
+    entries = cache._entries()
+    print(f'{len(entries)} entries, {sum(size for _, size, _ in entries) / 1e9:.2f} GB '
+          f'(budget {cache.max_bytes / 1e9:.2f} GB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import fnmatch
+import glob
+import hashlib
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import np_zstd
+from moments import Moments, VoxelMoments, load_stats, parse_stats, renormalize_
+from shard import ShardSet
+from zst_cache import DecompressedCache
+
+
+class DirectorySource:
+    """Subjects stored as ``<root>/<subject>/<member>`` on local disk (same API as `shard.ShardSet`)."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._subjects = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._subjects)
+
+    def subjects(self) -> list:
+        return list(self._subjects)
+
+    def members(self, subject: str) -> list:
+        subject_dir = os.path.join(self.root, subject)
+        out = []
+        for dirpath, _, filenames in os.walk(subject_dir):
+            for name in filenames:
+                out.append(os.path.relpath(os.path.join(dirpath, name), subject_dir).replace(os.sep, '/'))
+        return sorted(out)
+
+    def fingerprint(self, subject: str, member: str) -> str:
+        """Size and mtime of a member file, e.g. to key caches of decoded members."""
+        st = os.stat(os.path.join(self.root, subject, member))
+        return f'{st.st_size}:{st.st_mtime_ns}'
+
+    def read_bytes(self, subject: str, member: str) -> bytes:
+        with open(os.path.join(self.root, subject, member), 'rb') as f:
+            return f.read()
+
+
+def open_source(path: str):
+    """Open a tar shard, a directory of shards, or a directory of subject directories."""
+    if os.path.isdir(path) and not glob.glob(os.path.join(path, '*.tar')):
+        return DirectorySource(path)
+    return ShardSet(path)
+
+
+class ZstLoader:
+    """
+    Iterate over one `.npy.zst` member per subject with parallel decompression.
+
+    Decoding runs in a thread pool (zstd releases the GIL) with at most
+    `prefetch` members in flight; decoded samples pass through a shuffle
+    buffer of `shuffle_buffer` entries before they are yielded, so memory is
+    bounded by roughly ``prefetch + shuffle_buffer`` arrays.
+
+    Parameters
+    ----------
+    source : str or source object
+        Path accepted by `open_source`, or an object with the `shard.ShardSet` API
+        (including ``fingerprint`` when a `cache` is used).
+    member : str
+        fnmatch pattern selecting the member of each subject to load.
+    batch_size : int or None
+        If given, yield ``(subjects, batch)`` with the arrays stacked on a new
+        first axis; otherwise yield ``(subject, array)``.
+    shuffle : bool
+        Shuffle the subject order every epoch and mix samples through the shuffle buffer.
+    shuffle_buffer : int
+        Number of decoded samples held for shuffling.
+    prefetch : int
+        Maximum number of members being decoded or waiting to be consumed.
+    workers : int or None
+        Decompression threads (default: all CPUs).
+    dtype : np.dtype or None
+        Output dtype (None keeps the stored dtype).
+    epochs : int
+        Number of passes over the subjects.
+    drop_last : bool
+        Drop the final incomplete batch.
+    skip_errors : bool
+        Print and skip subjects that fail to decode instead of raising.
+    seed : int or None
+        Seed for the subject order and the shuffle buffer.
+    cache : zst_cache.DecompressedCache or None
+        Optional local cache; decoded members are stored once and served as
+        memmaps in later epochs.
+    renormalize : str, moments.Moments, moments.VoxelMoments or None
+        Cohort statistics (a file written by ``moments.py``, or an accumulator)
+        to re-normalize every sample to on load. Each subject's own mean/std
+        is read from its `stats_member`, and the stored z-scores are mapped to
+        cohort z-scores without touching the original data.
+    voxelwise : bool
+        With a statistics file as `renormalize`, use its per-voxel maps
+        instead of the global mean/std.
+    stats_member : str
+        fnmatch pattern of the per-subject statistics member.
+    stats_prefix : str or dict
+        Key prefix inside the statistics member, or a dict of member fnmatch
+        pattern -> prefix picked per loaded member (first match, else no
+        prefix). For nifti_mask_proc.py output, whose ``_masking_stats`` file
+        holds both runs, use ``{'*_pre40_*': 'pre_', '*_post40_*': 'post_'}``.
+    """
+
+    def __init__(self, source, member='*.npy.zst', batch_size=None, shuffle=True, shuffle_buffer=16, prefetch=None,
+                 workers=None, dtype=np.float32, epochs=1, drop_last=False, skip_errors=False, seed=None, cache=None,
+                 renormalize=None, voxelwise=False, stats_member='*_meanstd.npz.zst', stats_prefix=''):
+        self._source_id = os.path.abspath(source) if isinstance(source, str) else type(source).__name__
+        self.source = open_source(source) if isinstance(source, str) else source
+        self.member = member
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.workers = workers or os.cpu_count() or 1
+        self.prefetch = prefetch or 2 * self.workers
+        self.dtype = dtype
+        self.epochs = epochs
+        self.drop_last = drop_last
+        self.skip_errors = skip_errors
+        self.seed = seed
+        self.cache = cache
+        self.stats_member = stats_member
+        self.stats_prefix = stats_prefix
+        if isinstance(renormalize, str):
+            moments, voxel, _ = load_stats(renormalize)
+            if voxelwise and voxel is None:
+                raise ValueError(f'{renormalize} has no per-voxel maps')
+            renormalize = voxel if voxelwise else moments
+        if renormalize is not None and not isinstance(renormalize, (Moments, VoxelMoments)):
+            raise TypeError(f'renormalize must be a stats file, Moments or VoxelMoments, got {type(renormalize)}')
+        self.renormalize = renormalize
+        # Stable across runs, so cached renormalized samples are reused with the same cohort statistics
+        self._renormalize_key = None
+        if isinstance(renormalize, Moments):
+            self._renormalize_key = f'{renormalize.count}:{renormalize.mean!r}:{renormalize.m2!r}'
+        elif renormalize is not None:
+            digest = hashlib.sha1(renormalize.mean.tobytes() + renormalize.m2.tobytes())
+            self._renormalize_key = digest.hexdigest()
+
+        self.samples = 0
+        self.bytes_read = 0
+        self.elapsed = 0.0
+        self._passes = 0
+
+    def __len__(self) -> int:
+        """Samples over all epochs, or batches when `batch_size` is set (batches span epochs)."""
+        n = len(self.source) * self.epochs
+        if self.batch_size is None:
+            return n
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+    @property
+    def samples_per_sec(self) -> float:
+        return self.samples / self.elapsed if self.elapsed else 0.0
+
+    def _find_member(self, subject: str):
+        matches = [m for m in self.source.members(subject) if fnmatch.fnmatch(m, self.member)]
+        return matches[0] if matches else None
+
+    def _jobs(self, rng):
+        for _ in range(self.epochs):
+            subjects = self.source.subjects()
+            if self.shuffle:
+                rng.shuffle(subjects)
+            for subject in subjects:
+                member = self._find_member(subject)
+                if member is None:
+                    print(f'Warning: no member matching {self.member} for subject {subject}')
+                    continue
+                yield subject, member
+
+    def _read_decode(self, subject: str, member: str):
+        data = self.source.read_bytes(subject, member)
+        arr = np_zstd.unpack(np_zstd.loads(data), dtype=self.dtype or np.float32)
+        if self.renormalize is not None:
+            arr = self._renormalize(subject, member, arr)
+        return arr, len(data)
+
+    def _stats_prefix_for(self, member: str) -> str:
+        if isinstance(self.stats_prefix, str):
+            return self.stats_prefix
+        return next((prefix for pattern, prefix in self.stats_prefix.items() if fnmatch.fnmatch(member, pattern)), '')
+
+    def _renormalize(self, subject: str, member: str, arr: np.ndarray) -> np.ndarray:
+        candidates = fnmatch.filter(self.source.members(subject), self.stats_member)
+        if not candidates:
+            raise ValueError(f'No statistics member matching {self.stats_member} for subject {subject}')
+        # Prefer the statistics written next to this member (same file name stem)
+        stem = member.split('.', 1)[0]
+        name = next((c for c in candidates if c.startswith(stem)), candidates[0])
+        _, _, applied = parse_stats(self.source.read_bytes(subject, name), name,
+                                    prefix=self._stats_prefix_for(member))
+        if arr.dtype not in (np.float32, np.float64):
+            arr = arr.astype(np.float32)
+        elif not arr.flags.writeable:
+            arr = arr.copy()
+        return renormalize_(arr, applied, self.renormalize)
+
+    def _decode(self, subject: str, member: str):
+        if self.cache is None:
+            arr, n_bytes = self._read_decode(subject, member)
+        else:
+            n_read = []
+
+            def produce():
+                arr, n = self._read_decode(subject, member)
+                n_read.append(n)
+                return arr
+
+            # The member's size/CRC (or size/mtime) invalidates entries of rewritten shards or files
+            key = f'{self._source_id}:{subject}/{member}:{self.source.fingerprint(subject, member)}'
+            if self.renormalize is not None:
+                key += f':renormalized:{self._renormalize_key}:{self._stats_prefix_for(member)}'
+            arr = self.cache.get(key, produce)
+            n_bytes = sum(n_read)
+
+        if self.dtype is not None and arr.dtype != self.dtype:
+            arr = arr.astype(self.dtype)
+        return subject, arr, n_bytes
+
+    def _samples(self):
+        # Fresh order on every pass, reproducible for a given seed
+        rng = np.random.default_rng(None if self.seed is None else [self.seed, self._passes])
+        jobs = self._jobs(rng)
+        pending = collections.deque()
+        buffer = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                for job in itertools.islice(jobs, self.prefetch):
+                    pending.append((job, pool.submit(self._decode, *job)))
+
+                while pending:
+                    job, future = pending.popleft()
+                    nxt = next(jobs, None)
+                    if nxt is not None:
+                        pending.append((nxt, pool.submit(self._decode, *nxt)))
+
+                    try:
+                        subject, arr, n_bytes = future.result()
+                    except Exception as e:
+                        if not self.skip_errors:
+                            raise
+                        print(f'Error loading {job[0]}/{job[1]}: {e}')
+                        continue
+                    self.bytes_read += n_bytes
+
+                    if self.shuffle_buffer <= 1:
+                        yield subject, arr
+                        continue
+                    buffer.append((subject, arr))
+                    if len(buffer) >= self.shuffle_buffer:
+                        i = int(rng.integers(len(buffer)))
+                        buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                        yield buffer.pop()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        self.samples, self.bytes_read, self.elapsed = 0, 0, 0.0
+        t0 = time.perf_counter()
+
+        batch_subjects, batch_arrays = [], []
+        for subject, arr in self._samples():
+            self.samples += 1
+            self.elapsed = time.perf_counter() - t0
+            if self.batch_size is None:
+                yield subject, arr
+                continue
+
+            batch_subjects.append(subject)
+            batch_arrays.append(arr)
+            if len(batch_arrays) == self.batch_size:
+                yield batch_subjects, np.stack(batch_arrays)
+                batch_subjects, batch_arrays = [], []
+
+        if batch_arrays and not self.drop_last:
+            yield batch_subjects, np.stack(batch_arrays)
+        self.elapsed = time.perf_counter() - t0
+        self._passes += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure loader throughput over .npy.zst subjects.')
+    parser.add_argument('path', help='Tar shard, directory of shards, or directory of subject directories.')
+    parser.add_argument('--member', '-m', type=str, default='*.npy.zst', help='fnmatch pattern of the member to load.')
+    parser.add_argument('--workers', '-j', type=int, default=None, help='Decompression threads (default: all CPUs).')
+    parser.add_argument('--prefetch', '-p', type=int, default=None, help='Members in flight (default: 2x workers).')
+    parser.add_argument('--shuffle_buffer', '-s', type=int, default=16, help='Shuffle buffer size.')
+    parser.add_argument('--batch_size', '-b', type=int, default=None, help='Batch size (default: single samples).')
+    parser.add_argument('--epochs', '-e', type=int, default=1, help='Number of epochs.')
+    parser.add_argument('--dtype', type=str, default='float32', help='Output dtype.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Optional decompressed .npy cache directory.')
+    parser.add_argument('--cache_gb', type=float, default=100.0, help='Cache budget in GB.')
+    parser.add_argument('--cache_dtype', type=str, default=None, choices=['float16', 'float32'],
+                        help='Downcast cached floating-point entries to this dtype (default: cache them as decoded).')
+    parser.add_argument('--renormalize', type=str, default=None,
+                        help='Cohort statistics file (moments.py) to re-normalize samples to on load.')
+    parser.add_argument('--voxelwise', action='store_true',
+                        help='Re-normalize with the per-voxel maps of the --renormalize file.')
+    parser.add_argument('--stats_member', type=str, default='*_meanstd.npz.zst',
+                        help='fnmatch pattern of the per-subject statistics member for --renormalize.')
+    parser.add_argument('--stats_prefix', type=str, action='append', default=None,
+                        help='Key prefix inside the statistics member, or PATTERN=PREFIX to pick it per loaded '
+                             'member (repeatable), e.g. for nifti_mask_proc.py output '
+                             '--stats_member "*_masking_stats.npz.zst" '
+                             '--stats_prefix "*_pre40_*=pre_" --stats_prefix "*_post40_*=post_".')
+    args = parser.parse_args()
+
+    stats_prefix = ''
+    if args.stats_prefix:
+        if len(args.stats_prefix) == 1 and '=' not in args.stats_prefix[0]:
+            stats_prefix = args.stats_prefix[0]
+        elif all('=' in p for p in args.stats_prefix):
+            stats_prefix = dict(p.split('=', 1) for p in args.stats_prefix)
+        else:
+            parser.error('--stats_prefix takes one PREFIX or one or more PATTERN=PREFIX')
+
+    cache = None
+    if args.cache_dir:
+        cache = DecompressedCache(args.cache_dir, int(args.cache_gb * 1e9), dtype=args.cache_dtype)
+    loader = ZstLoader(args.path, member=args.member, batch_size=args.batch_size, shuffle_buffer=args.shuffle_buffer,
+                       prefetch=args.prefetch, workers=args.workers, dtype=np.dtype(args.dtype), seed=args.seed,
+                       cache=cache, renormalize=args.renormalize,
+                       voxelwise=args.voxelwise, stats_member=args.stats_member, stats_prefix=stats_prefix)
+    for epoch in range(args.epochs):
+        out_bytes = 0
+        for _, arr in loader:
+            out_bytes += arr.nbytes
+
+        print(f'Epoch {epoch}: {loader.samples} samples in {loader.elapsed:.2f} s with {loader.workers} workers: '
+              f'{loader.samples_per_sec:.1f} samples/s, {loader.bytes_read / 1e6 / max(loader.elapsed, 1e-9):.1f} MB/s '
+              f'compressed, {out_bytes / 1e6 / max(loader.elapsed, 1e-9):.1f} MB/s decoded')
+        if cache is not None:
+            print(f'Cache: {cache.stats()}')
+
+
+if __name__ == '__main__':
+    main()
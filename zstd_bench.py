@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import glob
+import itertools
+import time
+
+import numpy as np
+
+import np_zstd
+
+
+def _load_any(path: str) -> np.ndarray:
+    if path.endswith('.npy'):
+        return np.load(path, allow_pickle=False)
+    return np_zstd.load(path)
+
+
+def _npy_bytes(arr: np.ndarray) -> bytes:
+    arr = np.ascontiguousarray(arr)
+    return np_zstd._npy_header(arr) + arr.tobytes()
+
+
+def bench_payloads(payloads, level, threads, long_distance=False, window_log=0, repeat=3):
+    """
+    Time compression and decompression of `payloads` with one codec setting.
+
+    Returns
+    -------
+    row : dict
+        Raw size, compressed size, ratio and best-of-`repeat` MB/s for
+        compression and decompression.
+    """
+    cctx = np_zstd.make_compressor(level=level, threads=threads, long_distance=long_distance, window_log=window_log)
+    dctx = np_zstd.make_decompressor()
+
+    raw_bytes = sum(len(p) for p in payloads)
+    comp_time = dec_time = float('inf')
+    frames = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        frames = [cctx.compress(p) for p in payloads]
+        comp_time = min(comp_time, time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        for f in frames:
+            dctx.decompress(f)
+        dec_time = min(dec_time, time.perf_counter() - t0)
+
+    comp_bytes = sum(len(f) for f in frames)
+    mb = raw_bytes / 1e6
+    return {
+        'raw_MB': round(mb, 2),
+        'comp_MB': round(comp_bytes / 1e6, 2),
+        'ratio': round(raw_bytes / max(comp_bytes, 1), 3),
+        'comp_MBps': round(mb / comp_time, 1),
+        'decomp_MBps': round(mb / dec_time, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark zstd settings (level x threads x dtype) on nifti_process.py outputs.')
+    parser.add_argument('inputs', nargs='+', help='Input .npy.zst/.npy files or glob patterns.')
+    parser.add_argument('--levels', '-l', type=int, nargs='+', default=[1, 3, 5, 8, 12, 19],
+                        help='Compression levels to test.')
+    parser.add_argument('--threads', '-j', type=int, nargs='+', default=[0, -1],
+                        help='Compressor thread counts to test (0: single-threaded, -1: all CPUs).')
+    parser.add_argument('--dtypes', '-d', type=str, nargs='+', default=['float16', 'float32'],
+                        help='Dtypes to cast the arrays to before compressing.')
+    parser.add_argument('--long', action='store_true', help='Enable long-distance matching.')
+    parser.add_argument('--window_log', '-w', type=int, default=0, help='Window log (0: level default).')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Repetitions per setting (best is kept).')
+    parser.add_argument('--max_files', '-n', type=int, default=4, help='Maximum number of input files to use.')
+    parser.add_argument('--csv', type=str, default=None, help='Optional CSV path for the result table.')
+    args = parser.parse_args()
+
+    paths = sorted(itertools.chain.from_iterable(glob.glob(p) or [p] for p in args.inputs))[:args.max_files]
+    if not paths:
+        raise ValueError('No input files found.')
+
+    arrays = [_load_any(p) for p in paths]
+    print(f'Loaded {len(arrays)} arrays, first shape {arrays[0].shape} ({arrays[0].dtype})')
+
+    rows = []
+    header = f'{"dtype":>8} {"level":>5} {"threads":>7} {"ratio":>7} {"comp MB/s":>10} {"decomp MB/s":>12}'
+    print(header)
+    print('-' * len(header))
+    for dtype in args.dtypes:
+        payloads = [_npy_bytes(a.astype(dtype, copy=False)) for a in arrays]
+        for level, threads in itertools.product(args.levels, args.threads):
+            row = {'dtype': dtype, 'level': level, 'threads': threads, 'long': args.long,
+                   'window_log': args.window_log}
+            row.update(bench_payloads(payloads, level, threads, args.long, args.window_log, args.repeat))
+            rows.append(row)
+            print(f'{dtype:>8} {level:>5} {threads:>7} {row["ratio"]:>7.3f} '
+                  f'{row["comp_MBps"]:>10.1f} {row["decomp_MBps"]:>12.1f}')
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f'Results saved to {args.csv}')
+
+
+if __name__ == '__main__':
+    main()
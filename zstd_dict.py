@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import glob
+import itertools
+import os
+import random
+import time
+
+import np_zstd
+
+
+def _expand(patterns):
+    return sorted(set(itertools.chain.from_iterable(glob.glob(p, recursive=True) or [p] for p in patterns)))
+
+
+def train(args):
+    files = _expand(args.inputs)
+    if args.sample and len(files) > args.sample:
+        files = random.Random(args.seed).sample(files, args.sample)
+
+    print(f'Training a {args.size}-byte dictionary on {len(files)} files...')
+    d = np_zstd.train_dictionary(files, dict_size=args.size)
+    np_zstd.save_dictionary(args.output, d)
+    print(f'Dictionary {d.dict_id()} saved to {args.output}')
+
+
+def recompress(args):
+    np_zstd.use_dictionary(args.dict)
+
+    files = _expand(args.inputs)
+    before = after = 0
+    for path in files:
+        data = np_zstd.load_bytes(path)
+        out_path = path if path.endswith('.zst') else path + '.zst'
+        tmp_path = out_path + '.tmp'
+        np_zstd.save_bytes(tmp_path, data)
+
+        before += os.path.getsize(path)
+        after += os.path.getsize(tmp_path)
+        os.replace(tmp_path, out_path)
+        if out_path != path and args.remove:
+            os.remove(path)
+
+    print(f'Recompressed {len(files)} files: {before} -> {after} bytes')
+
+
+def bench(args):
+    files = _expand(args.inputs)
+    payloads = [np_zstd.load_bytes(f) for f in files]
+    raw_bytes = sum(len(p) for p in payloads)
+
+    d = np_zstd.register_dictionary(args.dict)
+    rows = [('no dict', np_zstd.make_compressor(), np_zstd.make_decompressor()),
+            (f'dict {d.dict_id()}', np_zstd.make_compressor(dict_data=d), np_zstd.make_decompressor(d))]
+
+    print(f'{len(files)} files, {raw_bytes} raw bytes')
+    for name, cctx, dctx in rows:
+        frames = [cctx.compress(p) for p in payloads]
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for f in frames:
+                dctx.decompress(f)
+        per_file = (time.perf_counter() - t0) / (args.repeat * len(frames))
+        comp_bytes = sum(len(f) for f in frames)
+        print(f'{name:>16}: {comp_bytes:>10} bytes (ratio {raw_bytes / comp_bytes:6.2f}), '
+              f'{per_file * 1e6:8.1f} us/file decompress')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train and apply zstd dictionaries for small .zst artifacts.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('train', help='Train a dictionary from sample files.')
+    p.add_argument('inputs', nargs='+', help='Sample files or glob patterns (.zst files are decompressed first).')
+    p.add_argument('--output', '-o', required=True, help='Output dictionary path (.zdict).')
+    p.add_argument('--size', '-s', type=int, default=np_zstd._DICT_SIZE, help='Dictionary size in bytes.')
+    p.add_argument('--sample', '-n', type=int, default=10000, help='Maximum number of files to sample.')
+    p.add_argument('--seed', type=int, default=0, help='Random seed for sampling.')
+    p.set_defaults(func=train)
+
+    p = sub.add_parser('recompress', help='Rewrite files with a dictionary (in place for .zst, '
+                                          'next to the original otherwise).')
+    p.add_argument('inputs', nargs='+', help='Files or glob patterns.')
+    p.add_argument('--dict', '-D', required=True, help='Dictionary path.')
+    p.add_argument('--remove', action='store_true',
+                   help='Delete uncompressed originals once their .zst file is written (default: keep them).')
+    p.set_defaults(func=recompress)
+
+    p = sub.add_parser('bench', help='Compare size and decompression time with and without a dictionary.')
+    p.add_argument('inputs', nargs='+', help='Files or glob patterns.')
+    p.add_argument('--dict', '-D', required=True, help='Dictionary path.')
+    p.add_argument('--repeat', '-r', type=int, default=5, help='Repetitions.')
+    p.set_defaults(func=bench)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()